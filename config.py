@@ -247,6 +247,32 @@ def getFFmpegWait():
     else:
         return 0
 
+def get_cache_dir(subdir=''):
+    path = get_server('cache_dir')
+    if not path:
+        return None
+    path = os.path.expanduser(path)
+    if subdir:
+        path = os.path.join(path, subdir)
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError, msg:
+            logger = logging.getLogger('pyTivo.config')
+            logger.error('Bad cache_dir path: %s -- %s' % (path, msg))
+            return None
+    return path
+
+def get_server_size(name, default):
+    """Read a size in bytes, like "32Mi", from the Server section."""
+    value = get_server(name, default)
+    try:
+        return max(int(strtod(value)), 0)
+    except SyntaxError:
+        logger = logging.getLogger('pyTivo.config')
+        logger.error('Bad %s setting: %s' % (name, value))
+        return int(strtod(default))
+
 def getFFmpegTemplate(tsn):
     tmpl = get_tsn('ffmpeg_tmpl', tsn, True)
     if tmpl:
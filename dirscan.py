@@ -0,0 +1,262 @@
+"""Directory listings for the plugins' get_files(), with as few system
+calls as possible.
+
+Entries are read along with their type, so that telling files from
+directories doesn't take a stat() of each one: via the "scandir" module
+if it's installed, else readdir() through ctypes on Linux, else
+os.listdir() and os.path.isdir() as before. (Where the type isn't known
+-- symlinks, and some network filesystems -- isdir() is still used.)
+Each Entry only stats its file when its date or size is first asked
+for, which for a listing sorted by name is just the page being shown.
+
+Recursive listings can also walk several directories at once, in
+"walk_threads" threads, which helps most on network shares, where each
+call waits on the server. The result is in the same order either way.
+
+Names are UTF-8 strings, NFC-normalized on the Mac, as before.
+"""
+
+import Queue
+import ctypes
+import ctypes.util
+import logging
+import os
+import sys
+import threading
+import unicodedata
+
+import config
+
+logger = logging.getLogger('pyTivo.dirscan')
+
+DT_UNKNOWN, DT_DIR, DT_LNK = 0, 4, 10
+
+class Entry(object):
+    """One file or directory. mdate, cdate and size come from stat(),
+       which is only called the first time one of them is used."""
+
+    __slots__ = ('name', 'isdir', 'mdate', 'cdate', 'size')
+
+    def __init__(self, name, isdir):
+        self.name = name
+        self.isdir = isdir
+
+    def __getattr__(self, attr):
+        if attr not in ('mdate', 'cdate', 'size'):
+            raise AttributeError(attr)
+        try:
+            st = os.stat(unicode(self.name, 'utf-8'))
+            self.mdate = int(st.st_mtime)
+            self.cdate = int(st.st_ctime)
+            self.size = st.st_size
+        except OSError:
+            self.mdate = self.cdate = self.size = 0
+        return getattr(self, attr)
+
+def _find_scandir():
+    try:
+        import scandir
+        return scandir.scandir
+    except ImportError:
+        return None
+
+def _find_readdir():
+    if not sys.platform.startswith('linux'):
+        return None
+
+    class dirent64(ctypes.Structure):
+        _fields_ = [('d_ino', ctypes.c_uint64),
+                    ('d_off', ctypes.c_int64),
+                    ('d_reclen', ctypes.c_ushort),
+                    ('d_type', ctypes.c_ubyte),
+                    ('d_name', ctypes.c_char * 256)]
+
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        opendir = libc.opendir
+        readdir = libc.readdir64
+        closedir = libc.closedir
+    except (OSError, TypeError, AttributeError):
+        return None
+    opendir.argtypes = [ctypes.c_char_p]
+    opendir.restype = ctypes.c_void_p
+    readdir.argtypes = [ctypes.c_void_p]
+    readdir.restype = ctypes.POINTER(dirent64)
+    closedir.argtypes = [ctypes.c_void_p]
+
+    def libc_readdir(path):
+        # (name, d_type) for each entry in path, a byte string
+        handle = opendir(path)
+        if not handle:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), path)
+        try:
+            result = []
+            while True:
+                ctypes.set_errno(0)
+                ent = readdir(handle)
+                if not ent:
+                    err = ctypes.get_errno()
+                    if err:
+                        raise OSError(err, os.strerror(err), path)
+                    return result
+                result.append((ent.contents.d_name, ent.contents.d_type))
+        finally:
+            closedir(handle)
+
+    return libc_readdir
+
+_scandir = _find_scandir()
+_readdir = not _scandir and _find_readdir()
+
+def _fs_to_utf8(name):
+    # A byte string name from the filesystem, as UTF-8, or None if it
+    # can't be decoded
+    encoding = sys.getfilesystemencoding() or 'utf-8'
+    try:
+        if encoding.lower().replace('-', '') == 'utf8':
+            name.decode('utf-8')
+            return name
+        return name.decode(encoding).encode('utf-8')
+    except (UnicodeError, LookupError):
+        return None
+
+def entries(path):
+    """(name, isdir) for everything in path (a UTF-8 string) except
+       dotfiles, with name the full path. Raises OSError if path can't
+       be read."""
+    result = []
+    if _scandir:
+        for ent in _scandir(unicode(path, 'utf-8')):
+            if ent.name.startswith('.'):
+                continue
+            name = ent.path
+            if sys.platform == 'darwin':
+                name = unicodedata.normalize('NFC', name)
+            result.append((name.encode('utf-8'), ent.is_dir()))
+    elif _readdir:
+        fspath = unicode(path, 'utf-8').encode(sys.getfilesystemencoding()
+                                               or 'utf-8')
+        for fname, dtype in _readdir(fspath):
+            if fname.startswith('.'):
+                continue
+            name = _fs_to_utf8(fname)
+            if name is None:
+                continue
+            name = os.path.join(path, name)
+            if dtype in (DT_UNKNOWN, DT_LNK):
+                isdir = os.path.isdir(os.path.join(fspath, fname))
+            else:
+                isdir = (dtype == DT_DIR)
+            result.append((name, isdir))
+    else:
+        upath = unicode(path, 'utf-8')
+        for f in os.listdir(upath):
+            if f.startswith('.'):
+                continue
+            f = os.path.join(upath, f)
+            isdir = os.path.isdir(f)
+            if sys.platform == 'darwin':
+                f = unicodedata.normalize('NFC', f)
+            result.append((f.encode('utf-8'), isdir))
+    return result
+
+def threads():
+    try:
+        return max(int(config.get_server('walk_threads', 1)), 1)
+    except ValueError:
+        return 1
+
+def scan(path, recurse=False, keep=None, cls=Entry):
+    """List path (a UTF-8 string), as cls(name, isdir) objects, for
+       each entry that keep(name, isdir) accepts (all, if keep is None).
+       If recurse is set, directories are walked into instead of being
+       listed, in walk_threads threads. Unreadable directories are
+       skipped."""
+    if recurse and threads() > 1:
+        return _Walk(keep, cls).run(path, threads())
+
+    files = []
+    try:
+        for name, isdir in entries(path):
+            if recurse and isdir:
+                files.extend(scan(name, recurse, keep, cls))
+            elif not keep or keep(name, isdir):
+                files.append(cls(name, isdir))
+    except Exception, msg:
+        logger.debug('Unable to list %s -- %s' % (path, msg))
+    return files
+
+class _Walk(object):
+    """A recursive scan by several threads. Each directory's results go
+       in its own list, in which a subdirectory is a nested list, filled
+       in whenever it's read; flattening it all at the end gives the
+       same order as a serial walk."""
+
+    def __init__(self, keep, cls):
+        self.keep = keep
+        self.cls = cls
+        self.queue = Queue.Queue()
+        self.cond = threading.Condition()
+        self.pending = 0
+
+    def run(self, path, count):
+        root = []
+        self.add(path, root)
+        workers = []
+        for i in xrange(count):
+            t = threading.Thread(target=self.work, name='dirscan')
+            t.setDaemon(True)
+            t.start()
+            workers.append(t)
+        self.cond.acquire()
+        try:
+            while self.pending:
+                self.cond.wait()
+        finally:
+            self.cond.release()
+        for t in workers:
+            self.queue.put(None)
+        for t in workers:
+            t.join()
+
+        files = []
+        stack = [iter(root)]
+        while stack:
+            for item in stack[-1]:
+                if isinstance(item, list):
+                    stack.append(iter(item))
+                    break
+                files.append(item)
+            else:
+                stack.pop()
+        return files
+
+    def add(self, path, results):
+        self.cond.acquire()
+        self.pending += 1
+        self.cond.release()
+        self.queue.put((path, results))
+
+    def work(self):
+        while True:
+            job = self.queue.get()
+            if job is None:
+                return
+            path, results = job
+            try:
+                try:
+                    for name, isdir in entries(path):
+                        if isdir:
+                            sub = []
+                            results.append(sub)
+                            self.add(name, sub)
+                        elif not self.keep or self.keep(name, isdir):
+                            results.append(self.cls(name, isdir))
+                except Exception, msg:
+                    logger.debug('Unable to list %s -- %s' % (path, msg))
+            finally:
+                self.cond.acquire()
+                self.pending -= 1
+                self.cond.notifyAll()
+                self.cond.release()
@@ -0,0 +1,343 @@
+"""Watch directory trees for changes, so that cached listings can be
+patched in place instead of being rebuilt from scratch.
+
+There are two backends: inotify, on Linux, and a thread that polls the
+directory mtimes, for everywhere else. Callbacks are made from the
+watcher's own thread, as callback(action, path), where action is
+'create', 'delete' or 'change' -- or 'reset', if events were lost and
+the whole tree should be considered stale.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+import unicodedata
+
+import config
+
+logger = logging.getLogger('pyTivo.fswatch')
+
+POLL_INTERVAL = 10
+
+# From <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_MASK = (IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE |
+           IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+
+EVENT_HEADER = 'iIII'
+EVENT_SIZE = struct.calcsize(EVENT_HEADER)
+
+def listdir(path):
+    """Return the non-hidden names in path, as UTF-8, normalized the same
+       way as the plugins' own directory listings."""
+    names = []
+    for f in os.listdir(unicode(path, 'utf-8')):
+        if f.startswith('.'):
+            continue
+        if sys.platform == 'darwin':
+            f = unicodedata.normalize('NFC', f)
+        names.append(f.encode('utf-8'))
+    return names
+
+def isdir(path):
+    return os.path.isdir(unicode(path, 'utf-8'))
+
+class Watcher(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots = {}
+
+    def watch(self, key, root, callback):
+        """Start watching the tree under root. Returns False if it can't
+           be watched, in which case the caller should fall back to
+           checking for itself."""
+        self.lock.acquire()
+        try:
+            if self.add_tree(root):
+                self.roots[key] = (root, callback)
+                return True
+            self.prune()
+            return False
+        finally:
+            self.lock.release()
+
+    def unwatch(self, key):
+        self.lock.acquire()
+        try:
+            if key in self.roots:
+                del self.roots[key]
+                self.prune()
+        finally:
+            self.lock.release()
+
+    def is_watching(self, key):
+        return key in self.roots
+
+    def keys(self):
+        return self.roots.keys()
+
+    def covered(self, path):
+        # Called with the lock held
+        for root, callback in self.roots.values():
+            if path == root or path.startswith(root + os.path.sep):
+                return True
+        return False
+
+    def dispatch(self, action, path):
+        # Called without the lock, so that callbacks may unwatch
+        for root, callback in self.roots.values():
+            if path == root or path.startswith(root + os.path.sep):
+                try:
+                    callback(action, path)
+                except Exception:
+                    logger.exception('Error handling %s of %s' %
+                                     (action, path))
+
+    def start(self):
+        t = threading.Thread(target=self.run, name='fswatch')
+        t.setDaemon(True)
+        t.start()
+
+class InotifyWatcher(Watcher):
+
+    def __init__(self):
+        Watcher.__init__(self)
+        name = ctypes.util.find_library('c')
+        if not name:
+            raise OSError('libc not found')
+        self.libc = ctypes.CDLL(name)
+        if not hasattr(self.libc, 'inotify_init'):
+            raise OSError('inotify not supported')
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError('inotify_init failed')
+        self.wds = {}       # watch descriptor -> directory
+        self.dirs = {}      # directory -> watch descriptor
+        self.start()
+
+    def add_tree(self, path):
+        # Called with the lock held
+        if path in self.dirs:
+            return True
+        wd = self.libc.inotify_add_watch(self.fd, path, IN_MASK)
+        if wd < 0:
+            logger.warning('Unable to watch %s -- check '
+                           '/proc/sys/fs/inotify/max_user_watches' % path)
+            return False
+        self.wds[wd] = path
+        self.dirs[path] = wd
+        try:
+            names = listdir(path)
+        except OSError:
+            return True
+        for name in names:
+            f = os.path.join(path, name)
+            if isdir(f) and not self.add_tree(f):
+                return False
+        return True
+
+    def remove_tree(self, path):
+        # Called with the lock held
+        prefix = path + os.path.sep
+        for d, wd in self.dirs.items():
+            if d == path or d.startswith(prefix):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[d]
+                del self.wds[wd]
+
+    def prune(self):
+        # Called with the lock held
+        for d, wd in self.dirs.items():
+            if not self.covered(d):
+                self.libc.inotify_rm_watch(self.fd, wd)
+                del self.dirs[d]
+                del self.wds[wd]
+
+    def run(self):
+        while True:
+            try:
+                buf = os.read(self.fd, 0x10000)
+            except OSError, msg:
+                if msg.errno == errno.EINTR:
+                    continue
+                logger.error('inotify read failed -- %s' % msg)
+                return
+            pos = 0
+            while pos + EVENT_SIZE <= len(buf):
+                wd, mask, cookie, length = struct.unpack_from(EVENT_HEADER,
+                                                              buf, pos)
+                pos += EVENT_SIZE
+                name = buf[pos:pos + length].rstrip('\0')
+                pos += length
+                self.handle(wd, mask, name)
+
+    def handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            logger.warning('inotify queue overflow')
+            for root, callback in self.roots.values():
+                self.dispatch('reset', root)
+            return
+
+        action = None
+        self.lock.acquire()
+        try:
+            directory = self.wds.get(wd)
+            if directory is None:
+                return
+            if mask & IN_IGNORED:
+                del self.wds[wd]
+                del self.dirs[directory]
+                return
+            if mask & (IN_DELETE_SELF | IN_MOVE_SELF):
+                # Subdirectories are handled via their parents
+                for root, callback in self.roots.values():
+                    if directory == root:
+                        action, path = 'reset', directory
+                        break
+            elif name and not name.startswith('.'):
+                path = os.path.join(directory, name)
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    if mask & IN_ISDIR:
+                        self.add_tree(path)
+                    action = 'create'
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    if mask & IN_ISDIR:
+                        self.remove_tree(path)
+                    action = 'delete'
+                elif mask & IN_CLOSE_WRITE:
+                    action = 'change'
+        finally:
+            self.lock.release()
+
+        if action:
+            self.dispatch(action, path)
+
+class PollWatcher(Watcher):
+
+    def __init__(self):
+        Watcher.__init__(self)
+        self.dirs = {}      # directory -> (mtime, names, subdirectories)
+        self.start()
+
+    def add_tree(self, path):
+        # Called with the lock held
+        if path in self.dirs:
+            return True
+        try:
+            mtime = os.stat(unicode(path, 'utf-8')).st_mtime
+            names = set(listdir(path))
+        except OSError:
+            return False
+        subdirs = set()
+        for name in names:
+            f = os.path.join(path, name)
+            if isdir(f):
+                subdirs.add(name)
+                self.add_tree(f)
+        self.dirs[path] = (mtime, names, subdirs)
+        return True
+
+    def remove_tree(self, path):
+        # Called with the lock held
+        prefix = path + os.path.sep
+        for d in self.dirs.keys():
+            if d == path or d.startswith(prefix):
+                del self.dirs[d]
+
+    def prune(self):
+        # Called with the lock held
+        for d in self.dirs.keys():
+            if not self.covered(d):
+                del self.dirs[d]
+
+    def run(self):
+        while True:
+            time.sleep(POLL_INTERVAL)
+            for action, path in self.poll():
+                self.dispatch(action, path)
+
+    def poll(self):
+        """Check every known directory's mtime, and list the ones that
+           have changed. Only the directories are stat'ed, so changes to
+           the contents of existing files aren't reported."""
+        events = []
+        self.lock.acquire()
+        try:
+            for path in sorted(self.dirs):
+                if path not in self.dirs:
+                    continue
+                mtime, names, subdirs = self.dirs[path]
+                try:
+                    new_mtime = os.stat(unicode(path, 'utf-8')).st_mtime
+                    if new_mtime == mtime:
+                        continue
+                    new_names = set(listdir(path))
+                except OSError:
+                    continue    # The parent will notice
+                for name in names - new_names:
+                    f = os.path.join(path, name)
+                    if name in subdirs:
+                        self.remove_tree(f)
+                    events.append(('delete', f))
+                new_subdirs = subdirs & new_names
+                for name in new_names - names:
+                    f = os.path.join(path, name)
+                    if isdir(f):
+                        new_subdirs.add(name)
+                        self.add_tree(f)
+                    events.append(('create', f))
+                self.dirs[path] = (new_mtime, new_names, new_subdirs)
+        finally:
+            self.lock.release()
+        return events
+
+watchers = {}
+watchers_lock = threading.Lock()
+
+def get_watcher():
+    """Return the watcher selected by the "fswatch" setting, or None if
+       watching is off (or unavailable)."""
+    opt = config.get_server('fswatch', 'auto').lower()
+    if opt in ['false', 'no', 'off']:
+        return None
+
+    watchers_lock.acquire()
+    try:
+        if opt not in watchers:
+            watcher = None
+            if opt in ['auto', 'inotify']:
+                try:
+                    watcher = InotifyWatcher()
+                except (OSError, AttributeError), msg:
+                    if opt == 'inotify':
+                        logger.error('Unable to use inotify -- %s' % msg)
+                    else:
+                        logger.debug('No inotify (%s), polling instead' %
+                                     msg)
+                        watcher = PollWatcher()
+            elif opt == 'poll':
+                watcher = PollWatcher()
+            else:
+                logger.error('Bad fswatch setting: %s' % opt)
+            watchers[opt] = watcher
+        return watchers[opt]
+    finally:
+        watchers_lock.release()
@@ -5,7 +5,6 @@ import gzip
 import logging
 import mimetypes
 import os
-import shutil
 import socket
 import time
 from cStringIO import StringIO
@@ -13,8 +12,10 @@ from email.utils import formatdate
 from urllib import unquote_plus, quote
 from xml.sax.saxutils import escape
 
-from Cheetah.Template import Template
 import config
+import scanner
+import tmplcache
+import zerocopy
 from plugin import GetPlugin, EncodeUnicode
 
 SCRIPTDIR = os.path.dirname(__file__)
@@ -70,6 +71,7 @@ class TivoHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
         self.containers.clear()
         for section, settings in config.getShares():
             self.add_container(section, settings)
+        scanner.rescan()
 
     def handle_error(self, request, client_address):
         self.logger.exception('Exception during request from %s' % 
@@ -227,7 +229,7 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
 
         # Send the body of the file
         try:
-            shutil.copyfileobj(handle, self.wfile)
+            zerocopy.sendfile(self.wfile, handle)
         except:
             pass
         handle.close()
@@ -313,9 +315,9 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
                     tsncontainers.append((section, settings))
             except Exception, msg:
                 self.server.logger.error(section + ' - ' + str(msg))
-        t = Template(file=os.path.join(SCRIPTDIR, 'templates',
-                                       'root_container.tmpl'),
-                     filter=EncodeUnicode)
+        t = tmplcache.get(os.path.join(SCRIPTDIR, 'templates',
+                                       'root_container.tmpl'))(
+                          filter=EncodeUnicode)
         if self.server.beacon.bd:
             t.renamed = self.server.beacon.bd.renamed
         else:
@@ -329,13 +331,13 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
     def infopage(self):
         useragent = self.headers.getheader('User-Agent', '')
         if useragent.lower().find('mobile') > 0:
-            t = Template(file=os.path.join(SCRIPTDIR, 'templates',
-                                       'info_page_mob.tmpl'),
-                     filter=EncodeUnicode)
+            t = tmplcache.get(os.path.join(SCRIPTDIR, 'templates',
+                                           'info_page_mob.tmpl'))(
+                              filter=EncodeUnicode)
         else:
-            t = Template(file=os.path.join(SCRIPTDIR, 'templates',
-                                       'info_page.tmpl'),
-                     filter=EncodeUnicode)
+            t = tmplcache.get(os.path.join(SCRIPTDIR, 'templates',
+                                           'info_page.tmpl'))(
+                              filter=EncodeUnicode)
         t.admin = ''
 
         if config.get_server('tivo_mak') and config.get_server('togo_path'):
@@ -354,7 +356,10 @@ class TivoHTTPHandler(BaseHTTPServer.BaseHTTPRequestHandler):
             if plugin_type == 'settings':
                 t.admin += ('<a href="/TiVoConnect?Command=Settings&amp;' +
                             'Container=' + quote(section) +
-                            '">Settings</a><br>')
+                            '">Settings</a><br>' +
+                            '<a href="/TiVoConnect?Command=Status&amp;' +
+                            'Container=' + quote(section) +
+                            '">Status</a><br>')
             elif plugin_type == 'togo' and t.togo:
                 for tsn in config.tivos:
                     if tsn:
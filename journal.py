@@ -0,0 +1,54 @@
+"""Small pickled state files kept under cache_dir, such as the Push and
+ToGo queues, so that work in progress survives a restart.
+
+A journal is rewritten in full each time: to a temporary file, which is
+then renamed into place, so a crash can't leave half of one behind. If
+cache_dir isn't set, nothing is kept, and load() always returns the
+default.
+"""
+
+import cPickle
+import logging
+import os
+import tempfile
+
+import config
+
+logger = logging.getLogger('pyTivo.journal')
+
+def path(name):
+    cache_dir = config.get_cache_dir()
+    if cache_dir:
+        return os.path.join(cache_dir, name + '.pkl')
+    return None
+
+def load(name, default=None):
+    fname = path(name)
+    if not fname or not os.path.exists(fname):
+        return default
+    try:
+        f = open(fname, 'rb')
+        try:
+            return cPickle.load(f)
+        finally:
+            f.close()
+    except Exception, msg:
+        logger.error('Unable to read %s -- %s' % (fname, msg))
+        return default
+
+def save(name, data):
+    fname = path(name)
+    if not fname:
+        return
+    try:
+        fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname))
+        f = os.fdopen(fd, 'wb')
+        try:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            f.close()
+        if os.path.exists(fname):
+            os.remove(fname)    # For Windows
+        os.rename(tmpname, fname)
+    except (IOError, OSError, cPickle.PicklingError), msg:
+        logger.error('Unable to write %s -- %s' % (fname, msg))
@@ -39,10 +39,10 @@ discarded. [1]_
 """
 
 from __future__ import generators
+import threading
 import time
-from heapq import heappush, heappop, heapify
 
-__version__ = "0.2"
+__version__ = "0.3"
 __all__ = ['CacheKeyError', 'LRUCache', 'DEFAULT_SIZE']
 __docformat__ = 'reStructuredText en'
 
@@ -95,108 +95,202 @@ class LRUCache(object):
 
     for j in cache:   # iterate (in LRU order)
         print j, cache[j] # iterator produces keys, not values
+
+    The cache can also be bounded by the total size of its contents, by
+    passing maxbytes; each object's size is found with the sizeof
+    function, len() by default. An object larger than maxbytes is not
+    kept at all. The hits, misses and evictions attributes count what
+    the cache has been doing (lookups, not "in" tests)::
+
+    cache = LRUCache(1000, maxbytes=16 << 20)
+    cache['foo'] = 'x' * 1024
+
+    print cache.bytes # 1024
     """
 
     class __Node(object):
         """Record of a cached value. Not for public consumption."""
 
-        def __init__(self, key, obj, timestamp):
-            object.__init__(self)
+        __slots__ = ['key', 'obj', 'atime', 'mtime', 'nbytes', 'prev', 'next']
+
+        def __init__(self, key, obj, timestamp, nbytes=0):
             self.key = key
             self.obj = obj
             self.atime = timestamp
             self.mtime = self.atime
-
-        def __cmp__(self, other):
-            return cmp(self.atime, other.atime)
+            self.nbytes = nbytes
+            self.prev = self.next = None
 
         def __repr__(self):
             return "<%s %s => %s (%s)>" % \
                    (self.__class__, self.key, self.obj, \
                     time.asctime(time.localtime(self.atime)))
 
-    def __init__(self, size=DEFAULT_SIZE):
+    def __init__(self, size=DEFAULT_SIZE, maxbytes=None, sizeof=len):
         # Check arguments
         if size <= 0:
             raise ValueError, size
         elif type(size) is not type(0):
             raise TypeError, size
         object.__init__(self)
-        self.__heap = []
+        self.__lock = threading.Lock()
         self.__dict = {}
-        self.size = size
-        """Maximum size of the cache.
-        If more than 'size' elements are added to the cache,
-        the least-recently-used ones will be discarded."""
+        # The nodes form a circular list through this sentinel, least
+        # recently used first.
+        self.__head = self.__Node(None, None, 0)
+        self.__head.prev = self.__head.next = self.__head
+        self.__size = size
+        self.__maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __unlink(self, node):
+        node.prev.next = node.next
+        node.next.prev = node.prev
+
+    def __append(self, node):
+        node.prev = self.__head.prev
+        node.next = self.__head
+        node.prev.next = node
+        self.__head.prev = node
+
+    def __shrink(self):
+        while self.__dict and (len(self.__dict) > self.__size or
+                               (self.__maxbytes is not None and
+                                self.bytes > self.__maxbytes)):
+            lru = self.__head.next
+            self.__unlink(lru)
+            del self.__dict[lru.key]
+            self.bytes -= lru.nbytes
+            self.evictions += 1
 
     def __len__(self):
-        return len(self.__heap)
+        return len(self.__dict)
 
     def __contains__(self, key):
         return self.__dict.has_key(key)
 
     def __setitem__(self, key, obj):
-        if self.__dict.has_key(key):
-            node = self.__dict[key]
-            node.obj = obj
-            node.atime = time.time()
-            node.mtime = node.atime
-            heapify(self.__heap)
-        else:
-            # size may have been reset, so we loop
-            while len(self.__heap) >= self.size:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
-            node = self.__Node(key, obj, time.time())
-            self.__dict[key] = node
-            heappush(self.__heap, node)
+        nbytes = 0
+        if self.__maxbytes is not None:
+            nbytes = self.sizeof(obj)
+        self.__lock.acquire()
+        try:
+            node = self.__dict.get(key)
+            if self.__maxbytes is not None and nbytes > self.__maxbytes:
+                # Too big to keep, and not worth flushing everything else
+                if node:
+                    self.__unlink(node)
+                    del self.__dict[key]
+                    self.bytes -= node.nbytes
+                return
+            if node:
+                self.__unlink(node)
+                self.bytes -= node.nbytes
+                node.obj = obj
+                node.atime = time.time()
+                node.mtime = node.atime
+                node.nbytes = nbytes
+            else:
+                node = self.__Node(key, obj, time.time(), nbytes)
+                self.__dict[key] = node
+            self.__append(node)
+            self.bytes += nbytes
+            self.__shrink()
+        finally:
+            self.__lock.release()
 
     def __getitem__(self, key):
-        if not self.__dict.has_key(key):
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
+        self.__lock.acquire()
+        try:
+            node = self.__dict.get(key)
+            if not node:
+                self.misses += 1
+                raise CacheKeyError(key)
             node.atime = time.time()
-            heapify(self.__heap)
+            self.__unlink(node)
+            self.__append(node)
+            self.hits += 1
             return node.obj
+        finally:
+            self.__lock.release()
 
     def __delitem__(self, key):
-        if not self.__dict.has_key(key):
-            raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            del self.__dict[key]
-            self.__heap.remove(node)
-            heapify(self.__heap)
+        self.__lock.acquire()
+        try:
+            node = self.__dict.pop(key, None)
+            if not node:
+                raise CacheKeyError(key)
+            self.__unlink(node)
+            self.bytes -= node.nbytes
             return node.obj
+        finally:
+            self.__lock.release()
 
     def __iter__(self):
-        copy = self.__heap[:]
-        while len(copy) > 0:
-            node = heappop(copy)
-            yield node.key
-        raise StopIteration
-
-    def __setattr__(self, name, value):
-        object.__setattr__(self, name, value)
-        # automagically shrink heap on resize
-        if name == 'size':
-            while len(self.__heap) > value:
-                lru = heappop(self.__heap)
-                del self.__dict[lru.key]
+        self.__lock.acquire()
+        try:
+            keys = []
+            node = self.__head.next
+            while node is not self.__head:
+                keys.append(node.key)
+                node = node.next
+        finally:
+            self.__lock.release()
+        return iter(keys)
+
+    def __get_size(self):
+        return self.__size
+
+    def __set_size(self, value):
+        # automagically shrink on resize
+        self.__lock.acquire()
+        try:
+            self.__size = value
+            self.__shrink()
+        finally:
+            self.__lock.release()
+
+    size = property(__get_size, __set_size, doc=
+        """Maximum size of the cache.
+        If more than 'size' elements are added to the cache,
+        the least-recently-used ones will be discarded.""")
+
+    def __get_maxbytes(self):
+        return self.__maxbytes
+
+    def __set_maxbytes(self, value):
+        self.__lock.acquire()
+        try:
+            self.__maxbytes = value
+            self.__shrink()
+        finally:
+            self.__lock.release()
+
+    maxbytes = property(__get_maxbytes, __set_maxbytes, doc=
+        """Maximum total size of the cached objects, or None.""")
 
     def __repr__(self):
-        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
+        return "<%s (%d elements)>" % (str(self.__class__), len(self.__dict))
 
     def mtime(self, key):
         """Return the last modification time for the cache record with key.
         May be useful for cache instances where the stored values can get
         'stale', such as caching file or network resource contents."""
-        if not self.__dict.has_key(key):
+        node = self.__dict.get(key)
+        if not node:
             raise CacheKeyError(key)
-        else:
-            node = self.__dict[key]
-            return node.mtime
+        return node.mtime
+
+    def stats(self):
+        """Return a dictionary of usage counts, for status reports."""
+        return {'entries': len(self.__dict), 'size': self.__size,
+                'bytes': self.bytes, 'maxbytes': self.__maxbytes,
+                'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions}
 
 if __name__ == "__main__":
     cache = LRUCache(25)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+
+"""Compare lrucache.LRUCache with the heap-based version it replaced.
+
+    usage: lrucache_bench.py [count ...]
+
+For each cache size (by default 1k, 10k and 100k entries), this fills a
+cache, then times hits, replacements of existing keys and inserts that
+evict. The old class re-heapifies on every hit, so it gets fewer
+iterations at the larger sizes; times are per operation.
+"""
+
+import random
+import sys
+import time
+from heapq import heappush, heappop, heapify
+
+from lrucache import LRUCache, CacheKeyError, DEFAULT_SIZE
+
+class HeapLRUCache(object):
+    """lrucache.LRUCache 0.2, for comparison."""
+
+    class __Node(object):
+        """Record of a cached value."""
+
+        def __init__(self, key, obj, timestamp):
+            object.__init__(self)
+            self.key = key
+            self.obj = obj
+            self.atime = timestamp
+            self.mtime = self.atime
+
+        def __cmp__(self, other):
+            return cmp(self.atime, other.atime)
+
+        def __repr__(self):
+            return "<%s %s => %s (%s)>" % \
+                   (self.__class__, self.key, self.obj, \
+                    time.asctime(time.localtime(self.atime)))
+
+    def __init__(self, size=DEFAULT_SIZE):
+        # Check arguments
+        if size <= 0:
+            raise ValueError, size
+        elif type(size) is not type(0):
+            raise TypeError, size
+        object.__init__(self)
+        self.__heap = []
+        self.__dict = {}
+        self.size = size
+        """Maximum size of the cache.
+        If more than 'size' elements are added to the cache,
+        the least-recently-used ones will be discarded."""
+
+    def __len__(self):
+        return len(self.__heap)
+
+    def __contains__(self, key):
+        return self.__dict.has_key(key)
+
+    def __setitem__(self, key, obj):
+        if self.__dict.has_key(key):
+            node = self.__dict[key]
+            node.obj = obj
+            node.atime = time.time()
+            node.mtime = node.atime
+            heapify(self.__heap)
+        else:
+            # size may have been reset, so we loop
+            while len(self.__heap) >= self.size:
+                lru = heappop(self.__heap)
+                del self.__dict[lru.key]
+            node = self.__Node(key, obj, time.time())
+            self.__dict[key] = node
+            heappush(self.__heap, node)
+
+    def __getitem__(self, key):
+        if not self.__dict.has_key(key):
+            raise CacheKeyError(key)
+        else:
+            node = self.__dict[key]
+            node.atime = time.time()
+            heapify(self.__heap)
+            return node.obj
+
+    def __delitem__(self, key):
+        if not self.__dict.has_key(key):
+            raise CacheKeyError(key)
+        else:
+            node = self.__dict[key]
+            del self.__dict[key]
+            self.__heap.remove(node)
+            heapify(self.__heap)
+            return node.obj
+
+    def __iter__(self):
+        copy = self.__heap[:]
+        while len(copy) > 0:
+            node = heappop(copy)
+            yield node.key
+        raise StopIteration
+
+    def __setattr__(self, name, value):
+        object.__setattr__(self, name, value)
+        # automagically shrink heap on resize
+        if name == 'size':
+            while len(self.__heap) > value:
+                lru = heappop(self.__heap)
+                del self.__dict[lru.key]
+
+    def __repr__(self):
+        return "<%s (%d elements)>" % (str(self.__class__), len(self.__heap))
+
+    def mtime(self, key):
+        """Return the last modification time for the cache record with key.
+        May be useful for cache instances where the stored values can get
+        'stale', such as caching file or network resource contents."""
+        if not self.__dict.has_key(key):
+            raise CacheKeyError(key)
+        else:
+            node = self.__dict[key]
+            return node.mtime
+
+def bench(cls, count, ops):
+    cache = cls(count)
+    for i in xrange(count):
+        cache[i] = i
+    keys = [random.randrange(count) for i in xrange(ops)]
+
+    results = []
+    start = time.time()
+    for key in keys:
+        cache[key]
+    results.append(time.time() - start)
+
+    start = time.time()
+    for key in keys:
+        cache[key] = key
+    results.append(time.time() - start)
+
+    start = time.time()
+    for i in xrange(count, count + ops):
+        cache[i] = i
+    results.append(time.time() - start)
+
+    return [t * 1e6 / ops for t in results]
+
+def main(argv):
+    counts = [int(x) for x in argv] or [1000, 10000, 100000]
+    print '%-14s %8s %10s %10s %10s' % ('class', 'entries', 'hit us',
+                                       'update us', 'evict us')
+    for count in counts:
+        for cls, ops in ((HeapLRUCache, max(20, 200000 / count)),
+                         (LRUCache, 100000)):
+            hit, update, evict = bench(cls, count, ops)
+            print '%-14s %8d %10.2f %10.2f %10.2f' % (cls.__name__, count,
+                                                      hit, update, evict)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
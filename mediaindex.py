@@ -0,0 +1,134 @@
+"""Persistent index of per-file results, such as ffmpeg probes.
+
+Entries are keyed by path, and are only returned while the file's size
+and mtime still match the values recorded with them. The index lives in
+an SQLite database under the "cache_dir" setting; if that isn't set (or
+sqlite3 isn't available), every lookup misses and every store is a
+no-op, so callers never need to check -- unless they're counting on a
+later store to be there, for which there's available().
+"""
+
+import cPickle
+import logging
+import os
+import threading
+
+try:
+    import sqlite3
+except ImportError:
+    sqlite3 = None
+
+import config
+
+logger = logging.getLogger('pyTivo.mediaindex')
+
+SCHEMA = """CREATE TABLE IF NOT EXISTS entries (
+            path TEXT PRIMARY KEY, size INTEGER, mtime REAL, data BLOB)"""
+
+class MediaIndex(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.db = None
+        self.db_path = None
+
+    def _connect(self):
+        # Called with the lock held. The cache_dir setting can change on
+        # a soft reset, so the database is (re)opened as needed.
+        path = config.get_cache_dir()
+        if path:
+            path = os.path.join(path, self.name + '.db')
+        if path != self.db_path:
+            if self.db:
+                self.db.close()
+            self.db = None
+            self.db_path = path
+            if path and sqlite3:
+                try:
+                    self.db = sqlite3.connect(path, check_same_thread=False)
+                    self.db.text_factory = str
+                    self.db.execute('PRAGMA synchronous = NORMAL')
+                    self.db.execute(SCHEMA)
+                    self.db.commit()
+                    logger.debug('Opened %s' % path)
+                except sqlite3.Error, msg:
+                    logger.error('Unable to open %s -- %s' % (path, msg))
+                    self.db = None
+        return self.db
+
+    def available(self):
+        """True if the index can be opened, so that what's stored now
+           can be looked up later."""
+        self.lock.acquire()
+        try:
+            return bool(self._connect())
+        finally:
+            self.lock.release()
+
+    def get(self, path, size, mtime):
+        """Return the stored result for path, or None if there is none,
+           or if the file has changed since it was stored."""
+        self.lock.acquire()
+        try:
+            db = self._connect()
+            if not db:
+                return None
+            try:
+                row = db.execute('SELECT size, mtime, data FROM entries '
+                                 'WHERE path = ?', (path,)).fetchone()
+            except sqlite3.Error, msg:
+                logger.error('%s lookup failed -- %s' % (self.name, msg))
+                return None
+        finally:
+            self.lock.release()
+
+        if not row or row[0] != size or row[1] != mtime:
+            return None
+        try:
+            return cPickle.loads(str(row[2]))
+        except Exception, msg:
+            logger.error('%s: bad entry for %s -- %s' % (self.name, path, msg))
+            return None
+
+    def put(self, path, size, mtime, data):
+        self.lock.acquire()
+        try:
+            db = self._connect()
+            if not db:
+                return
+            blob = sqlite3.Binary(cPickle.dumps(data, 2))
+            try:
+                db.execute('INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?)',
+                           (path, size, mtime, blob))
+                db.commit()
+            except sqlite3.Error, msg:
+                logger.error('%s store failed -- %s' % (self.name, msg))
+        finally:
+            self.lock.release()
+
+    def remove(self, path):
+        self.lock.acquire()
+        try:
+            db = self._connect()
+            if db:
+                try:
+                    db.execute('DELETE FROM entries WHERE path = ?', (path,))
+                    db.commit()
+                except sqlite3.Error, msg:
+                    logger.error('%s delete failed -- %s' % (self.name, msg))
+        finally:
+            self.lock.release()
+
+    def __len__(self):
+        self.lock.acquire()
+        try:
+            db = self._connect()
+            if not db:
+                return 0
+            try:
+                return db.execute('SELECT COUNT(*) FROM entries').fetchone()[0]
+            except sqlite3.Error:
+                return 0
+        finally:
+            self.lock.release()
@@ -4,6 +4,7 @@ import logging
 import os
 import subprocess
 import sys
+import time
 from datetime import datetime
 from xml.dom import minidom
 from xml.parsers import expat
@@ -13,9 +14,10 @@ except:
     pass
 
 import mutagen
-from lrucache import LRUCache
+from lrucache import LRUCache, CacheKeyError
 
 import config
+import tivoxml
 import plugins.video.transcode
 
 # Something to strip
@@ -54,6 +56,9 @@ mp4_cache = LRUCache(50)
 dvrms_cache = LRUCache(50)
 nfo_cache = LRUCache(50)
 
+SIDECAR_CHECK = 5   # Seconds a directory listing or text file is trusted
+RACY_MTIME = 2      # Coarsest directory mtime resolution allowed for
+
 mswindows = (sys.platform == "win32")
 
 def get_mpaa(rating):
@@ -91,15 +96,6 @@ def tag_data(element, tag):
         return ''
     return element.firstChild.data
 
-def _vtag_data(element, tag):
-    for name in tag.split('/'):
-        new_element = element.getElementsByTagName(name)
-        if not new_element:
-            return []
-        element = new_element[0]
-    elements = element.getElementsByTagName('element')
-    return [x.firstChild.data for x in elements if x.firstChild]
-
 def _vtag_data_alternate(element, tag):
     elements = [element]
     for name in tag.split('/'):
@@ -109,12 +105,6 @@ def _vtag_data_alternate(element, tag):
         elements = new_elements
     return [x.firstChild.data for x in elements if x.firstChild]
 
-def _tag_value(element, tag):
-    item = element.getElementsByTagName(tag)
-    if item:
-        value = item[0].attributes['value'].value
-        return int(value[0])
-
 def from_moov(full_path):
     if full_path in mp4_cache:
         return mp4_cache[full_path]
@@ -287,12 +277,107 @@ def from_eyetv(full_path):
             metadata['movieYear'] = eyetv['info']['start'].year
     return metadata
 
+def _parse_text(metafile):
+    metadata = {}
+    sep = ':='[metafile.endswith('.properties')]
+    for line in file(metafile, 'U'):
+        if line.startswith(BOM):
+            line = line[3:]
+        if line.strip().startswith('#') or not sep in line:
+            continue
+        key, value = [x.strip() for x in line.split(sep, 1)]
+        if not key or not value:
+            continue
+        if key.startswith('v'):
+            if key in metadata:
+                metadata[key].append(value)
+            else:
+                metadata[key] = [value]
+        else:
+            metadata[key] = value
+    return metadata
+
+class SidecarIndex(object):
+    """Which of the text files from_text() looks for exist, and what's
+    in them.
+
+    Rather than stat each possible file on every call, this keeps the
+    listing of every directory it's asked about -- so a missing file is
+    just a set lookup -- and the parsed contents of every file found.
+    A listing is checked against its directory's mtime, and a file's
+    contents against its mtime and size, but at most once every
+    SIDECAR_CHECK seconds. A listing read within RACY_MTIME seconds of
+    its directory's mtime is read again at the next check regardless,
+    since on filesystems with coarse mtimes a file added in the same
+    tick wouldn't change it.
+    """
+
+    def __init__(self):
+        self.dirs = LRUCache(1000)      # path -> (checked, mtime, listed,
+                                        #          names)
+        self.files = LRUCache(1000)     # path -> (checked, stat, metadata)
+
+    def fold(self, name):
+        # Filesystems here are usually case-insensitive
+        if mswindows or sys.platform == 'darwin':
+            return name.lower()
+        return name
+
+    def exists(self, path, name):
+        now = time.time()
+        try:
+            checked, mtime, listed, names = self.dirs[path]
+        except CacheKeyError:
+            checked = None
+        if checked is None or now - checked >= SIDECAR_CHECK:
+            try:
+                new_mtime = os.stat(path).st_mtime
+            except OSError:
+                new_mtime = None
+            if (checked is None or new_mtime != mtime or
+                (mtime is not None and listed - mtime < RACY_MTIME)):
+                listed = now
+                names = set()
+                if new_mtime is not None:
+                    try:
+                        names = set([self.fold(x) for x in os.listdir(path)])
+                    except OSError:
+                        pass
+            self.dirs[path] = (now, new_mtime, listed, names)
+        return self.fold(name) in names
+
+    def read(self, metafile):
+        """The parsed contents of metafile. Not to be modified."""
+        now = time.time()
+        try:
+            checked, stat, metadata = self.files[metafile]
+        except CacheKeyError:
+            checked = None
+        if checked is None or now - checked >= SIDECAR_CHECK:
+            try:
+                st = os.stat(metafile)
+                new_stat = (st.st_mtime, st.st_size)
+            except OSError:
+                new_stat = None
+            if checked is None or new_stat != stat:
+                metadata = {}
+                if new_stat:
+                    try:
+                        metadata = _parse_text(metafile)
+                    except (IOError, OSError):
+                        pass
+            self.files[metafile] = (now, new_stat, metadata)
+        return metadata
+
+sidecars = SidecarIndex()
+
 def from_text(full_path):
     metadata = {}
     full_path = unicode(full_path, 'utf-8')
     path, name = os.path.split(full_path)
     title, ext = os.path.splitext(name)
 
+    # (directory, file name), in the order they're applied
     search_paths = []
     ptmp = full_path
     while ptmp:
@@ -301,31 +386,22 @@ def from_text(full_path):
             ptmp = parent
         else:
             break
-        search_paths.append(os.path.join(ptmp, 'default.txt'))
+        search_paths.append((ptmp, 'default.txt'))
 
-    search_paths.append(os.path.join(path, title) + '.properties')
+    search_paths.append((path, title + '.properties'))
     search_paths.reverse()
 
-    search_paths += [full_path + '.txt',
-                     os.path.join(path, '.meta', 'default.txt'),
-                     os.path.join(path, '.meta', name) + '.txt']
-
-    for metafile in search_paths:
-        if os.path.exists(metafile):
-            sep = ':='[metafile.endswith('.properties')]
-            for line in file(metafile, 'U'):
-                if line.startswith(BOM):
-                    line = line[3:]
-                if line.strip().startswith('#') or not sep in line:
-                    continue
-                key, value = [x.strip() for x in line.split(sep, 1)]
-                if not key or not value:
-                    continue
+    meta_dir = os.path.join(path, '.meta')
+    search_paths += [(path, name + '.txt'),
+                     (meta_dir, 'default.txt'),
+                     (meta_dir, name + '.txt')]
+
+    for dirname, fname in search_paths:
+        if sidecars.exists(dirname, fname):
+            data = sidecars.read(os.path.join(dirname, fname))
+            for key, value in data.items():
                 if key.startswith('v'):
-                    if key in metadata:
-                        metadata[key].append(value)
-                    else:
-                        metadata[key] = [value]
+                    metadata[key] = metadata.get(key, []) + value
                 else:
                     metadata[key] = value
 
@@ -366,7 +442,8 @@ def basic(full_path):
 
     return metadata
 
-def from_container(xmldoc):
+def from_container(item):
+    """item is one of the Item dicts from tivoxml.parse_container()."""
     metadata = {}
 
     keys = {'title': 'Title', 'episodeTitle': 'EpisodeTitle',
@@ -376,10 +453,8 @@ def from_container(xmldoc):
             'callsign': 'SourceStation', 'showingBits': 'ShowingBits',
             'mpaaRating': 'MpaaRating'}
 
-    details = xmldoc.getElementsByTagName('Details')[0]
-
     for key in keys:
-        data = tag_data(details, keys[key])
+        data = item.get('Details/' + keys[key])
         if data:
             if key == 'description':
                 data = data.replace(TRIBUNE_CR, '')
@@ -395,9 +470,7 @@ def from_container(xmldoc):
 def from_details(xml):
     metadata = {}
 
-    xmldoc = minidom.parse(xml)
-    showing = xmldoc.getElementsByTagName('showing')[0]
-    program = showing.getElementsByTagName('program')[0]
+    fields, vitems, values = tivoxml.parse_details(xml)
 
     items = {'description': 'program/description',
              'title': 'program/title',
@@ -414,7 +487,7 @@ def from_details(xml):
              'time': 'time'}
 
     for item in items:
-        data = tag_data(showing, items[item])
+        data = fields.get(items[item])
         if data:
             if item == 'description':
                 data = data.replace(TRIBUNE_CR, '')
@@ -425,23 +498,19 @@ def from_details(xml):
               'vHost', 'vProducer', 'vWriter']
 
     for item in vItems:
-        data = _vtag_data(program, item)
+        data = vitems.get(item)
         if data:
             metadata[item] = data
 
-    sb = showing.getElementsByTagName('showingBits')
-    if sb:
-        metadata['showingBits'] = sb[0].attributes['value'].value
+    if 'showingBits' in values:
+        metadata['showingBits'] = values['showingBits']
 
     #for tag in ['starRating', 'mpaaRating', 'colorCode']:
-    for tag in ['starRating', 'mpaaRating']:
-        value = _tag_value(program, tag)
-        if value:
-            metadata[tag] = value
-
-    rating = _tag_value(showing, 'tvRating')
-    if rating:
-        metadata['tvRating'] = rating
+    for tag in ['starRating', 'mpaaRating', 'tvRating']:
+        if values.get(tag):
+            value = int(values[tag][0])
+            if value:
+                metadata[tag] = value
 
     return metadata
 
@@ -1,31 +1,104 @@
 import cookielib
+import httplib
 import logging
+import socket
 import sys
+import threading
 import time
 import urllib2
 import urllib
 import warnings
 import xml.etree.ElementTree as ElementTree
+from StringIO import StringIO
 
 import config
 import metadata
 
+# Sessions, by (username, mind server), with the password they used
+minds = {}
+minds_lock = threading.Lock()
+
+class KeepAliveHTTPSHandler(urllib2.HTTPSHandler):
+    """Like HTTPSHandler, but keeps one connection open per host and
+       reuses it for the following requests, instead of connecting (and
+       negotiating SSL) every time. Each response is read in full, so
+       the connection is free again by the time it's returned."""
+
+    def __init__(self):
+        urllib2.HTTPSHandler.__init__(self)
+        self.conns = {}
+
+    def https_open(self, req):
+        return self.do_open(httplib.HTTPSConnection, req)
+
+    def do_open(self, http_class, req):
+        host = req.get_host()
+        if not host:
+            raise urllib2.URLError('no host given')
+
+        headers = dict(req.headers)
+        headers.update(req.unredirected_hdrs)
+        headers['Connection'] = 'keep-alive'
+
+        while True:
+            conn = self.conns.get(host)
+            reused = conn is not None
+            if not reused:
+                conn = http_class(host)
+                self.conns[host] = conn
+            try:
+                conn.request(req.get_method(), req.get_selector(),
+                             req.data, headers)
+                r = conn.getresponse()
+                data = r.read()
+                break
+            except (socket.error, httplib.HTTPException), msg:
+                conn.close()
+                del self.conns[host]
+                if not reused:
+                    raise urllib2.URLError(msg)
+                # The server closed the idle connection -- try a new one
+
+        if r.will_close:
+            conn.close()
+            del self.conns[host]
+
+        resp = urllib.addinfourl(StringIO(data), r.msg, req.get_full_url())
+        resp.code = r.status
+        resp.msg = r.reason
+        return resp
+
 class Mind:
+    """A session with the Mind server. Sessions are shared (see
+       getMind()), so every request goes through one lock. The login
+       happens on the first request, and again whenever the server
+       says the session has expired."""
+
     def __init__(self, username, password, tsn):
         self.__logger = logging.getLogger('pyTivo.mind')
         self.__username = username
         self.__password = password
         self.__mind = config.get_mind(tsn)
+        self.__lock = threading.RLock()
+        self.__logged_in = False
+        self.__pc_body_id = None
 
         cj = cookielib.CookieJar()
         cp = urllib2.HTTPCookieProcessor(cj)
-        self.__opener = urllib2.build_opener(cp)
-
-        self.__login()
+        self.__opener = urllib2.build_opener(cp, KeepAliveHTTPSHandler())
 
     def pushVideo(self, tsn, url, description, duration, size,
                   title, subtitle, source='', mime='video/mpeg',
                   tvrating=None):
+        self.__lock.acquire()
+        try:
+            self.__pushVideo(tsn, url, description, duration, size,
+                             title, subtitle, source, mime, tvrating)
+        finally:
+            self.__lock.release()
+
+    def __pushVideo(self, tsn, url, description, duration, size,
+                    title, subtitle, source, mime, tvrating):
         # It looks like tivo only supports one pc per house
         pc_body_id = self.__pcBodySearch()
 
@@ -61,6 +134,13 @@ class Mind:
         self.__subscribe(offer_id, content_id, tsn)
 
     def getDownloadRequests(self):
+        self.__lock.acquire()
+        try:
+            return self.__getDownloadRequests()
+        finally:
+            self.__lock.release()
+
+    def __getDownloadRequests(self):
         NEEDED_VALUES = [
             'bodyId',
             'bodyOfferId',
@@ -94,6 +174,13 @@ class Mind:
         return requests
 
     def completeDownloadRequest(self, request, status, mime='video/mpeg'):
+        self.__lock.acquire()
+        try:
+            self.__completeDownloadRequest(request, status, mime)
+        finally:
+            self.__lock.release()
+
+    def __completeDownloadRequest(self, request, status, mime):
         if status:
             mtypes = {'video/mp4': 'avcL41MP4', 'video/bif': 'vc1ApL3'}
             request['encodingType'] = mtypes.get(mime, 'mpeg2ProgramStream')
@@ -111,10 +198,14 @@ class Mind:
             self.__subscribe(offer_id, content_id, request['bodyId'][4:])
 
     def getXMPPLoginInfo(self):
-        # It looks like tivo only supports one pc per house
-        pc_body_id = self.__pcBodySearch()
+        self.__lock.acquire()
+        try:
+            # It looks like tivo only supports one pc per house
+            pc_body_id = self.__pcBodySearch()
 
-        xml = self.__bodyXmppInfoGet(pc_body_id)
+            xml = self.__bodyXmppInfoGet(pc_body_id)
+        finally:
+            self.__lock.release()
 
         results = {
             'server': xml.findtext('server'),
@@ -143,24 +234,42 @@ class Mind:
         )
         try:
             result = self.__opener.open(r)
+            result.read()
         except:
             pass
 
+        self.__logged_in = True
         self.__logger.debug('__login\n%s' % (data))
 
     def __dict_request(self, data, req):
-        r = urllib2.Request(
-            'https://%s/mind/mind7?type=%s' % (self.__mind, req),
-            dictcode(data),
-            {'Content-Type': 'x-tivo/dict-binary'}
-        )
-        result = self.__opener.open(r)
-
-        xml = ElementTree.parse(result).find('.')
-
-        self.__logger.debug('%s\n%s\n\n%sg' % (req, data,
-                            ElementTree.tostring(xml)))
-        return xml
+        if not self.__logged_in:
+            self.__login()
+
+        for retry in (True, False):
+            r = urllib2.Request(
+                'https://%s/mind/mind7?type=%s' % (self.__mind, req),
+                dictcode(data),
+                {'Content-Type': 'x-tivo/dict-binary'}
+            )
+            try:
+                result = self.__opener.open(r)
+            except urllib2.HTTPError, msg:
+                if retry and msg.code in (401, 403):
+                    self.__login()
+                    continue
+                raise
+
+            xml = ElementTree.parse(result).find('.')
+
+            self.__logger.debug('%s\n%s\n\n%sg' % (req, data,
+                                ElementTree.tostring(xml)))
+
+            if (retry and xml.tag == 'error' and
+                'auth' in (xml.findtext('code') or '').lower()):
+                # The session has expired
+                self.__login()
+                continue
+            return xml
 
     def __bodyOfferModify(self, data):
         """Create an offer"""
@@ -200,12 +309,16 @@ class Mind:
     def __pcBodySearch(self):
         """Find PCS"""
 
+        if self.__pc_body_id:
+            return self.__pc_body_id
+
         xml = self.__dict_request({}, 'pcBodySearch')
         id = xml.findtext('.//pcBodyId')
         if not id:
             xml = self.__pcBodyStore('pyTivo', True)
             id = xml.findtext('.//pcBodyId')
 
+        self.__pc_body_id = id
         return id
 
     def __collectionIdSearch(self, url):
@@ -284,4 +397,12 @@ def getMind(tsn=None):
     if not username or not password:
         raise Exception("tivo_username and tivo_password required")
 
-    return Mind(username, password, tsn)
+    key = (username, config.get_mind(tsn))
+    minds_lock.acquire()
+    try:
+        if key not in minds or minds[key][0] != password:
+            minds[key] = (password, Mind(username, password, tsn))
+        m = minds[key][1]
+    finally:
+        minds_lock.release()
+    return m
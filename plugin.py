@@ -4,9 +4,10 @@ import shutil
 import sys
 import threading
 import time
-import unicodedata
 import urllib
 
+import dirscan
+import fswatch
 from Cheetah.Filters import Filter
 from lrucache import LRUCache
 
@@ -17,6 +18,8 @@ else:
     quote = lambda x: urllib.quote(x.replace(os.path.sep, '/'))
     unquote = lambda x: os.path.normpath(urllib.unquote_plus(x))
 
+SETTLE = 5      # Seconds a new file must go unchanged before it's listed
+
 class Error:
     CONTENT_TYPE = 'text/html'
 
@@ -86,10 +89,13 @@ class Plugin(object):
             path = os.path.join(path, folder)
         return path
 
-    def item_count(self, handler, query, cname, files, last_start=0):
+    def item_count(self, handler, query, cname, files, last_start=0,
+                   positions=None):
         """Return only the desired portion of the list, as specified by 
            ItemCount, AnchorItem and AnchorOffset. 'files' is either a 
            list of strings, OR a list of objects with a 'name' attribute.
+           'positions', if given, maps each name to its index in files.
+           The list returned is always a new one.
         """
         def no_anchor(handler, anchor):
             handler.server.logger.warning('Anchor not found: ' + anchor)
@@ -112,20 +118,27 @@ class Plugin(object):
                 if not '://' in anchor:
                     anchor = os.path.normpath(anchor)
 
-                if type(files[0]) == str:
-                    filenames = files
-                else:
-                    filenames = [x.name for x in files]
-                try:
-                    index = filenames.index(anchor, last_start)
-                except ValueError:
-                    if last_start:
-                        try:
-                            index = filenames.index(anchor, 0, last_start)
-                        except ValueError:
-                            no_anchor(handler, anchor)
+                if positions is not None:
+                    if anchor in positions:
+                        index = positions[anchor]
                     else:
                         no_anchor(handler, anchor) # just use index = 0
+                else:
+                    if type(files[0]) == str:
+                        filenames = files
+                    else:
+                        filenames = [x.name for x in files]
+                    try:
+                        index = filenames.index(anchor, last_start)
+                    except ValueError:
+                        if last_start:
+                            try:
+                                index = filenames.index(anchor, 0,
+                                                        last_start)
+                            except ValueError:
+                                no_anchor(handler, anchor)
+                        else:
+                            no_anchor(handler, anchor) # just use index = 0
 
                 if count > 0:
                     index += 1
@@ -137,18 +150,16 @@ class Plugin(object):
                 index = (index + count) % len(files)
                 count = -count
             files = files[index:index + count]
+        else:
+            files = files[:]
 
         return files, totalFiles, index
 
-    def get_files(self, handler, query, filterFunction=None, force_alpha=False):
+    def positions(self, files):
+        """A dict of the index of each name in files, for item_count()."""
+        return dict((f.name, i) for i, f in enumerate(files))
 
-        class FileData:
-            def __init__(self, name, isdir):
-                self.name = name
-                self.isdir = isdir
-                st = os.stat(unicode(name, 'utf-8'))
-                self.mdate = int(st.st_mtime)
-                self.size = st.st_size
+    def get_files(self, handler, query, filterFunction=None, force_alpha=False):
 
         class SortList:
             def __init__(self, files):
@@ -156,27 +167,105 @@ class Plugin(object):
                 self.unsorted = True
                 self.sortby = None
                 self.last_start = 0
-
-        def build_recursive_list(path, recurse=True):
-            files = []
-            path = unicode(path, 'utf-8')
+                self.lock = threading.Lock()
+                self.watched = False
+                self.stale = False
+                self.names = {}
+                self.pending = set()    # New files, not yet filtered
+                self.positions = None
+
+        def keep(name, isdir):
+            return filterFunction(name, file_type)
+
+        if not filterFunction:
+            keep = None
+
+        def watch_event(filelist, action, name):
+            # Keep a watched recursive list in step with the filesystem.
+            # New files are only noted here; the filter, which may probe
+            # them, runs in add_pending(), once they've settled.
+            filelist.lock.acquire()
             try:
-                for f in os.listdir(path):
-                    if f.startswith('.'):
-                        continue
-                    f = os.path.join(path, f)
-                    isdir = os.path.isdir(f)
-                    if sys.platform == 'darwin':
-                        f = unicodedata.normalize('NFC', f)
-                    f = f.encode('utf-8')
-                    if recurse and isdir:
-                        files.extend(build_recursive_list(f))
+                if action == 'reset':
+                    filelist.stale = True
+                    watcher.unwatch((rc, path))
+                elif action == 'create':
+                    if name in filelist.names:
+                        return
+                    try:
+                        if fswatch.isdir(name):
+                            new = [f.name for f in dirscan.scan(name, True)]
+                        else:
+                            new = [name]
+                    except OSError:
+                        return
+                    for f in new:
+                        if f not in filelist.names:
+                            filelist.pending.add(f)
+                elif action == 'delete':
+                    prefix = name + os.path.sep
+                    files = []
+                    for f in filelist.files:
+                        if f.name == name or f.name.startswith(prefix):
+                            del filelist.names[f.name]
+                        else:
+                            files.append(f)
+                    filelist.files = files
+                    for f in list(filelist.pending):
+                        if f == name or f.startswith(prefix):
+                            filelist.pending.discard(f)
+                elif action == 'change':
+                    f = filelist.names.get(name)
+                    if f:
+                        try:
+                            st = os.stat(unicode(name, 'utf-8'))
+                        except OSError:
+                            return
+                        f.mdate = int(st.st_mtime)
+                        f.size = st.st_size
                     else:
-                       if not filterFunction or filterFunction(f, file_type):
-                           files.append(FileData(f, isdir))
-            except:
-                pass
-            return files
+                        # Perhaps turned away while it was being written
+                        filelist.pending.add(name)
+                filelist.unsorted = True
+            finally:
+                filelist.lock.release()
+
+        def add_pending(filelist):
+            # Filter the files the watcher has found, once they've gone
+            # SETTLE seconds without changing. The filter runs outside
+            # the lock, so a slow probe doesn't hold up the watcher or
+            # other listings.
+            now = time.time()
+            ready = []
+            filelist.lock.acquire()
+            try:
+                for name in list(filelist.pending):
+                    try:
+                        mtime = os.stat(unicode(name, 'utf-8')).st_mtime
+                    except OSError:
+                        filelist.pending.discard(name)
+                        continue
+                    if mtime + SETTLE <= now:
+                        ready.append(name)
+            finally:
+                filelist.lock.release()
+
+            accepted = set(name for name in ready
+                           if not keep or keep(name, False))
+
+            filelist.lock.acquire()
+            try:
+                for name in ready:
+                    if name not in filelist.pending:
+                        continue    # Deleted meanwhile
+                    filelist.pending.discard(name)
+                    if name in accepted and name not in filelist.names:
+                        f = dirscan.Entry(name, False)
+                        filelist.names[f.name] = f
+                        filelist.files.append(f)
+                        filelist.unsorted = True
+            finally:
+                filelist.lock.release()
 
         subcname = query['Container'][0]
         path = self.get_local_path(handler, query)
@@ -188,22 +277,49 @@ class Plugin(object):
         filelist = []
         rc = self.recurse_cache
         dc = self.dir_cache
+        watcher = fswatch.get_watcher()
         if recurse:
-            if path in rc and rc.mtime(path) + 300 >= time.time():
+            # A watched list is kept current, so the age limit only
+            # applies when there's no watcher.
+            if path in rc:
                 filelist = rc[path]
+                if filelist.stale or (not filelist.watched and
+                                      rc.mtime(path) + 300 < time.time()):
+                    filelist = []
         else:
             updated = os.stat(unicode(path, 'utf-8'))[8]
             if path in dc and dc.mtime(path) >= updated:
                 filelist = dc[path]
             for p in rc:
-                if path.startswith(p) and rc.mtime(p) < updated:
+                if (path.startswith(p) and rc.mtime(p) < updated and
+                    not (watcher and watcher.is_watching((rc, p)))):
                     del rc[p]
 
         if not filelist:
-            filelist = SortList(build_recursive_list(path, recurse))
+            if recurse and watcher:
+                # Start watching before the walk, so nothing is missed;
+                # events that arrive meanwhile wait on the lock.
+                filelist = SortList([])
+                filelist.lock.acquire()
+                try:
+                    filelist.watched = watcher.watch((rc, path), path,
+                        lambda action, name, fl=filelist:
+                            watch_event(fl, action, name))
+                    filelist.files = dirscan.scan(path, True, keep)
+                    if filelist.watched:
+                        for f in filelist.files:
+                            filelist.names[f.name] = f
+                finally:
+                    filelist.lock.release()
+            else:
+                filelist = SortList(dirscan.scan(path, recurse, keep))
 
             if recurse:
                 rc[path] = filelist
+                if watcher:
+                    for key in watcher.keys():
+                        if key[0] is rc and key[1] not in rc:
+                            watcher.unwatch(key)
             else:
                 dc[path] = filelist
 
@@ -219,23 +335,31 @@ class Plugin(object):
         def date_sort(x, y):
             return cmp(y.mdate, x.mdate)
 
+        if filelist.pending:
+            add_pending(filelist)
+
         sortby = query.get('SortOrder', ['Normal'])[0]
-        if filelist.unsorted or filelist.sortby != sortby:
-            if force_alpha:
-                filelist.files.sort(dir_sort)
-            elif sortby == '!CaptureDate':
-                filelist.files.sort(date_sort)
-            else:
-                filelist.files.sort(name_sort)
+        filelist.lock.acquire()
+        try:
+            if filelist.unsorted or filelist.sortby != sortby:
+                if force_alpha:
+                    filelist.files.sort(dir_sort)
+                elif sortby == '!CaptureDate':
+                    filelist.files.sort(date_sort)
+                else:
+                    filelist.files.sort(name_sort)
 
-            filelist.sortby = sortby
-            filelist.unsorted = False
+                filelist.sortby = sortby
+                filelist.unsorted = False
+                filelist.positions = self.positions(filelist.files)
 
-        files = filelist.files[:]
+            # Trim the list
+            files, total, start = self.item_count(handler, query,
+                handler.cname, filelist.files, filelist.last_start,
+                filelist.positions)
+            if len(files) > 1:
+                filelist.last_start = start
+        finally:
+            filelist.lock.release()
 
-        # Trim the list
-        files, total, start = self.item_count(handler, query, handler.cname,
-                                              files, filelist.last_start)
-        if len(files) > 1:
-            filelist.last_start = start
         return files, total, start
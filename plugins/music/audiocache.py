@@ -0,0 +1,417 @@
+"""Cache of music transcoded to MP3, with an index of where each moment
+of it starts, so that repeat plays -- and the seeks the TiVo makes when
+scrubbing -- are sent as plain byte ranges, instead of FFmpeg decoding
+the file from the start again for every request.
+
+The first request for a file starts a "fill": one FFmpeg run over the
+whole file, written under cache_dir/music as it goes. Requests for any
+part of it the fill has already reached are sent from the file as it
+grows; others are transcoded live, as before. The fill runs as a batch
+job, so it never holds up a live transcode -- including the one for
+the request that started it. The index -- the offset
+of the first frame at or after every STEP milliseconds -- is built from
+the MP3 frame headers on the way through, and saved alongside when the
+fill is done.
+
+A fill that stops well short of the song's length (if it's known) is
+thrown away rather than cached.
+
+Entries are keyed by (path, mtime, size). They're kept up to the
+"music_cache_disk" budget, after which the least recently played are
+removed; with no budget, or no cache_dir, nothing is cached.
+"""
+
+import cPickle
+import logging
+import os
+import subprocess
+import tempfile
+import threading
+from hashlib import md5
+
+import config
+import scheduler
+import zerocopy
+from lrucache import LRUCache, CacheKeyError
+from procrun import kill
+
+logger = logging.getLogger('pyTivo.music.audiocache')
+
+DEFAULT_DISK = '0'
+STEP = 100              # Milliseconds between index entries
+BLOCKSIZE = 64 * 1024
+MIN_COVER = 95          # Percent of the known length a fill must reach
+
+# Layer III bitrates (kbps) by bitrate index, and sample rates by
+# sample rate index, for MPEG 1 and MPEG 2 / 2.5
+BITRATES = {1: (0, 32, 40, 48, 56, 64, 80, 96, 112, 128, 160, 192, 224,
+                256, 320),
+            2: (0, 8, 16, 24, 32, 40, 48, 56, 64, 80, 96, 112, 128,
+                144, 160)}
+RATES = {3: (44100, 48000, 32000),      # MPEG 1
+         2: (22050, 24000, 16000),      # MPEG 2
+         0: (11025, 12000, 8000)}       # MPEG 2.5
+
+def frame_info(header):
+    """The length in bytes, samples and sample rate of the Layer III
+       frame starting with header (four bytes), or None if it isn't
+       one."""
+    b1, b2 = ord(header[1]), ord(header[2])
+    if header[0] != '\xff' or b1 & 0xe0 != 0xe0:
+        return None
+    version = (b1 >> 3) & 3
+    if version == 1 or (b1 >> 1) & 3 != 1:
+        return None
+    try:
+        rate = RATES[version][(b2 >> 2) & 3]
+        bitrate = BITRATES[version == 3 and 1 or 2][b2 >> 4] * 1000
+    except IndexError:
+        return None
+    if not bitrate:
+        return None
+    padding = (b2 >> 1) & 1
+    if version == 3:
+        return 144 * bitrate / rate + padding, 1152, rate
+    return 72 * bitrate / rate + padding, 576, rate
+
+def lookup(index, ms):
+    """The offset to start from for ms milliseconds in, or None if the
+       index doesn't reach that far. The start is always offset 0, so
+       the ID3 tag goes with it."""
+    if ms <= 0:
+        return 0
+    step = int(ms) / STEP
+    if step < len(index):
+        return index[step]
+    return None
+
+class MP3Indexer(object):
+    """Builds the index of an MP3 stream from blocks fed to it in
+       order."""
+
+    def __init__(self):
+        self.index = []
+        self.samples = 0        # Start of the next frame, in samples
+        self.pos = 0            # Offset of the start of buf
+        self.buf = ''
+        self.skip = 0           # Bytes still to pass over
+
+    def feed(self, data):
+        buf = self.buf + data
+        i = 0
+        while True:
+            if self.skip:
+                n = min(self.skip, len(buf) - i)
+                i += n
+                self.skip -= n
+                if self.skip:
+                    break
+            if len(buf) - i < 10:
+                break
+            if self.pos + i == 0 and buf[:3] == 'ID3':
+                size = 0
+                for c in buf[6:10]:
+                    size = (size << 7) | (ord(c) & 0x7f)
+                self.skip = size + 10
+                continue
+            info = frame_info(buf[i:i + 4])
+            if not info:
+                i += 1          # Look for the next frame
+                continue
+            length, samples, rate = info
+            while len(self.index) * STEP * rate <= self.samples * 1000:
+                self.index.append(self.pos + i)
+            self.samples += samples
+            self.skip = length
+        self.pos += i
+        self.buf = buf[i:]
+
+class Cached(object):
+    """A finished entry."""
+
+    def __init__(self, fname, index, size):
+        self.fname = fname
+        self.index = index
+        self.size = size
+
+    def span(self, seek, duration):
+        """The (offset, length) to send for seek and duration, in
+           milliseconds (no limit if duration is 0)."""
+        start = lookup(self.index, seek)
+        if start is None:
+            start = self.size
+        end = self.size
+        if duration:
+            end = lookup(self.index, seek + duration)
+            if end is None:
+                end = self.size
+        return start, max(end - start, 0)
+
+    def send(self, wfile, offset, count):
+        f = open(self.fname, 'rb')
+        try:
+            zerocopy.sendfile(wfile, f, offset, count)
+        finally:
+            f.close()
+
+class Fill(object):
+    """An entry being written."""
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.cond = threading.Condition()
+        self.indexer = MP3Indexer()
+        self.size = 0
+        self.done = False
+
+    def reached(self, seek):
+        self.cond.acquire()
+        try:
+            return lookup(self.indexer.index, seek) is not None
+        finally:
+            self.cond.release()
+
+    def blocks(self, seek, duration):
+        """The data for seek and duration, as the fill reaches it."""
+        f = open(self.fname, 'rb')
+        try:
+            pos = None
+            end = None
+            while True:
+                self.cond.acquire()
+                try:
+                    while True:
+                        index = self.indexer.index
+                        if pos is None:
+                            pos = lookup(index, seek)
+                        if end is None and duration:
+                            end = lookup(index, seek + duration)
+                        if end is None and self.done:
+                            end = self.size
+                        limit = self.size
+                        if end is not None:
+                            limit = min(end, limit)
+                        if pos < limit or self.done:
+                            break
+                        self.cond.wait()
+                finally:
+                    self.cond.release()
+                if pos >= limit:
+                    return
+                f.seek(pos)
+                block = f.read(min(BLOCKSIZE, limit - pos))
+                if not block:
+                    return
+                pos += len(block)
+                yield block
+        finally:
+            f.close()
+
+class AudioCache(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.fills = {}                 # Base name -> Fill
+        self.indexes = LRUCache(20)     # Base name -> Cached
+        self.disk_path = None
+        self.disk_bytes = 0
+
+    def get(self, path, cmd, seek=0, length=0):
+        """The cached transcode of path (a UTF-8 string) -- a Cached, or
+           a Fill if it's still being written -- if it reaches seek
+           milliseconds in; otherwise None. If there's none, a fill is
+           started, running cmd (an FFmpeg command line writing the
+           whole file as MP3 to stdout). length is the song's duration
+           in milliseconds, if known."""
+        if not config.get_server_size('music_cache_disk', DEFAULT_DISK):
+            return None
+        base = self.base_name(path)
+        if not base:
+            return None
+
+        self.lock.acquire()
+        try:
+            fill = self.fills.get(base)
+            if not fill:
+                cached = self.load(base)
+                if cached:
+                    return cached
+                fill = Fill(base + '.part')
+                try:
+                    out = open(fill.fname, 'wb')
+                except IOError, msg:
+                    logger.error('Unable to write %s -- %s' %
+                                 (fill.fname, msg))
+                    return None
+                self.fills[base] = fill
+                t = threading.Thread(target=self.fill, name='music fill',
+                                     args=(base, fill, out, list(cmd),
+                                           os.path.basename(path), length))
+                t.setDaemon(True)
+                t.start()
+        finally:
+            self.lock.release()
+
+        if fill.reached(seek):
+            return fill
+        return None
+
+    def base_name(self, path):
+        cache_path = self.check_disk()
+        if not cache_path:
+            return None
+        try:
+            st = os.stat(unicode(path, 'utf-8'))
+        except OSError:
+            return None
+        key = (path, st.st_mtime, st.st_size)
+        return os.path.join(cache_path, md5(repr(key)).hexdigest())
+
+    def load(self, base):
+        # Called with the lock held
+        try:
+            cached = self.indexes[base]
+        except CacheKeyError:
+            try:
+                f = open(base + '.idx', 'rb')
+                index = cPickle.load(f)
+                f.close()
+                size = os.path.getsize(base + '.mp3')
+            except (IOError, OSError, EOFError, cPickle.UnpicklingError):
+                return None
+            cached = self.indexes[base] = Cached(base + '.mp3', index, size)
+        try:
+            os.utime(cached.fname, None)    # For the trimming order
+        except OSError:
+            del self.indexes[base]
+            return None
+        return cached
+
+    def fill(self, base, fill, out, cmd, desc, length):
+        ok = False
+        ffmpeg = None
+        job = scheduler.acquire('batch', desc)
+        preexec = scheduler.preexec('batch')
+        try:
+            try:
+                ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
+                                          stdout=subprocess.PIPE,
+                                          preexec_fn=preexec)
+                while True:
+                    block = ffmpeg.stdout.read(BLOCKSIZE)
+                    if not block:
+                        break
+                    out.write(block)
+                    out.flush()
+                    fill.cond.acquire()
+                    try:
+                        fill.indexer.feed(block)
+                        fill.size += len(block)
+                        fill.cond.notifyAll()
+                    finally:
+                        fill.cond.release()
+                ok = ffmpeg.wait() == 0 and fill.size > 0
+                reached = len(fill.indexer.index) * STEP
+                if ok and reached * 100 < length * MIN_COVER:
+                    logger.error('Not caching %s -- only %d of %d ms' %
+                                 (desc, reached, length))
+                    ok = False
+            except (IOError, OSError), msg:
+                logger.error('Unable to cache %s -- %s' % (desc, msg))
+                if ffmpeg and ffmpeg.poll() is None:
+                    kill(ffmpeg)
+        finally:
+            scheduler.release(job)
+            out.close()
+            fill.cond.acquire()
+            fill.done = True
+            fill.cond.notifyAll()
+            fill.cond.release()
+
+        if ok:
+            try:
+                fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(base))
+                f = os.fdopen(fd, 'wb')
+                cPickle.dump(fill.indexer.index, f, 2)
+                f.close()
+                if os.path.exists(base + '.idx'):
+                    os.remove(base + '.idx')
+                os.rename(tmpname, base + '.idx')
+                if os.path.exists(base + '.mp3'):
+                    os.remove(base + '.mp3')
+                os.rename(fill.fname, base + '.mp3')
+            except (IOError, OSError), msg:
+                logger.error('Unable to save %s -- %s' % (base, msg))
+                ok = False
+
+        self.lock.acquire()
+        try:
+            del self.fills[base]
+            if ok:
+                self.disk_bytes += fill.size + os.path.getsize(base + '.idx')
+                limit = config.get_server_size('music_cache_disk',
+                                               DEFAULT_DISK)
+                if self.disk_bytes > limit:
+                    self.trim(limit * 9 / 10)
+            else:
+                try:
+                    os.remove(fill.fname)
+                except OSError:
+                    pass
+        finally:
+            self.lock.release()
+
+    def check_disk(self):
+        """Return the cache directory, totting up what's already there
+           (and clearing out any unfinished fills) whenever it
+           changes."""
+        path = config.get_cache_dir('music')
+        self.lock.acquire()
+        try:
+            if path != self.disk_path:
+                self.disk_path = path
+                self.disk_bytes = 0
+                if path:
+                    for name in os.listdir(path):
+                        fname = os.path.join(path, name)
+                        try:
+                            if name.endswith('.part'):
+                                if fname[:-5] not in self.fills:
+                                    os.remove(fname)
+                            else:
+                                self.disk_bytes += os.path.getsize(fname)
+                        except OSError:
+                            pass
+        finally:
+            self.lock.release()
+        return path
+
+    def trim(self, target):
+        # Called with the lock held
+        entries = []
+        total = 0
+        for name in os.listdir(self.disk_path):
+            if not name.endswith('.mp3'):
+                continue
+            base = os.path.join(self.disk_path, name[:-4])
+            try:
+                st = os.stat(base + '.mp3')
+                size = st.st_size + os.path.getsize(base + '.idx')
+            except OSError:
+                continue
+            entries.append((st.st_mtime, size, base))
+            total += size
+        entries.sort()
+        for mtime, size, base in entries:
+            if total <= target:
+                break
+            try:
+                os.remove(base + '.mp3')
+                os.remove(base + '.idx')
+                total -= size
+            except OSError:
+                pass
+            if base in self.indexes:
+                del self.indexes[base]
+        self.disk_bytes = total
+        logger.debug('Trimmed music cache to %d bytes' % total)
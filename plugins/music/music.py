@@ -2,23 +2,28 @@ import cgi
 import os
 import random
 import re
-import shutil
 import socket
 import subprocess
 import sys
 import time
-import unicodedata
 import urllib
 from xml.sax.saxutils import escape
 
 import mutagen
 from mutagen.easyid3 import EasyID3
 from mutagen.mp3 import MP3
-from Cheetah.Template import Template
 from lrucache import LRUCache
 import config
+import dirscan
+import mediaindex
+import procrun
+import scanner
+import scheduler
+import tmplcache
+import zerocopy
 from plugin import EncodeUnicode, Plugin, quote, unquote
-from plugins.video.transcode import kill
+from plugins.music import audiocache
+from procrun import kill
 
 SCRIPTDIR = os.path.dirname(__file__)
 
@@ -49,13 +54,10 @@ plslength = re.compile('[Ll]ength(\d+)=(\d+)').match
 # Duration -- parse from ffmpeg output
 durre = re.compile(r'.*Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+),').search
 
-# Preload the templates
-tfname = os.path.join(SCRIPTDIR, 'templates', 'container.tmpl')
-tpname = os.path.join(SCRIPTDIR, 'templates', 'm3u.tmpl')
-iname = os.path.join(SCRIPTDIR, 'templates', 'item.tmpl')
-FOLDER_TEMPLATE = file(tfname, 'rb').read()
-PLAYLIST_TEMPLATE = file(tpname, 'rb').read()
-ITEM_TEMPLATE = file(iname, 'rb').read()
+# The templates, compiled on first use
+FOLDER_TEMPLATE = os.path.join(SCRIPTDIR, 'templates', 'container.tmpl')
+PLAYLIST_TEMPLATE = os.path.join(SCRIPTDIR, 'templates', 'm3u.tmpl')
+ITEM_TEMPLATE = os.path.join(SCRIPTDIR, 'templates', 'item.tmpl')
 
 # XXX BIG HACK
 # subprocess is broken for me on windows so super hack
@@ -80,6 +82,98 @@ class FileData:
         self.title = ''
         self.duration = 0
 
+tag_index = mediaindex.MediaIndex('music_tags')
+
+def read_tags(fname):
+    """Read the tags and duration of an audio file (a UTF-8 string) with
+       mutagen, or the duration with ffmpeg if mutagen can't find it."""
+    tags = {}
+    ext = os.path.splitext(fname)[1].lower()
+    fname = unicode(fname, 'utf-8')
+
+    try:
+        # If the file is an mp3, let's load the EasyID3 interface
+        if ext == '.mp3':
+            audioFile = MP3(fname, ID3=EasyID3)
+        else:
+            # Otherwise, let mutagen figure it out
+            audioFile = mutagen.File(fname)
+
+        if audioFile:
+            # Pull the length from the FileType, if present
+            if audioFile.info.length > 0:
+                tags['Duration'] = int(audioFile.info.length * 1000)
+
+            # Grab our other tags, if present
+            def get_tag(tagname, d):
+                for tag in ([tagname] + TAGNAMES[tagname]):
+                    try:
+                        if tag in d:
+                            value = d[tag][0]
+                            if type(value) not in [str, unicode]:
+                                value = str(value)
+                            return value
+                    except:
+                        pass
+                return ''
+
+            artist = get_tag('artist', audioFile)
+            title = get_tag('title', audioFile)
+            if artist == 'Various Artists' and '/' in title:
+                artist, title = [x.strip() for x in title.split('/')]
+            tags['ArtistName'] = artist
+            tags['SongTitle'] = title
+            tags['AlbumTitle'] = get_tag('album', audioFile)
+            tags['AlbumYear'] = get_tag('date', audioFile)[:4]
+            tags['MusicGenre'] = get_tag('genre', audioFile)
+    except Exception, msg:
+        print msg
+
+    ffmpeg_path = config.get_bin('ffmpeg')
+    if 'Duration' not in tags and ffmpeg_path:
+        if mswindows:
+            fname = fname.encode('iso8859-1')
+        cmd = [ffmpeg_path, '-i', fname]
+        job = scheduler.acquire('probe', os.path.basename(fname))
+        result = None
+        try:
+            if job:
+                # wait 10 sec if ffmpeg is not back give up
+                result = procrun.run(cmd, 10, scheduler.preexec('probe'))
+        finally:
+            scheduler.release(job)
+
+        if result and not result.timed_out:
+            d = durre(result.stderr)
+            if d:
+                millisecs = ((int(d.group(1)) * 3600 +
+                              int(d.group(2)) * 60 +
+                              int(d.group(3))) * 1000 +
+                             int(d.group(4)) *
+                             (10 ** (3 - len(d.group(4)))))
+            else:
+                millisecs = 0
+            tags['Duration'] = millisecs
+
+    return tags
+
+def file_tags(fname, parse=True):
+    """The tags of an audio file, from the tag index if it's there and
+       the file hasn't changed; otherwise read from the file and added
+       to the index -- or, if parse is False and there is an index to
+       add them to later, None."""
+    try:
+        st = os.stat(unicode(fname, 'utf-8'))
+    except OSError:
+        return {}
+    tags = tag_index.get(fname, st.st_size, st.st_mtime)
+    if tags is None and (parse or not tag_index.available()):
+        tags = read_tags(fname)
+        # Leave it out if ffmpeg was too busy to find the duration
+        if 'Duration' in tags or not config.get_bin('ffmpeg'):
+            tag_index.put(fname, st.st_size, st.st_mtime, tags)
+    return tags
+
 class Music(Plugin):
 
     CONTENT_TYPE = 'x-container/tivo-music'
@@ -89,6 +183,7 @@ class Music(Plugin):
     PLAYLIST = 'play'
 
     media_data_cache = LRUCache(300)
+    audio_cache = audiocache.AudioCache()   # transcoded streams
     recurse_cache = LRUCache(5)
     dir_cache = LRUCache(10)
 
@@ -102,16 +197,6 @@ class Music(Plugin):
         ext = os.path.splitext(fname)[1].lower()
         needs_transcode = ext in TRANSCODE or seek or duration or always
 
-        if not needs_transcode:
-            fsize = os.path.getsize(fname)
-            handler.send_response(200)
-            handler.send_header('Content-Length', fsize)
-        else:
-            handler.send_response(206)
-            handler.send_header('Transfer-Encoding', 'chunked')
-        handler.send_header('Content-Type', 'audio/mpeg')
-        handler.end_headers()
-
         if needs_transcode:
             if mswindows:
                 fname = fname.encode('iso8859-1')
@@ -121,31 +206,86 @@ class Music(Plugin):
                 cmd += ['-acodec', 'copy']
             else:
                 cmd += ['-ab', '320k', '-ar', '44100']
-            cmd += ['-f', 'mp3', '-']
-            if seek:
-                cmd[-1:] = ['-ss', '%.3f' % (seek / 1000.0), '-']
-            if duration:
-                cmd[-1:] = ['-t', '%.3f' % (duration / 1000.0), '-']
+            cmd += ['-f', 'mp3']
+
+        # Whole transcodes are cached, and sent from there when they
+        # reach the point asked for. The fill always covers the whole
+        # file, whatever this request's Seek and Duration.
+        cached = None
+        if ext in TRANSCODE and config.get_bin('ffmpeg'):
+            if path in self.media_data_cache:
+                length = self.media_data_cache[path].get('Duration', 0)
+            elif tag_index.available():
+                length = (file_tags(path, False) or {}).get('Duration', 0)
+            else:
+                length = 0      # Not worth reading the tags for
+            cached = self.audio_cache.get(path, cmd + ['-'], seek, length)
 
-            ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
-                                      stdout=subprocess.PIPE)
-            while True:
-                try:
-                    block = ffmpeg.stdout.read(BLOCKSIZE)
+        if isinstance(cached, audiocache.Cached):
+            offset, count = cached.span(seek, duration)
+            handler.send_response(206)
+            handler.send_header('Content-Length', count)
+        elif not needs_transcode:
+            fsize = os.path.getsize(fname)
+            handler.send_response(200)
+            handler.send_header('Content-Length', fsize)
+        else:
+            handler.send_response(206)
+            handler.send_header('Transfer-Encoding', 'chunked')
+        handler.send_header('Content-Type', 'audio/mpeg')
+        handler.end_headers()
+
+        if isinstance(cached, audiocache.Cached):
+            try:
+                cached.send(handler.wfile, offset, count)
+            except Exception, msg:
+                handler.server.logger.info(msg)
+        elif cached:
+            try:
+                for block in cached.blocks(seek, duration):
                     handler.wfile.write('%x\r\n' % len(block))
                     handler.wfile.write(block)
                     handler.wfile.write('\r\n')
+                handler.wfile.write('0\r\n\r\n')
+            except Exception, msg:
+                handler.server.logger.info(msg)
+        elif needs_transcode:
+            if seek:
+                cmd += ['-ss', '%.3f' % (seek / 1000.0)]
+            if duration:
+                cmd += ['-t', '%.3f' % (duration / 1000.0)]
+            cmd.append('-')
+
+            job = scheduler.acquire('live', os.path.basename(path))
+            if not job:
+                # Too busy; end the stream rather than keep it waiting
+                try:
+                    handler.wfile.write('0\r\n\r\n')
                 except Exception, msg:
                     handler.server.logger.info(msg)
-                    kill(ffmpeg)
-                    break
+                return
+            try:
+                ffmpeg = subprocess.Popen(cmd, bufsize=BLOCKSIZE,
+                                          stdout=subprocess.PIPE)
+                while True:
+                    try:
+                        block = ffmpeg.stdout.read(BLOCKSIZE)
+                        handler.wfile.write('%x\r\n' % len(block))
+                        handler.wfile.write(block)
+                        handler.wfile.write('\r\n')
+                    except Exception, msg:
+                        handler.server.logger.info(msg)
+                        kill(ffmpeg)
+                        break
 
-                if not block:
-                    break
+                    if not block:
+                        break
+            finally:
+                scheduler.release(job)
         else:
             f = open(fname, 'rb')
             try:
-                shutil.copyfileobj(f, handler.wfile)
+                zerocopy.sendfile(handler.wfile, f)
             except:
                 pass
             f.close()
@@ -174,113 +314,6 @@ class Music(Plugin):
 
                 return file_type
 
-        def media_data(f):
-            if f.name in self.media_data_cache:
-                return self.media_data_cache[f.name]
-
-            item = {}
-            item['path'] = f.name
-            item['part_path'] = f.name.replace(local_base_path, '', 1)
-            item['name'] = os.path.basename(f.name)
-            item['is_dir'] = f.isdir
-            item['is_playlist'] = f.isplay
-            item['params'] = 'No'
-
-            if f.title:
-                item['Title'] = f.title
-
-            if f.duration > 0:
-                item['Duration'] = f.duration
-
-            if f.isdir or f.isplay or '://' in f.name:
-                self.media_data_cache[f.name] = item
-                return item
-
-            # If the format is: (track #) Song name...
-            #artist, album, track = f.name.split(os.path.sep)[-3:]
-            #track = os.path.splitext(track)[0]
-            #if track[0].isdigit:
-            #    track = ' '.join(track.split(' ')[1:])
-
-            #item['SongTitle'] = track
-            #item['AlbumTitle'] = album
-            #item['ArtistName'] = artist
-
-            ext = os.path.splitext(f.name)[1].lower()
-            fname = unicode(f.name, 'utf-8')
-
-            try:
-                # If the file is an mp3, let's load the EasyID3 interface
-                if ext == '.mp3':
-                    audioFile = MP3(fname, ID3=EasyID3)
-                else:
-                    # Otherwise, let mutagen figure it out
-                    audioFile = mutagen.File(fname)
-
-                if audioFile:
-                    # Pull the length from the FileType, if present
-                    if audioFile.info.length > 0:
-                        item['Duration'] = int(audioFile.info.length * 1000)
-
-                    # Grab our other tags, if present
-                    def get_tag(tagname, d):
-                        for tag in ([tagname] + TAGNAMES[tagname]):
-                            try:
-                                if tag in d:
-                                    value = d[tag][0]
-                                    if type(value) not in [str, unicode]:
-                                        value = str(value)
-                                    return value
-                            except:
-                                pass
-                        return ''
-
-                    artist = get_tag('artist', audioFile)
-                    title = get_tag('title', audioFile)
-                    if artist == 'Various Artists' and '/' in title:
-                        artist, title = [x.strip() for x in title.split('/')]
-                    item['ArtistName'] = artist
-                    item['SongTitle'] = title
-                    item['AlbumTitle'] = get_tag('album', audioFile)
-                    item['AlbumYear'] = get_tag('date', audioFile)[:4]
-                    item['MusicGenre'] = get_tag('genre', audioFile)
-            except Exception, msg:
-                print msg
-
-            ffmpeg_path = config.get_bin('ffmpeg')
-            if 'Duration' not in item and ffmpeg_path:
-                if mswindows:
-                    fname = fname.encode('iso8859-1')
-                cmd = [ffmpeg_path, '-i', fname]
-                ffmpeg = subprocess.Popen(cmd, stderr=subprocess.PIPE,
-                                               stdout=subprocess.PIPE, 
-                                               stdin=subprocess.PIPE)
-
-                # wait 10 sec if ffmpeg is not back give up
-                for i in xrange(200):
-                    time.sleep(.05)
-                    if not ffmpeg.poll() == None:
-                        break
-
-                if ffmpeg.poll() != None:
-                    output = ffmpeg.stderr.read()
-                    d = durre(output)
-                    if d:
-                        millisecs = ((int(d.group(1)) * 3600 +
-                                      int(d.group(2)) * 60 +
-                                      int(d.group(3))) * 1000 +
-                                     int(d.group(4)) *
-                                     (10 ** (3 - len(d.group(4)))))
-                    else:
-                        millisecs = 0
-                    item['Duration'] = millisecs
-
-            if 'Duration' in item and ffmpeg_path:
-                item['params'] = 'Yes'
-
-            self.media_data_cache[f.name] = item
-            return item
-
         subcname = query['Container'][0]
         local_base_path = self.get_local_base_path(handler, query)
 
@@ -289,13 +322,21 @@ class Music(Plugin):
             return
 
         if os.path.splitext(subcname)[1].lower() in PLAYLISTS:
-            t = Template(PLAYLIST_TEMPLATE, filter=EncodeUnicode)
+            t = tmplcache.get(PLAYLIST_TEMPLATE)(filter=EncodeUnicode)
             t.files, t.total, t.start = self.get_playlist(handler, query)
         else:
-            t = Template(FOLDER_TEMPLATE, filter=EncodeUnicode)
+            t = tmplcache.get(FOLDER_TEMPLATE)(filter=EncodeUnicode)
             t.files, t.total, t.start = self.get_files(handler, query,
                                                        AudioFileFilter)
-        t.files = map(media_data, t.files)
+        # With a background scan running, files it hasn't reached yet
+        # are listed without their tags, and queued.
+        unscanned = None
+        if scanner.threads():
+            unscanned = []
+        t.files = [self.media_data(f, local_base_path, unscanned)
+                   for f in t.files]
+        if unscanned:
+            scanner.queue_files(handler.cname, unscanned)
         t.container = handler.cname
         t.name = subcname
         t.quote = quote
@@ -303,19 +344,65 @@ class Music(Plugin):
 
         handler.send_xml(str(t))
 
+    def media_data(self, f, local_base_path, unscanned=None):
+        """The details of a FileData, for the templates. If unscanned
+           is a list, a file that isn't in the tag index yet is added to
+           it, instead of being read now."""
+        if f.name in self.media_data_cache:
+            return self.media_data_cache[f.name]
+
+        item = {}
+        item['path'] = f.name
+        item['part_path'] = f.name.replace(local_base_path, '', 1)
+        item['name'] = os.path.basename(f.name)
+        item['is_dir'] = f.isdir
+        item['is_playlist'] = f.isplay
+        item['params'] = 'No'
+
+        if f.title:
+            item['Title'] = f.title
+
+        if f.duration > 0:
+            item['Duration'] = f.duration
+
+        if f.isdir or f.isplay or '://' in f.name:
+            self.media_data_cache[f.name] = item
+            return item
+
+        tags = file_tags(f.name, unscanned is None)
+        if tags is None:
+            unscanned.append(f.name)
+            return item
+        item.update(tags)
+
+        if 'Duration' in item and config.get_bin('ffmpeg'):
+            item['params'] = 'Yes'
+
+        self.media_data_cache[f.name] = item
+        return item
+
     def QueryItem(self, handler, query):
         uq = urllib.unquote_plus
         splitpath = [x for x in uq(query['Url'][0]).split('/') if x]
         path = os.path.join(handler.container['path'], *splitpath[1:])
 
-        if path in self.media_data_cache:
-            t = Template(ITEM_TEMPLATE, filter=EncodeUnicode)
-            t.file = self.media_data_cache[path]
+        if (path in self.media_data_cache or ('..' not in splitpath and
+            os.path.isfile(unicode(path, 'utf-8')))):
+            t = tmplcache.get(ITEM_TEMPLATE)(filter=EncodeUnicode)
+            t.file = self.media_data(FileData(path, False),
+                                     handler.container['path'])
             t.escape = escape
             handler.send_xml(str(t))
         else:
             handler.send_error(404)
 
+    def prewarm(self, full_path):
+        """Read a file's tags into the tag index ahead of time. Called
+           by the scanner."""
+        ext = os.path.splitext(full_path)[1].lower()
+        if ext in ('.mp3', '.mp2') or ext in TRANSCODE:
+            file_tags(full_path)
+
     def parse_playlist(self, list_name, recurse):
 
         ext = os.path.splitext(list_name)[1].lower()
@@ -420,28 +507,10 @@ class Music(Plugin):
                 self.unsorted = True
                 self.sortby = None
                 self.last_start = 0
+                self.positions = None
  
-        def build_recursive_list(path, recurse=True):
-            files = []
-            path = unicode(path, 'utf-8')
-            try:
-                for f in os.listdir(path):
-                    if f.startswith('.'):
-                        continue
-                    f = os.path.join(path, f)
-                    isdir = os.path.isdir(f)
-                    if sys.platform == 'darwin':
-                        f = unicodedata.normalize('NFC', f)
-                    f = f.encode('utf-8')
-                    if recurse and isdir:
-                        files.extend(build_recursive_list(f))
-                    else:
-                        fd = FileData(f, isdir)
-                        if isdir or filterFunction(f, file_type):
-                            files.append(fd)
-            except:
-                pass
-            return files
+        def keep(name, isdir):
+            return isdir or filterFunction(name, file_type)
 
         def dir_sort(x, y):
             if x.isdir == y.isdir:
@@ -476,7 +545,7 @@ class Music(Plugin):
                     del rc[p]
 
         if not filelist:
-            filelist = SortList(build_recursive_list(path, recurse))
+            filelist = SortList(dirscan.scan(path, recurse, keep, FileData))
 
             if recurse:
                 rc[path] = filelist
@@ -520,12 +589,13 @@ class Music(Plugin):
 
             filelist.sortby = sortby
             filelist.unsorted = False
-
-        files = filelist.files[:]
+            filelist.positions = self.positions(filelist.files)
 
         # Trim the list
         files, total, start = self.item_count(handler, query, handler.cname,
-                                              files, filelist.last_start)
+                                              filelist.files,
+                                              filelist.last_start,
+                                              filelist.positions)
         filelist.last_start = start
         return files, total, start
 
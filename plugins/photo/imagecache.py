@@ -0,0 +1,148 @@
+"""Cache of rendered photos -- scaled, rotated and re-encoded as JPEG --
+so that repeat views at the same size are sent without touching the
+original.
+
+Entries are keyed by (path, mtime, width, height, pshape, rotation).
+They're held in memory up to the "photo_cache_size" budget, and if
+"photo_cache_disk" is set, also written under cache_dir/photo, where
+the least recently used files are removed once that budget is exceeded.
+"""
+
+import logging
+import os
+import tempfile
+import threading
+from hashlib import md5
+
+import config
+from lrucache import LRUCache, CacheKeyError
+
+logger = logging.getLogger('pyTivo.photo.imagecache')
+
+DEFAULT_MEMORY = '32Mi'
+DEFAULT_DISK = '0'
+
+class ImageCache(object):
+
+    def __init__(self):
+        self.memory = LRUCache(10000, maxbytes=0)    # Set by limits()
+        self.lock = threading.Lock()
+        self.disk_path = None
+        self.disk_bytes = 0
+
+    def limits(self):
+        # Settings can change on a soft reset
+        memory = config.get_server_size('photo_cache_size', DEFAULT_MEMORY)
+        if memory != self.memory.maxbytes:
+            self.memory.maxbytes = memory
+        disk = config.get_server_size('photo_cache_disk', DEFAULT_DISK)
+        return memory, disk
+
+    def get(self, key):
+        """Return the cached JPEG for key, or None."""
+        memory, disk = self.limits()
+        try:
+            return self.memory[key]
+        except CacheKeyError:
+            pass
+        if disk:
+            data = self.read_disk(key)
+            if data:
+                self.memory[key] = data
+                return data
+        return None
+
+    def put(self, key, data):
+        memory, disk = self.limits()
+        if memory:
+            self.memory[key] = data
+        if disk:
+            self.write_disk(key, data, disk)
+
+    def disk_name(self, key):
+        path = self.check_disk()
+        if path:
+            return os.path.join(path, md5(repr(key)).hexdigest() + '.jpg')
+        return None
+
+    def check_disk(self):
+        """Return the spill directory, totting up what's already there
+           whenever it changes."""
+        path = config.get_cache_dir('photo')
+        self.lock.acquire()
+        try:
+            if path != self.disk_path:
+                self.disk_path = path
+                self.disk_bytes = 0
+                if path:
+                    for name in os.listdir(path):
+                        try:
+                            self.disk_bytes += os.path.getsize(
+                                os.path.join(path, name))
+                        except OSError:
+                            pass
+        finally:
+            self.lock.release()
+        return path
+
+    def read_disk(self, key):
+        fname = self.disk_name(key)
+        if not fname:
+            return None
+        try:
+            f = open(fname, 'rb')
+            data = f.read()
+            f.close()
+            os.utime(fname, None)   # For the trimming order
+        except (IOError, OSError):
+            return None
+        return data
+
+    def write_disk(self, key, data, limit):
+        fname = self.disk_name(key)
+        if not fname:
+            return
+        replaced = 0
+        try:
+            fd, tmpname = tempfile.mkstemp(dir=os.path.dirname(fname))
+            os.write(fd, data)
+            os.close(fd)
+            if os.path.exists(fname):
+                replaced = os.path.getsize(fname)
+                os.remove(fname)
+            os.rename(tmpname, fname)
+        except (IOError, OSError), msg:
+            logger.error('Unable to write %s -- %s' % (fname, msg))
+            return
+
+        self.lock.acquire()
+        try:
+            self.disk_bytes += len(data) - replaced
+            if self.disk_bytes > limit:
+                self.trim(limit * 9 / 10)
+        finally:
+            self.lock.release()
+
+    def trim(self, target):
+        # Called with the lock held
+        files = []
+        total = 0
+        for name in os.listdir(self.disk_path):
+            fname = os.path.join(self.disk_path, name)
+            try:
+                st = os.stat(fname)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, fname))
+            total += st.st_size
+        files.sort()
+        for mtime, size, fname in files:
+            if total <= target:
+                break
+            try:
+                os.remove(fname)
+                total -= size
+            except OSError:
+                pass
+        self.disk_bytes = total
+        logger.debug('Trimmed photo cache to %d bytes' % total)
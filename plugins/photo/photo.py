@@ -24,15 +24,13 @@
 # Version 0.2,  Dec. 8  -- thumbnail caching, faster thumbnails
 # Version 0.1,  Dec. 7, 2007
 
+import logging
 import os
 import re
 import random
-import subprocess
 import sys
-import tempfile
 import threading
 import time
-import unicodedata
 import urllib
 from cStringIO import StringIO
 from xml.sax.saxutils import escape
@@ -48,15 +46,22 @@ except ImportError:
         print 'Python Imaging Library not found; using FFmpeg'
 
 import config
-from Cheetah.Template import Template
+import dirscan
+import procrun
+import scheduler
+import tmplcache
 from lrucache import LRUCache
 from plugin import EncodeUnicode, Plugin, quote, unquote
-from plugins.video.transcode import kill
+from plugins.photo.imagecache import ImageCache
+from plugins.photo.prefetch import Prefetcher
+from procrun import kill
 
 SCRIPTDIR = os.path.dirname(__file__)
 
 CLASS_NAME = 'Photo'
 
+logger = logging.getLogger('pyTivo.photo')
+
 # Match Exif date -- YYYY:MM:DD HH:MM:SS
 exif_date = re.compile(r'(\d{4}):(\d\d):(\d\d) (\d\d):(\d\d):(\d\d)').search
 
@@ -69,11 +74,9 @@ exif_orient_m = \
 # Find size in FFmpeg output
 ffmpeg_size = re.compile(r'.*Video: .+, (\d+)x(\d+)[, ].*')
 
-# Preload the template
-tname = os.path.join(SCRIPTDIR, 'templates', 'container.tmpl')
-iname = os.path.join(SCRIPTDIR, 'templates', 'item.tmpl')
-PHOTO_TEMPLATE = file(tname, 'rb').read()
-ITEM_TEMPLATE = file(iname, 'rb').read()
+# The templates, compiled on first use
+PHOTO_TEMPLATE = os.path.join(SCRIPTDIR, 'templates', 'container.tmpl')
+ITEM_TEMPLATE = os.path.join(SCRIPTDIR, 'templates', 'item.tmpl')
 
 JFIF_TAG = '\xff\xe0\x00\x10JFIF\x00\x01\x02\x00\x00\x01\x00\x01\x00\x00'
 
@@ -108,7 +111,10 @@ class Photo(Plugin):
                 self.release()
             return item
 
-    media_data_cache = LockedLRUCache(300)  # info and thumbnails
+    media_data_cache = LockedLRUCache(300)  # info
+    image_cache = ImageCache()              # rendered images
+    prefetcher = Prefetcher()
+    slideshows = {}                         # last list sent, by client
     recurse_cache = LockedLRUCache(5)       # recursive directory lists
     dir_cache = LockedLRUCache(10)          # non-recursive lists
 
@@ -220,34 +226,27 @@ class Photo(Plugin):
 
         return True, encoded
 
+    def run_ffmpeg(self, cmd, fname):
+        job = scheduler.acquire('probe', os.path.basename(fname))
+        if not job:
+            return False, 'FFmpeg too busy'
+        try:
+            # wait configured # of seconds: if ffmpeg is not back give up
+            result = procrun.run(cmd, config.getFFmpegWait(),
+                                 scheduler.preexec('probe'))
+        finally:
+            scheduler.release(job)
+        if result.timed_out:
+            return False, 'FFmpeg timed out'
+        return True, result
+
     def get_size_ffmpeg(self, ffmpeg_path, fname):
         cmd = [ffmpeg_path, '-i', fname]
-        # Windows and other OS buffer 4096 and ffmpeg can output more
-        # than that.
-        err_tmp = tempfile.TemporaryFile()
-        ffmpeg = subprocess.Popen(cmd, stderr=err_tmp,
-                                  stdout=subprocess.PIPE,
-                                  stdin=subprocess.PIPE)
-
-        # wait configured # of seconds: if ffmpeg is not back give up
-        limit = config.getFFmpegWait()
-        if limit:
-            for i in xrange(limit * 20):
-                time.sleep(.05)
-                if not ffmpeg.poll() == None:
-                    break
-
-            if ffmpeg.poll() == None:
-                kill(ffmpeg)
-                return False, 'FFmpeg timed out'
-        else:
-            ffmpeg.wait()
-
-        err_tmp.seek(0)
-        output = err_tmp.read()
-        err_tmp.close()
+        status, result = self.run_ffmpeg(cmd, fname)
+        if not status:
+            return status, result
 
-        x = ffmpeg_size.search(output)
+        x = ffmpeg_size.search(result.stderr)
         if x:
             width = int(x.group(1))
             height = int(x.group(2))
@@ -301,27 +300,11 @@ class Photo(Plugin):
         filters += 'scale=%d:%d' % (width, height)
 
         cmd = [ffmpeg_path, '-i', fname, '-vf', filters, '-f', 'mjpeg', '-']
-        jpeg_tmp = tempfile.TemporaryFile()
-        ffmpeg = subprocess.Popen(cmd, stdout=jpeg_tmp,
-                                  stdin=subprocess.PIPE)
-
-        # wait configured # of seconds: if ffmpeg is not back give up
-        limit = config.getFFmpegWait()
-        if limit:
-            for i in xrange(limit * 20):
-                time.sleep(.05)
-                if not ffmpeg.poll() == None:
-                    break
-
-            if ffmpeg.poll() == None:
-                kill(ffmpeg)
-                return False, 'FFmpeg timed out'
-        else:
-            ffmpeg.wait()
+        status, result = self.run_ffmpeg(cmd, fname)
+        if not status:
+            return status, result
 
-        jpeg_tmp.seek(0)
-        output = jpeg_tmp.read()
-        jpeg_tmp.close()
+        output = result.stdout
 
         if 'JFIF' not in output[:10]:
             output = output[:2] + JFIF_TAG + output[2:]
@@ -352,40 +335,107 @@ class Photo(Plugin):
             rot = (rot - int(query['Rotation'][0])) % 360
             if attrs:
                 attrs['rotation'] = rot
-                if 'thumb' in attrs:
-                    del attrs['thumb']
 
         # Requested size
         width = int(query.get('Width', ['0'])[0])
         height = int(query.get('Height', ['0'])[0])
 
-        # Return saved thumbnail?
-        if attrs and 'thumb' in attrs and 0 < width < 100 and 0 < height < 100:
-            send_jpeg(attrs['thumb'])
-            return
-
         # Requested pixel shape
         pshape = query.get('PixelShape', ['1:1'])[0]
 
+        # Return a saved image?
+        try:
+            mtime = os.path.getmtime(unicode(path, 'utf-8'))
+        except OSError, msg:
+            handler.server.logger.error('Could not open %s -- %s' %
+                                        (path, msg))
+            handler.send_error(404)
+            return
+        key = (path, mtime, width, height, pshape, rot)
+        image = self.image_cache.get(key)
+        if not image and self.prefetcher.wait(key, config.getFFmpegWait()
+                                              or None):
+            image = self.image_cache.get(key)
+        if image:
+            send_jpeg(image)
+            self.prefetch(handler, path, width, height, pshape)
+            return
+
         # Build a new image
-        if use_pil:
-            status, result = self.get_image_pil(path, width, height, 
-                                                pshape, rot, attrs)
-        else:
-            status, result = self.get_image_ffmpeg(path, width, height, 
-                                                   pshape, rot, attrs)
+        status, result = self.get_image(path, width, height,
+                                        pshape, rot, attrs)
 
         if status:
-            # Save thumbnails
-            if attrs and width < 100 and height < 100:
-                attrs['thumb'] = result
+            self.image_cache.put(key, result)
 
             # Send it
             send_jpeg(result)
+            self.prefetch(handler, path, width, height, pshape)
         else:
             handler.server.logger.error(result)
             handler.send_error(404)
 
+    def get_image(self, path, width, height, pshape, rot, attrs):
+        if use_pil:
+            return self.get_image_pil(path, width, height,
+                                      pshape, rot, attrs)
+        else:
+            return self.get_image_ffmpeg(path, width, height,
+                                         pshape, rot, attrs)
+
+    def prefetch(self, handler, path, width, height, pshape):
+        """Queue the photos after path, in the list most recently sent
+           to this client, for rendering at the same size."""
+        count = self.prefetcher.count()
+        client = handler.client_address[0]
+        filelist = self.slideshows.get(client)
+        if not count or not filelist:
+            return
+
+        # Walk forward (wrapping around) from path, skipping folders
+        names = []
+        filelist.acquire()
+        try:
+            files = filelist.files
+            if not filelist.positions or path not in filelist.positions:
+                return
+            index = filelist.positions[path]
+            for i in xrange(1, len(files)):
+                f = files[(index + i) % len(files)]
+                if not f.isdir:
+                    names.append(f.name)
+                    if len(names) >= count:
+                        break
+        finally:
+            filelist.release()
+
+        jobs = []
+        for name in names:
+            try:
+                attrs = self.media_data_cache[name]
+                rot = attrs['rotation']
+            except:
+                attrs = None
+                rot = 0
+            try:
+                mtime = os.path.getmtime(unicode(name, 'utf-8'))
+            except OSError:
+                continue
+            key = (name, mtime, width, height, pshape, rot)
+            jobs.append((key, self.prefetch_image, (key, attrs)))
+        self.prefetcher.schedule(client, jobs)
+
+    def prefetch_image(self, key, attrs):
+        path, mtime, width, height, pshape, rot = key
+        if self.image_cache.get(key):
+            return
+        status, result = self.get_image(path, width, height,
+                                        pshape, rot, attrs)
+        if status:
+            self.image_cache.put(key, result)
+        else:
+            logger.warning(result)
+
     def QueryContainer(self, handler, query):
 
         # Reject a malformed request -- these attributes should only
@@ -423,7 +473,7 @@ class Photo(Plugin):
             self.media_data_cache[f.name] = item
             return item
 
-        t = Template(PHOTO_TEMPLATE, filter=EncodeUnicode)
+        t = tmplcache.get(PHOTO_TEMPLATE)(filter=EncodeUnicode)
         t.name = query['Container'][0]
         t.container = handler.cname
         t.files, t.total, t.start = self.get_files(handler, query,
@@ -440,7 +490,7 @@ class Photo(Plugin):
         path = os.path.join(handler.container['path'], *splitpath[1:])
 
         if path in self.media_data_cache:
-            t = Template(ITEM_TEMPLATE, filter=EncodeUnicode)
+            t = tmplcache.get(ITEM_TEMPLATE)(filter=EncodeUnicode)
             t.file = self.media_data_cache[path]
             t.escape = escape
             handler.send_xml(str(t))
@@ -449,20 +499,13 @@ class Photo(Plugin):
 
     def get_files(self, handler, query, filterFunction):
 
-        class FileData:
-            def __init__(self, name, isdir):
-                self.name = name
-                self.isdir = isdir
-                st = os.stat(unicode(name, 'utf-8'))
-                self.cdate = int(st.st_ctime)
-                self.mdate = int(st.st_mtime)
-
         class SortList:
             def __init__(self, files):
                 self.files = files
                 self.unsorted = True
                 self.sortby = None
                 self.last_start = 0
+                self.positions = None
                 self.lock = threading.RLock()
 
             def acquire(self, blocking=1):
@@ -471,27 +514,8 @@ class Photo(Plugin):
             def release(self):
                 self.lock.release()
 
-        def build_recursive_list(path, recurse=True):
-            files = []
-            path = unicode(path, 'utf-8')
-            try:
-                for f in os.listdir(path):
-                    if f.startswith('.'):
-                        continue
-                    f = os.path.join(path, f)
-                    isdir = os.path.isdir(f)
-                    if sys.platform == 'darwin':
-                        f = unicodedata.normalize('NFC', f)
-                    f = f.encode('utf-8')
-                    if recurse and isdir:
-                        files.extend(build_recursive_list(f))
-                    else:
-                       if isdir or filterFunction(f):
-                           files.append(FileData(f, isdir))
-            except:
-                pass
-
-            return files
+        def keep(name, isdir):
+            return isdir or filterFunction(name)
 
         def name_sort(x, y):
             return cmp(x.name, y.name)
@@ -528,7 +552,7 @@ class Photo(Plugin):
                     del rc[p]
 
         if not filelist:
-            filelist = SortList(build_recursive_list(path, recurse))
+            filelist = SortList(dirscan.scan(path, recurse, keep))
 
             if recurse:
                 rc[path] = filelist
@@ -584,8 +608,10 @@ class Photo(Plugin):
 
             filelist.sortby = sortby
             filelist.unsorted = False
+            filelist.positions = self.positions(filelist.files)
 
-        files = filelist.files[:]
+        files = filelist.files
+        positions = filelist.positions
 
         # Filter it -- this section needs work
         if 'Filter' in query:
@@ -593,11 +619,15 @@ class Photo(Plugin):
             useimg = 'image' in query['Filter'][0]
             if not usedir:
                 files = [x for x in files if not x.isdir]
+                positions = None
             elif usedir and not useimg:
                 files = [x for x in files if x.isdir]
+                positions = None
 
         files, total, start = self.item_count(handler, query, handler.cname,
-                                              files, filelist.last_start)
+                                              files, filelist.last_start,
+                                              positions)
         filelist.last_start = start
         filelist.release()
+        self.slideshows[handler.client_address[0]] = filelist
         return files, total, start
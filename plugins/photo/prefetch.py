@@ -0,0 +1,110 @@
+"""Render upcoming photos ahead of time, in a pool of worker threads.
+
+The photo plugin hands over a list of jobs each time it sends an image
+-- typically the next few photos in the same listing, at the same size
+-- and the workers run them in order. A newer batch from the same client
+supersedes any of its older jobs that haven't started yet. If a request
+arrives for an image that's being rendered right now, wait() lets it
+pick up the result instead of starting over.
+"""
+
+import Queue
+import logging
+import threading
+
+import config
+import scheduler
+
+logger = logging.getLogger('pyTivo.photo.prefetch')
+
+class Prefetcher(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.pending = {}       # key -> [event, client, generation]
+        self.generation = {}    # client -> generation
+        self.workers = 0
+
+    def count(self):
+        """How many photos ahead to render."""
+        try:
+            return max(int(config.get_server('photo_prefetch', 2)), 0)
+        except ValueError:
+            return 0
+
+    def threads(self):
+        try:
+            return max(int(config.get_server('photo_prefetch_threads', 1)), 1)
+        except ValueError:
+            return 1
+
+    def schedule(self, client, jobs):
+        """Queue a list of (key, function, args) jobs for client,
+           replacing any of its jobs still waiting."""
+        self.lock.acquire()
+        try:
+            generation = self.generation.get(client, 0) + 1
+            self.generation[client] = generation
+            for key, func, args in jobs:
+                if key in self.pending:
+                    self.pending[key][1:] = [client, generation]
+                else:
+                    self.pending[key] = [threading.Event(), client,
+                                         generation]
+                    self.queue.put((key, func, args))
+            while self.workers < self.threads():
+                self.workers += 1
+                t = threading.Thread(target=self.work,
+                                     name='photo prefetch')
+                t.setDaemon(True)
+                t.start()
+        finally:
+            self.lock.release()
+
+    def wait(self, key, timeout=None):
+        """If key is queued or being rendered, wait for it to finish.
+           Returns True if it was pending."""
+        self.lock.acquire()
+        try:
+            entry = self.pending.get(key)
+        finally:
+            self.lock.release()
+        if entry:
+            entry[0].wait(timeout)
+            return True
+        return False
+
+    def work(self):
+        # Nobody is waiting on these yet
+        scheduler.set_background()
+        while True:
+            self.lock.acquire()
+            try:
+                if self.workers > self.threads():
+                    self.workers -= 1
+                    return
+            finally:
+                self.lock.release()
+
+            key, func, args = self.queue.get()
+
+            self.lock.acquire()
+            try:
+                event, client, generation = self.pending[key]
+                current = self.generation.get(client) == generation
+            finally:
+                self.lock.release()
+
+            try:
+                if current:
+                    func(*args)
+            except Exception:
+                logger.exception('Prefetch failed for %s' % (key,))
+
+            self.lock.acquire()
+            try:
+                del self.pending[key]
+            finally:
+                self.lock.release()
+            event.set()
@@ -1,11 +1,14 @@
 import logging
 import os
+import time
 from urllib import quote
-
-from Cheetah.Template import Template
+from xml.sax.saxutils import escape
 
 import buildhelp
 import config
+import scanner
+import scheduler
+import tmplcache
 from plugin import EncodeUnicode, Plugin
 
 SCRIPTDIR = os.path.dirname(__file__)
@@ -25,9 +28,9 @@ SETTINGS_MSG = """<h3>Settings Saved</h3> <p>Your settings have been
 saved to the pyTivo.conf file. However you may need to do a <b>Soft 
 Reset</b> or <b>Restart</b> before these changes will take effect.</p>"""
 
-# Preload the templates
-tsname = os.path.join(SCRIPTDIR, 'templates', 'settings.tmpl')
-SETTINGS_TEMPLATE = file(tsname, 'rb').read()
+# The templates, compiled on first use
+SETTINGS_TEMPLATE = os.path.join(SCRIPTDIR, 'templates', 'settings.tmpl')
+STATUS_TEMPLATE = os.path.join(SCRIPTDIR, 'templates', 'status.tmpl')
 
 class Settings(Plugin):
     CONTENT_TYPE = 'text/html'
@@ -61,6 +64,14 @@ class Settings(Plugin):
         handler.redir(RESET_MSG, 3)
         logging.getLogger('pyTivo.settings').info('pyTivo has been soft reset.')
 
+    def Status(self, handler, query):
+        t = tmplcache.get(STATUS_TEMPLATE)(filter=EncodeUnicode)
+        t.scan = scanner.status()
+        t.jobs = scheduler.status()
+        t.escape = escape
+        t.time = time
+        handler.send_html(str(t), refresh='10')
+
     def Settings(self, handler, query):
         # Read config file new each time in case there was any outside edits
         config.reset()
@@ -75,7 +86,7 @@ class Settings(Plugin):
                                         dict(config.config.items(section,
                                                                  raw=True))))
 
-        t = Template(SETTINGS_TEMPLATE, filter=EncodeUnicode)
+        t = tmplcache.get(SETTINGS_TEMPLATE)(filter=EncodeUnicode)
         t.mode = buildhelp.mode
         t.options = buildhelp.options
         t.container = handler.cname
@@ -0,0 +1,268 @@
+"""Queue of recordings to fetch from TiVos.
+
+Downloads run in a pool of worker threads: up to "togo_threads" at
+once in all, and up to "togo_tivo_threads" from any one TiVo (most
+TiVos don't like serving more than one at a time). Workers take the
+oldest waiting download whose TiVo has a free slot, so pulls from
+several TiVos run side by side.
+
+If cache_dir is set, the downloads still waiting or in progress are
+kept in a journal there, and are queued again the next time the ToGo
+plugin starts -- picking up where they left off, where the file allows
+it (see ToGo.get_tivo_file()).
+
+Each download is a dict; stats() returns copies of them, along with
+totals per TiVo and overall, for the templates.
+"""
+
+import logging
+import threading
+import time
+
+import config
+import journal
+
+logger = logging.getLogger('pyTivo.togo.downloads')
+
+JOURNAL = 'togo_queue'
+RATE_INTERVAL = 5   # Seconds over which the current rate is measured
+
+# Download states
+QUEUED, STARTING, RUNNING, FINISHED, FAILED = ('queued', 'starting',
+    'running', 'finished', 'error')
+ACTIVE = (QUEUED, STARTING, RUNNING)
+
+class DownloadQueue(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.jobs = []      # In the order they were added
+        self.plugin = None
+        self.workers = 0
+
+    def threads(self):
+        try:
+            return max(int(config.get_server('togo_threads', 2)), 1)
+        except ValueError:
+            return 1
+
+    def tivo_threads(self):
+        """The most downloads from one TiVo at a time; 0 for no limit."""
+        try:
+            return max(int(config.get_server('togo_tivo_threads', 1)), 0)
+        except ValueError:
+            return 1
+
+    def start(self, plugin):
+        """Set the plugin whose get_tivo_file() method does the work,
+           and reload anything left in the journal. Only the first call
+           has any effect."""
+        self.cond.acquire()
+        try:
+            if self.plugin:
+                return
+            self.plugin = plugin
+            jobs = journal.load(JOURNAL, [])
+            for job in jobs:
+                self._add(job)
+            if jobs:
+                logger.info('Resuming %d queued downloads' % len(jobs))
+                self._start_workers()
+        finally:
+            self.cond.release()
+
+    def add(self, job):
+        """Queue a download. job is a dict with at least 'url',
+           'tivoIP', 'tsn', 'togo_path', 'decode' and 'save'. A finished
+           or failed earlier download of the same URL is replaced."""
+        self.cond.acquire()
+        try:
+            old = self._find(job['url'])
+            if old:
+                if old['state'] in ACTIVE:
+                    return False
+                self.jobs.remove(old)
+            self._add(job)
+            self.save()
+            self._start_workers()
+            self.cond.notifyAll()
+            return True
+        finally:
+            self.cond.release()
+
+    def _add(self, job):
+        # Called with the lock held
+        job.update({'state': QUEUED, 'error': '', 'bytes': 0, 'total': 0,
+                    'rate': 0.0, 'started': None, 'finished': None,
+                    'stop': False})
+        job.setdefault('added', time.time())
+        self.jobs.append(job)
+
+    def _find(self, url):
+        # Called with the lock held
+        for job in self.jobs:
+            if job['url'] == url:
+                return job
+        return None
+
+    def remove(self, url):
+        """Take a download that hasn't started yet out of the queue."""
+        self.cond.acquire()
+        try:
+            job = self._find(url)
+            if job and job['state'] == QUEUED:
+                self.jobs.remove(job)
+                self.save()
+                return True
+            return False
+        finally:
+            self.cond.release()
+
+    def stop(self, url):
+        """Ask a running download to stop. Its partial file is removed."""
+        self.cond.acquire()
+        try:
+            job = self._find(url)
+            if job and job['state'] in (STARTING, RUNNING):
+                job['stop'] = True
+        finally:
+            self.cond.release()
+
+    def _start_workers(self):
+        # Called with the lock held
+        while self.workers < self.threads():
+            self.workers += 1
+            t = threading.Thread(target=self.work, name='togo download')
+            t.setDaemon(True)
+            t.start()
+
+    def _next(self):
+        # Called with the lock held. The oldest waiting job whose TiVo
+        # has room for another download, if any.
+        limit = self.tivo_threads()
+        running = {}
+        for job in self.jobs:
+            if job['state'] in (STARTING, RUNNING):
+                running[job['tivoIP']] = running.get(job['tivoIP'], 0) + 1
+        for job in self.jobs:
+            if (job['state'] == QUEUED and
+                (not limit or running.get(job['tivoIP'], 0) < limit)):
+                return job
+        return None
+
+    def work(self):
+        while True:
+            self.cond.acquire()
+            try:
+                while True:
+                    if self.workers > self.threads():
+                        self.workers -= 1
+                        return
+                    job = self._next()
+                    if job:
+                        break
+                    self.cond.wait(60)
+                job['state'] = STARTING
+                job['started'] = time.time()
+                self.save()
+            finally:
+                self.cond.release()
+
+            try:
+                self.plugin.get_tivo_file(job, self)
+            except Exception, msg:
+                logger.exception('Download of %s failed' % job['url'])
+                self.finish(job, str(msg))
+
+    def running(self, job, total, offset=0):
+        """Called when the transfer has started: total is the full size,
+           if known, and offset the number of bytes already on disk."""
+        self.cond.acquire()
+        try:
+            job['state'] = RUNNING
+            job['total'] = total
+            job['bytes'] = offset
+            job['rate'] = 0.0
+            job['interval'] = (time.time(), offset)
+        finally:
+            self.cond.release()
+
+    def progress(self, job, length):
+        """Count length more bytes received. Returns False if the job has
+           been asked to stop."""
+        now = time.time()
+        self.cond.acquire()
+        try:
+            job['bytes'] += length
+            last, count = job['interval']
+            if now - last >= RATE_INTERVAL:
+                job['rate'] = (job['bytes'] - count) / (now - last)
+                job['interval'] = (now, job['bytes'])
+            return not job['stop']
+        finally:
+            self.cond.release()
+
+    def finish(self, job, error=''):
+        """Called when a download is over. A stopped job is dropped; a
+           failed one is kept, with its error, until it's queued again."""
+        self.cond.acquire()
+        try:
+            job['finished'] = time.time()
+            job['rate'] = 0.0
+            if job['stop']:
+                if job in self.jobs:
+                    self.jobs.remove(job)
+            elif error:
+                job['state'] = FAILED
+                job['error'] = error
+            else:
+                job['state'] = FINISHED
+            self.save()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def stats(self):
+        """A snapshot of every download, with its place in its TiVo's
+           queue ('position', from 1) if it's waiting, plus totals by
+           TiVo and overall: how many are running and queued, and the
+           combined rate in bytes per second."""
+        self.cond.acquire()
+        try:
+            downloads = []
+            tivos = {}
+            total = {'running': 0, 'queued': 0, 'rate': 0.0, 'bytes': 0}
+            for job in self.jobs:
+                job = dict(job)
+                tivo = tivos.setdefault(job['tivoIP'], {'running': 0,
+                                        'queued': 0, 'rate': 0.0,
+                                        'bytes': 0})
+                if job['state'] == QUEUED:
+                    tivo['queued'] += 1
+                    total['queued'] += 1
+                    job['position'] = tivo['queued']
+                elif job['state'] in (STARTING, RUNNING):
+                    tivo['running'] += 1
+                    total['running'] += 1
+                tivo['rate'] += job['rate']
+                total['rate'] += job['rate']
+                tivo['bytes'] += job['bytes']
+                total['bytes'] += job['bytes']
+                downloads.append(job)
+        finally:
+            self.cond.release()
+        return {'downloads': downloads, 'tivos': tivos, 'total': total}
+
+    def by_url(self):
+        return dict((job['url'], job) for job in self.stats()['downloads'])
+
+    def save(self):
+        # Called with the lock held. Only what's still to be done is
+        # kept; it all starts out queued again after a restart.
+        keep = ('url', 'tivoIP', 'tsn', 'togo_path', 'decode', 'save',
+                'meta', 'added')
+        jobs = [dict((key, job[key]) for key in keep if key in job)
+                for job in self.jobs if job['state'] in ACTIVE]
+        journal.save(JOURNAL, jobs)
+
+download_queue = DownloadQueue()
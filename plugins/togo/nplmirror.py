@@ -0,0 +1,237 @@
+"""A copy of each TiVo's Now Playing List, kept up to date in the
+background, for the ToGo pages to be served from.
+
+The first time a TiVo's list is viewed, and whenever the copy is more
+than REFRESH seconds old, a thread walks the whole list -- the top
+level and every folder -- PAGE_SIZE items at a time. Pages are read
+with tivoxml, and each show is kept as a small dict of what the
+templates use (see make_entry()), not as XML; shows are matched by
+UniqueId, and only those whose data has changed since the last pass
+are processed again. Shows and folders no longer on the TiVo are
+dropped at the end of each pass.
+
+Pages are served from the copy, at any folder and offset, without
+waiting on the TiVo -- except the first view of a folder that hasn't
+been fetched yet.
+"""
+
+import hashlib
+import logging
+import threading
+import time
+
+import metadata
+import tivoxml
+
+logger = logging.getLogger('pyTivo.togo.nplmirror')
+
+PAGE_SIZE = 50
+REFRESH = 60        # Seconds before a view starts a new pass
+WAIT = 60           # Seconds to wait for a folder that isn't here yet
+
+FOLDER = 'x-tivo-container/folder'
+
+def getint(thing):
+    try:
+        result = int(thing)
+    except:
+        result = 0
+    return result
+
+def make_entry(item):
+    """The parts of an NPL Item (as read by tivoxml.parse_container())
+       that the templates use."""
+    entry = {}
+    entry['ContentType'] = item.get('Details/ContentType', '')
+    entry['Anchor'] = item.get('Links/Content/Url', '')
+    for tag in ('CopyProtected', 'UniqueId'):
+        value = item.get('Details/' + tag)
+        if value:
+            entry[tag] = value
+    if entry['ContentType'] == FOLDER:
+        entry['Title'] = item.get('Details/Title', '')
+        entry['TotalItems'] = item.get('Details/TotalItems', '')
+        lc = item.get('Details/LastCaptureDate')
+        if not lc:
+            lc = item.get('Details/LastChangeDate')
+        entry['LastChangeDate'] = time.strftime('%b %d, %Y',
+            time.localtime(int(lc, 16)))
+    else:
+        keys = {'Icon': 'Links/CustomIcon/Url',
+                'Url': 'Links/Content/Url',
+                'SourceSize': 'Details/SourceSize',
+                'Duration': 'Details/Duration',
+                'CaptureDate': 'Details/CaptureDate'}
+        for key in keys:
+            value = item.get(keys[key])
+            if value:
+                entry[key] = value
+
+        rawsize = entry['SourceSize']
+        entry['SourceSize'] = metadata.human_size(rawsize)
+
+        dur = getint(entry['Duration']) / 1000
+        entry['Duration'] = ( '%d:%02d:%02d' %
+            (dur / 3600, (dur % 3600) / 60, dur % 60) )
+
+        entry['CaptureDate'] = time.strftime('%b %d, %Y',
+            time.localtime(int(entry['CaptureDate'], 16)))
+
+        entry['meta'] = metadata.from_container(item)
+        entry.update(entry['meta'])
+    return entry
+
+class Mirror(object):
+    """The copy of one TiVo's list."""
+
+    def __init__(self, tivoIP):
+        self.tivoIP = tivoIP
+        self.folders = {}       # Folder id ('' for the top) -> folder
+        self.shows = {}         # UniqueId -> (digest of item, entry)
+        self.by_url = {}        # Show URL -> entry
+        self.refreshing = False
+        self.updated = 0        # When the last pass finished
+        self.error = ''
+
+class NPLMirror(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.mirrors = {}
+        self.opener = None
+
+    def start(self, opener):
+        """Set the function used to open a URL on a TiVo."""
+        self.opener = opener
+
+    def get(self, tivoIP, folder=''):
+        """The folder as last fetched -- a dict with 'title', 'total'
+           and 'items' (the entries, in the TiVo's order) -- starting a
+           refresh if it's due. Waits if the folder hasn't been fetched
+           yet; returns None if it can't be."""
+        self.cond.acquire()
+        try:
+            mirror = self.mirrors.get(tivoIP)
+            if not mirror:
+                mirror = self.mirrors[tivoIP] = Mirror(tivoIP)
+            if (not mirror.refreshing and
+                time.time() - mirror.updated >= REFRESH):
+                mirror.refreshing = True
+                mirror.error = ''
+                t = threading.Thread(target=self.refresh, args=(mirror,),
+                                     name='npl mirror')
+                t.setDaemon(True)
+                t.start()
+            deadline = time.time() + WAIT
+            while (folder not in mirror.folders and mirror.refreshing and
+                   time.time() < deadline):
+                self.cond.wait(deadline - time.time())
+            return mirror.folders.get(folder)
+        finally:
+            self.cond.release()
+
+    def meta(self, url):
+        """The NPL metadata for the show at url, if it's been seen."""
+        self.cond.acquire()
+        try:
+            for mirror in self.mirrors.values():
+                if url in mirror.by_url:
+                    return dict(mirror.by_url[url]['meta'])
+            return {}
+        finally:
+            self.cond.release()
+
+    def refresh(self, mirror):
+        seen = set()
+        folders = ['']
+        try:
+            while folders:
+                folder = folders.pop(0)
+                items = []
+                title = self.fetch(mirror, folder, items, seen)
+                for entry in items:
+                    if entry['ContentType'] == FOLDER and not folder:
+                        folders.append(entry['UniqueId'])
+
+                self.cond.acquire()
+                try:
+                    mirror.folders[folder] = {'title': title,
+                                              'total': len(items),
+                                              'items': items}
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+        except Exception, msg:
+            logger.error('Unable to read the Now Playing List from %s -- %s'
+                         % (mirror.tivoIP, msg))
+            self.cond.acquire()
+            try:
+                mirror.error = str(msg)
+                mirror.refreshing = False
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+            return
+
+        self.cond.acquire()
+        try:
+            # Drop whatever wasn't seen on this pass
+            for key in mirror.folders.keys():
+                if key and key not in seen:
+                    del mirror.folders[key]
+            for key in mirror.shows.keys():
+                if key not in seen:
+                    del mirror.shows[key]
+            mirror.by_url = dict((entry['Url'], entry)
+                                 for digest, entry in mirror.shows.values()
+                                 if 'Url' in entry)
+            mirror.updated = time.time()
+            mirror.refreshing = False
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def fetch(self, mirror, folder, items, seen):
+        """Read one folder, a page at a time, appending its entries to
+           items and their UniqueIds to seen. Returns its title."""
+        url = ('https://%s/TiVoConnect?Command=QueryContainer'
+               '&Container=/NowPlaying' % mirror.tivoIP)
+        if folder:
+            url += '/' + folder
+        title = ''
+        count = 0       # Entries read from this folder
+        while True:
+            page = self.opener('%s&ItemCount=%d&AnchorOffset=%d' %
+                               (url, PAGE_SIZE, count))
+            details, found = tivoxml.parse_container(page)
+            page.close()
+
+            title = details.get('Details/Title', '')
+            total = details.get('Details/TotalItems')
+            for item in found:
+                items.append(self.entry(mirror, item, seen))
+            count += len(found)
+            if not found:
+                return title
+            if total is None:
+                # Keep going until a short page
+                if len(found) < PAGE_SIZE:
+                    return title
+            elif count >= getint(total):
+                return title
+
+    def entry(self, mirror, item, seen):
+        # Reuse the last entry for this show if its data hasn't changed
+        uid = item.get('Details/UniqueId', '')
+        digest = hashlib.md5(repr(sorted(item.items()))).digest()
+        old = mirror.shows.get(uid)
+        if old and old[0] == digest:
+            entry = old[1]
+        else:
+            entry = make_entry(item)
+        if uid:
+            seen.add(uid)
+            mirror.shows[uid] = (digest, entry)
+        return entry
+
+npl_mirror = NPLMirror()
@@ -0,0 +1,116 @@
+"""A chain of processes that a ToGo download is streamed through on its
+way to disk, such as tivodecode and an FFmpeg remux.
+
+Each stage reads the one before it on stdin; the last one writes the
+output file. The network side hands blocks to write(), which queues
+them (up to BUFFERS of them) for a feeder thread to pass to the first
+stage, so a stall in the chain slows the download instead of running
+up memory, and a short stall doesn't slow it at all. Nothing is read
+back from disk: the recording goes from the TiVo to the finished file
+in one pass.
+
+    pipe = Pipeline([decode_stage, remux_stage], outfile)
+    for block in blocks:
+        pipe.write(block)
+    error = pipe.close()
+"""
+
+import Queue
+import logging
+import subprocess
+import sys
+import threading
+
+from procrun import kill
+
+logger = logging.getLogger('pyTivo.togo.pipeline')
+
+BUFFERS = 16    # Blocks queued ahead of the first stage
+
+# Without this, each child would hold open the other pipes in the chain,
+# and the stages after the first would never see end-of-file.
+CLOSE_FDS = (sys.platform != 'win32')
+
+class Pipeline(object):
+
+    def __init__(self, stages, outfile, buffers=BUFFERS):
+        """stages is a list of functions, each taking an output file
+           name (or None, meaning stdout) and returning a command line.
+           The last one is given outfile."""
+        self.procs = []
+        self.names = []
+        self.error = ''
+        self.queue = Queue.Queue(buffers)
+        self.feeder = None
+
+        stdin = subprocess.PIPE
+        for i, stage in enumerate(stages):
+            last = (i == len(stages) - 1)
+            if last:
+                cmd = stage(outfile)
+                stdout = None
+            else:
+                cmd = stage(None)
+                stdout = subprocess.PIPE
+            logger.debug(' '.join(cmd))
+            try:
+                proc = subprocess.Popen(cmd, stdin=stdin, stdout=stdout,
+                                        close_fds=CLOSE_FDS)
+            except OSError, msg:
+                self.kill()
+                raise OSError('Unable to run %s -- %s' % (cmd[0], msg))
+            if self.procs:
+                self.procs[-1].stdout.close()   # The child has its copy
+            self.procs.append(proc)
+            self.names.append(cmd[0])
+            stdin = proc.stdout
+
+        self.feeder = threading.Thread(target=self.feed,
+                                       name='togo pipeline')
+        self.feeder.setDaemon(True)
+        self.feeder.start()
+
+    def feed(self):
+        f = self.procs[0].stdin
+        while True:
+            block = self.queue.get()
+            if block is None:
+                break
+            if self.error:
+                continue    # Drain, so write() never blocks
+            try:
+                f.write(block)
+            except (IOError, OSError), msg:
+                self.error = '%s stopped -- %s' % (self.names[0], msg)
+        try:
+            f.close()
+        except (IOError, OSError):
+            pass
+
+    def write(self, block):
+        """Queue a block for the first stage; raises IOError if the
+           chain has failed."""
+        if self.error:
+            raise IOError(self.error)
+        self.queue.put(block)
+
+    def close(self):
+        """Finish the input and wait for every stage to exit. Returns
+           an error message, or '' if they all succeeded."""
+        self.queue.put(None)
+        self.feeder.join()
+        for name, proc in zip(self.names, self.procs):
+            status = proc.wait()
+            if status and not self.error:
+                self.error = '%s exited with status %d' % (name, status)
+        return self.error
+
+    def kill(self):
+        """Stop the chain, abandoning anything not yet written."""
+        self.error = self.error or 'Stopped'
+        for proc in self.procs:
+            if proc.poll() is None:
+                kill(proc)
+        if self.feeder:
+            self.queue.put(None)
+            self.feeder.join()
@@ -1,23 +1,21 @@
 import cookielib
 import logging
 import os
-import subprocess
-import thread
 import time
 import urllib2
 import urlparse
 from urllib import quote, unquote
-from xml.dom import minidom
 from xml.sax.saxutils import escape
 
-from Cheetah.Template import Template
-
 import config
 import metadata
+import tmplcache
 from plugin import EncodeUnicode, Plugin
+from downloads import download_queue
+from nplmirror import npl_mirror
+from pipeline import Pipeline
 
 logger = logging.getLogger('pyTivo.togo')
-tag_data = metadata.tag_data
 
 SCRIPTDIR = os.path.dirname(__file__)
 
@@ -42,17 +40,16 @@ connect to the TiVo at %s.</p> <p>This is most likely caused by an
 incorrect Media Access Key. Please return to the Settings page and 
 double check your <b>tivo_mak</b> setting.</p>"""
 
-# Preload the templates
+# The templates, compiled on first use
 def tmpl(name):
-    return file(os.path.join(SCRIPTDIR, 'templates', name), 'rb').read()
+    return os.path.join(SCRIPTDIR, 'templates', name)
 
 CONTAINER_TEMPLATE_MOBILE = tmpl('npl_mob.tmpl')
 CONTAINER_TEMPLATE = tmpl('npl.tmpl')
 
-status = {} # Global variable to control download threads
-tivo_cache = {} # Cache of TiVo NPL
-queue = {} # Recordings to download -- list per TiVo
-basic_meta = {} # Data from NPL, parsed, indexed by progam URL
+BLOCKSIZE = 1024000
+TRIES = 3       # Attempts at each download, resuming where possible
+RETRY_WAIT = 10
 
 def null_cookie(name, value):
     return cookielib.Cookie(0, name, value, None, False, '', False, 
@@ -67,6 +64,10 @@ tivo_opener = urllib2.build_opener(urllib2.HTTPCookieProcessor(cj),
 class ToGo(Plugin):
     CONTENT_TYPE = 'text/html'
 
+    def init(self):
+        download_queue.start(self)
+        npl_mirror.start(self.tivo_open)
+
     def tivo_open(self, url):
         # Loop just in case we get a server busy message
         while True:
@@ -92,7 +93,6 @@ class ToGo(Plugin):
                 result = 0
             return result
 
-        global basic_meta
         shows_per_page = 50 # Change this to alter the number of shows returned
         folder = ''
         FirstAnchor = ''
@@ -104,85 +104,35 @@ class ToGo(Plugin):
             tsn = config.tivos_by_ip(tivoIP)
             tivo_name = config.tivo_names[tsn]
             tivo_mak = config.get_tsn('tivo_mak', tsn)
-            theurl = ('https://' + tivoIP +
-                      '/TiVoConnect?Command=QueryContainer&ItemCount=' +
-                      str(shows_per_page) + '&Container=/NowPlaying')
             if 'Folder' in query:
                 folder += query['Folder'][0]
-                theurl += '/' + folder
-            if 'AnchorItem' in query:
-                theurl += '&AnchorItem=' + quote(query['AnchorItem'][0])
-            if 'AnchorOffset' in query:
-                theurl += '&AnchorOffset=' + query['AnchorOffset'][0]
-
-            if (theurl not in tivo_cache or
-                (time.time() - tivo_cache[theurl]['thepage_time']) >= 60):
-                # if page is not cached or old then retreive it
-                auth_handler.add_password('TiVo DVR', tivoIP, 'tivo', tivo_mak)
-                try:
-                    page = self.tivo_open(theurl)
-                except IOError, e:
-                    handler.redir(UNABLE % tivoIP, 10)
-                    return
-                tivo_cache[theurl] = {'thepage': minidom.parse(page),
-                                      'thepage_time': time.time()}
-                page.close()
-
-            xmldoc = tivo_cache[theurl]['thepage']
-            items = xmldoc.getElementsByTagName('Item')
-            TotalItems = tag_data(xmldoc, 'TiVoContainer/Details/TotalItems')
-            ItemStart = tag_data(xmldoc, 'TiVoContainer/ItemStart')
-            ItemCount = tag_data(xmldoc, 'TiVoContainer/ItemCount')
-            title = tag_data(xmldoc, 'TiVoContainer/Details/Title')
-            if items:
-                FirstAnchor = tag_data(items[0], 'Links/Content/Url')
 
-            data = []
-            for item in items:
-                entry = {}
-                entry['ContentType'] = tag_data(item, 'Details/ContentType')
-                for tag in ('CopyProtected', 'UniqueId'):
-                    value = tag_data(item, 'Details/' + tag)
-                    if value:
-                        entry[tag] = value
-                if entry['ContentType'] == 'x-tivo-container/folder':
-                    entry['Title'] = tag_data(item, 'Details/Title')
-                    entry['TotalItems'] = tag_data(item, 'Details/TotalItems')
-                    lc = tag_data(item, 'Details/LastCaptureDate')
-                    if not lc:
-                        lc = tag_data(item, 'Details/LastChangeDate')
-                    entry['LastChangeDate'] = time.strftime('%b %d, %Y',
-                        time.localtime(int(lc, 16)))
-                else:
-                    keys = {'Icon': 'Links/CustomIcon/Url',
-                            'Url': 'Links/Content/Url',
-                            'SourceSize': 'Details/SourceSize',
-                            'Duration': 'Details/Duration',
-                            'CaptureDate': 'Details/CaptureDate'}
-                    for key in keys:
-                        value = tag_data(item, keys[key])
-                        if value:
-                            entry[key] = value
-
-                    rawsize = entry['SourceSize']
-                    entry['SourceSize'] = metadata.human_size(rawsize)
-
-                    dur = getint(entry['Duration']) / 1000
-                    entry['Duration'] = ( '%d:%02d:%02d' %
-                        (dur / 3600, (dur % 3600) / 60, dur % 60) )
-
-                    entry['CaptureDate'] = time.strftime('%b %d, %Y',
-                        time.localtime(int(entry['CaptureDate'], 16)))
-
-                    url = entry['Url']
-                    if url in basic_meta:
-                        entry.update(basic_meta[url])
-                    else:
-                        basic_data = metadata.from_container(item)
-                        entry.update(basic_data)
-                        basic_meta[url] = basic_data
-
-                data.append(entry)
+            auth_handler.add_password('TiVo DVR', tivoIP, 'tivo', tivo_mak)
+            container = npl_mirror.get(tivoIP, folder)
+            if not container:
+                handler.redir(UNABLE % tivoIP, 10)
+                return
+            items = container['items']
+
+            # Same paging as the TiVo: the page starts AnchorOffset + 1
+            # items after AnchorItem
+            start = 0
+            if 'AnchorItem' in query:
+                anchor = query['AnchorItem'][0]
+                for i, entry in enumerate(items):
+                    if entry['Anchor'] == anchor:
+                        start = i + getint(query.get('AnchorOffset',
+                                                     ['0'])[0]) + 1
+                        break
+            start = max(min(start, len(items) - 1), 0)
+
+            data = items[start:start + shows_per_page]
+            TotalItems = container['total']
+            ItemStart = start
+            ItemCount = len(data)
+            title = container['title']
+            if data:
+                FirstAnchor = data[0]['Anchor']
         else:
             data = []
             tivoIP = ''
@@ -192,15 +142,14 @@ class ToGo(Plugin):
             title = ''
 
         if useragent.lower().find('mobile') > 0:
-            t = Template(CONTAINER_TEMPLATE_MOBILE, filter=EncodeUnicode)
+            t = tmplcache.get(CONTAINER_TEMPLATE_MOBILE)(
+                filter=EncodeUnicode)
         else:
-            t = Template(CONTAINER_TEMPLATE, filter=EncodeUnicode)
+            t = tmplcache.get(CONTAINER_TEMPLATE)(filter=EncodeUnicode)
         t.escape = escape
         t.quote = quote
         t.folder = folder
-        t.status = status
-        if tivoIP in queue:
-            t.queue = queue[tivoIP]
+        t.status = download_queue.by_url()
         t.has_tivodecode = has_tivodecode
         t.tname = tivo_name
         t.tivoIP = tivoIP
@@ -215,112 +164,182 @@ class ToGo(Plugin):
         t.title = title
         handler.send_html(str(t), refresh='300')
 
-    def get_tivo_file(self, tivoIP, url, mak, togo_path):
-        # global status
-        status[url].update({'running': True, 'queued': False})
+    def get_tivo_file(self, job, downloads):
+        """Fetch one recording, for the download queue. A raw .TiVo file
+           is written to "name.part" first, and renamed when it's done;
+           if it's interrupted, the next attempt (or the next run, after
+           a restart) asks the TiVo for just the rest, with a Range
+           header, and starts over only if that isn't honored."""
+        url = job['url']
+        tivoIP = job['tivoIP']
+        mak = config.get_tsn('tivo_mak', job['tsn'])
 
         parse_url = urlparse.urlparse(url)
 
         name = unquote(parse_url[2])[10:].split('.')
         id = unquote(parse_url[4]).split('id=')[1]
         name.insert(-1, ' - ' + id + '.')
-        if status[url]['decode']:
-            name[-1] = 'mpg'
-        outfile = os.path.join(togo_path, ''.join(name))
-
-        if status[url]['save']:
-            meta = basic_meta[url]
-            details_url = 'https://%s/TiVoVideoDetails?id=%s' % (tivoIP, id)
-            try:
-                handle = self.tivo_open(details_url)
-                meta.update(metadata.from_details(handle))
-                handle.close()
-            except:
-                pass
-            metafile = open(outfile + '.txt', 'w')
-            metadata.dump(metafile, meta)
-            metafile.close()
+        stages = self.stages(job, mak)
+        if job['decode']:
+            name[-1] = config.get_server('togo_remux', '') or 'mpg'
+        outfile = os.path.join(job['togo_path'], ''.join(name))
+        partfile = outfile + '.part'
 
+        tivo_name = config.tivo_names[config.tivos_by_ip(tivoIP)]
         auth_handler.add_password('TiVo DVR', url, 'tivo', mak)
-        try:
-            handle = self.tivo_open(url)
-        except urllib2.HTTPError, e:
-            status[url]['running'] = False
-            status[url]['error'] = e.code
-            logger.error(e.code)
-            return
-        except urllib2.URLError, e:
-            status[url]['running'] = False
-            status[url]['error'] = e.reason
-            logger.error(e.reason)
-            return
 
-        tivo_name = config.tivo_names[config.tivos_by_ip(tivoIP)]
+        start_time = time.time()
+        size = 0
+        error = ''
+        running = True
+        for attempt in xrange(TRIES):
+            if attempt:
+                time.sleep(RETRY_WAIT)
+
+            offset = 0
+            if not job['decode'] and os.path.exists(partfile):
+                offset = os.path.getsize(partfile)
+            request = urllib2.Request(url)
+            if offset:
+                request.add_header('Range', 'bytes=%d-' % offset)
 
-        logger.info('[%s] Start getting "%s" from %s' %
-                    (time.strftime('%d/%b/%Y %H:%M:%S'), outfile, tivo_name))
+            try:
+                handle = self.tivo_open(request)
+            except urllib2.HTTPError, e:
+                error = e.code
+                logger.error(e.code)
+                if e.code == 416 and offset:
+                    os.remove(partfile)     # Start over
+                    continue
+                break
+            except urllib2.URLError, e:
+                error = e.reason
+                logger.error(e.reason)
+                continue
+
+            if offset:
+                crange = handle.info().getheader('Content-Range', '')
+                if (getattr(handle, 'code', 200) != 206 or
+                    not crange.startswith('bytes %d-' % offset)):
+                    offset = 0      # Not honored
+            try:
+                total = offset + int(handle.info().getheader('Content-Length'))
+            except (TypeError, ValueError):
+                total = 0
+
+            if offset:
+                logger.info('[%s] Resume getting "%s" from %s at %d' %
+                            (time.strftime('%d/%b/%Y %H:%M:%S'), outfile,
+                             tivo_name, offset))
+            else:
+                logger.info('[%s] Start getting "%s" from %s' %
+                            (time.strftime('%d/%b/%Y %H:%M:%S'), outfile,
+                             tivo_name))
 
-        if status[url]['decode']:
-            tivodecode_path = config.get_bin('tivodecode')
-            tcmd = [tivodecode_path, '-m', mak, '-o', outfile, '-']
-            tivodecode = subprocess.Popen(tcmd, stdin=subprocess.PIPE,
-                                          bufsize=(512 * 1024))
-            f = tivodecode.stdin
-        else:
-            f = open(outfile, 'wb')
-        length = 0
-        start_time = time.time()
-        last_interval = start_time
-        now = start_time
-        try:
-            while status[url]['running']:
-                output = handle.read(1024000)
-                if not output:
-                    break
-                length += len(output)
-                f.write(output)
-                now = time.time()
-                elapsed = now - last_interval
-                if elapsed >= 5:
-                    status[url]['rate'] = '%.2f Mb/s' % (length * 8.0 / 
-                        (elapsed * 1024 * 1024))
-                    status[url]['size'] += length
-                    length = 0
-                    last_interval = now
-            if status[url]['running']:
-                status[url]['finished'] = True
-        except Exception, msg:
-            status[url]['running'] = False
-            logger.info(msg)
-        handle.close()
-        f.close()
-        status[url]['size'] += length
-        if status[url]['running']:
-            mega_elapsed = (now - start_time) * 1024 * 1024
+            try:
+                if stages:
+                    f = Pipeline(stages, outfile)
+                elif offset:
+                    f = open(partfile, 'ab')
+                else:
+                    f = open(partfile, 'wb')
+            except (IOError, OSError), msg:
+                handle.close()
+                error = str(msg)
+                logger.error(msg)
+                break
+
+            downloads.running(job, total, offset)
+            error = ''
+            try:
+                while running:
+                    output = handle.read(BLOCKSIZE)
+                    if not output:
+                        break
+                    f.write(output)
+                    running = downloads.progress(job, len(output))
+            except Exception, msg:
+                error = str(msg)
+                logger.info(msg)
+            handle.close()
+            if not stages:
+                f.close()
+            elif not running:
+                f.kill()
+            else:
+                error = f.close() or error
+            size = job['bytes']
+
+            if running and not error and total and size < total:
+                error = 'Transfer ended after %d of %d bytes' % (size, total)
+                logger.info(error)
+            if not running or not error:
+                break
+
+        if not running:
+            remove = [partfile]
+            if stages:
+                remove = [outfile]
+            for name in remove:
+                if os.path.exists(name):
+                    os.remove(name)
+            logger.info('[%s] Transfer of "%s" from %s aborted' %
+                        (time.strftime('%d/%b/%Y %H:%M:%S'), outfile,
+                         tivo_name))
+        elif not error:
+            if not job['decode']:
+                if os.path.exists(outfile):
+                    os.remove(outfile)
+                os.rename(partfile, outfile)
+            mega_elapsed = (time.time() - start_time) * 1024 * 1024
             if mega_elapsed < 1:
                 mega_elapsed = 1
-            size = status[url]['size']
             rate = size * 8.0 / mega_elapsed
             logger.info('[%s] Done getting "%s" from %s, %d bytes, %.2f Mb/s' %
                         (time.strftime('%d/%b/%Y %H:%M:%S'), outfile,
                          tivo_name, size, rate))
-            status[url]['running'] = False
-        else:
-            os.remove(outfile)
-            if status[url]['save']:
-                os.remove(outfile + '.txt')
-            logger.info('[%s] Transfer of "%s" from %s aborted' %
-                        (time.strftime('%d/%b/%Y %H:%M:%S'), outfile,
-                         tivo_name))
-            del status[url]
-
-    def process_queue(self, tivoIP, mak, togo_path):
-        while queue[tivoIP]:
-            time.sleep(5)
-            url = queue[tivoIP][0]
-            self.get_tivo_file(tivoIP, url, mak, togo_path)
-            queue[tivoIP].pop(0)
-        del queue[tivoIP]
+            if job['save']:
+                self.write_metadata(job, id, outfile)
+        downloads.finish(job, error)
+
+    def stages(self, job, mak):
+        """The processes a download is streamed through on its way to
+           disk (see pipeline.py); none for a raw .TiVo file. Each is a
+           function taking the output file name, or None for stdout, and
+           returning the command line."""
+        stages = []
+        if job['decode']:
+            tivodecode_path = config.get_bin('tivodecode')
+            def decode(outfile):
+                return [tivodecode_path, '-m', mak, '-o', outfile or '-', '-']
+            stages.append(decode)
+
+            if config.get_server('togo_remux', ''):
+                ffmpeg_path = config.get_bin('ffmpeg')
+                def remux(outfile):
+                    cmd = [ffmpeg_path, '-i', '-', '-vcodec', 'copy',
+                           '-acodec', 'copy']
+                    if outfile:
+                        return cmd + ['-y', outfile]
+                    return cmd + ['-f', 'mpegts', '-']
+                stages.append(remux)
+        return stages
+
+    def write_metadata(self, job, id, outfile):
+        """Save what's known about the program, from the Now Playing
+           List and the TiVo's details page, in a .txt file alongside
+           the download."""
+        meta = job.get('meta', {})
+        details_url = 'https://%s/TiVoVideoDetails?id=%s' % (job['tivoIP'], id)
+        try:
+            handle = self.tivo_open(details_url)
+            meta.update(metadata.from_details(handle))
+            handle.close()
+        except:
+            pass
+        metafile = open(outfile + '.txt', 'w')
+        metadata.dump(metafile, meta)
+        metafile.close()
 
     def ToGo(self, handler, query):
         togo_path = config.get_server('togo_path')
@@ -330,20 +349,14 @@ class ToGo(Plugin):
         if togo_path:
             tivoIP = query['TiVo'][0]
             tsn = config.tivos_by_ip(tivoIP)
-            tivo_mak = config.get_tsn('tivo_mak', tsn)
             urls = query.get('Url', [])
             decode = 'decode' in query
             save = 'save' in query
             for theurl in urls:
-                status[theurl] = {'running': False, 'error': '', 'rate': '',
-                                  'queued': True, 'size': 0, 'finished': False,
-                                  'decode': decode, 'save': save}
-                if tivoIP in queue:
-                    queue[tivoIP].append(theurl)
-                else:
-                    queue[tivoIP] = [theurl]
-                    thread.start_new_thread(ToGo.process_queue,
-                                            (self, tivoIP, tivo_mak, togo_path))
+                download_queue.add({'url': theurl, 'tivoIP': tivoIP,
+                                    'tsn': tsn, 'togo_path': togo_path,
+                                    'decode': decode, 'save': save,
+                                    'meta': npl_mirror.meta(theurl)})
                 logger.info('[%s] Queued "%s" for transfer to %s' %
                             (time.strftime('%d/%b/%Y %H:%M:%S'),
                              unquote(theurl), togo_path))
@@ -355,15 +368,13 @@ class ToGo(Plugin):
 
     def ToGoStop(self, handler, query):
         theurl = query['Url'][0]
-        status[theurl]['running'] = False
+        download_queue.stop(theurl)
         handler.redir(TRANS_STOP % unquote(theurl))
 
     def Unqueue(self, handler, query):
         theurl = query['Url'][0]
-        tivoIP = query['TiVo'][0]
-        del status[theurl]
-        queue[tivoIP].remove(theurl)
-        logger.info('[%s] Removed "%s" from queue' %
-                    (time.strftime('%d/%b/%Y %H:%M:%S'),
-                     unquote(theurl)))
+        if download_queue.remove(theurl):
+            logger.info('[%s] Removed "%s" from queue' %
+                        (time.strftime('%d/%b/%Y %H:%M:%S'),
+                         unquote(theurl)))
         handler.redir(UNQUEUE % unquote(theurl))
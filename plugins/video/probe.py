@@ -0,0 +1,347 @@
+"""Turn what FFmpeg (or ffprobe) says about a video file into the info
+dict used by transcode.video_info() and everything downstream of it.
+
+from_ffmpeg() reads the text "ffmpeg -i" writes to stderr. It makes one
+pass over the lines, trying each pattern only on lines that contain its
+keyword, and stops looking for each field once it's been found; the
+patterns are compiled once, here. The results are the same as searching
+the whole output with each pattern in turn, since none of them can
+match across lines.
+
+from_ffprobe() reads the JSON from "ffprobe -print_format json", which
+needs no pattern matching at all. It's used when an ffprobe binary can
+be found (see ffprobe()), and Python has the json module.
+
+Either way, the result has these keys:
+
+    Supported     - False if the container, video codec, size or frame
+                    rate couldn't be found
+    container     - FFmpeg's name for the format, e.g. 'mpeg' or 'mov'
+    vCodec, vWidth, vHeight, vFps ('29.97'), kbps (overall, as a string)
+    par1 ('32:27'), par2 (as a float), dar1 ('16:9'), par (None)
+    aCodec, aKbps, aFreq (strings), aCh (an int)
+    mapVideo      - the video stream's id, e.g. '0:0' or '0.0'
+    mapAudio      - (id, description) for each audio stream
+    millisecs     - the duration
+    rawmeta       - the container's metadata, {key: [value]}
+"""
+
+import logging
+import re
+import sys
+
+try:
+    import json
+except ImportError:
+    json = None
+
+import config
+
+logger = logging.getLogger('pyTivo.video.probe')
+
+FFPROBE_ARGS = ['-v', 'quiet', '-print_format', 'json', '-show_format',
+                '-show_streams']
+
+# (key, keyword, pattern); the first line containing the keyword that
+# the pattern matches gives the value. "match" patterns start with ".*",
+# so re.match() on the line is the same as re.search() on the output.
+PATTERNS = [
+    ('container', 'Input #0, ', re.compile(r'Input #0, ([^,]+),').search),
+    ('vCodec', 'Video: ', re.compile(r'Video: ([^, ]+)').search),
+    ('aKbps', 'Audio: ', re.compile(r'.*Audio: .+, (.+) (?:kb/s).*').match),
+    ('aCodec', 'Audio: ', re.compile(r'.*Audio: ([^, ]+)').match),
+    ('aFreq', 'Audio: ', re.compile(r'.*Audio: .+, (.+) (?:Hz).*').match),
+    ('mapVideo', ': Video:',
+     re.compile(r'([0-9]+[.:]+[0-9]+).*: Video:.*').search),
+    ('aCh', 'Audio: ', re.compile(r'.*Audio: .+, (?:(\d+)(?:(?:\.(\d).*)?'
+                                  r'(?: channels.*)?)|(stereo|mono)),.*').match),
+    ('size', 'Video: ', re.compile(r'.*Video: .+, (\d+)x(\d+)[, ].*').match),
+    ('vFps', 'Video: ',
+     re.compile(r'.*Video: .+, (.+) (?:fps|tb\(r\)|tbr).*').match),
+    ('duration', 'Duration: ', re.compile(r'.*Duration: ([0-9]+):([0-9]+):'
+                                          r'([0-9]+)\.([0-9]+),').match),
+    ('kbps', 'bitrate: ', re.compile(r'.*bitrate: (.+) (?:kb/s).*').match),
+    # Sample line:  Stream #0.0[0x1e0]: Video: mpeg2video, yuv420p,
+    #               720x480 [PAR 32:27 DAR 16:9], 9800 kb/s, 59.94 tb(r)
+    ('vKbps', 'Video: mpeg2video, ',
+     re.compile(r'.*Stream #0\.0\[.*\]: Video: mpeg2video, '
+                r'\S+, \S+ \[.*\], (\d+) (?:kb/s).*').match),
+    ('par', 'PAR ',
+     re.compile(r'.*Video: .+PAR ([0-9]+):([0-9]+) DAR [0-9:]+.*').match),
+    ('dar', 'DAR ', re.compile(r'.*Video: .+DAR ([0-9]+):([0-9]+).*').match)
+]
+
+AUDIO_MAP = re.compile(r'([0-9]+[.:]+[0-9]+)(.*): Audio:(.*)').search
+
+# Checked, on the lowercased output, for mpeg2 with a doubled frame rate
+FILM_SOURCE = re.compile(r'.*film source: 29.97.*').search
+FRAME_RATE_DIFFERS = re.compile(r'.*frame rate differs from container '
+                                r'frame rate: 29.97.*').search
+
+# Looked up once per config.reset(), since get_bin() warns every time
+# it fails
+ffprobe_path = [None, None]     # [config.bin_paths, path]
+
+def ffprobe():
+    """The path to ffprobe, if it can be found and used; else None."""
+    if ffprobe_path[0] is not config.bin_paths:
+        path = None
+        if json:
+            path = config.get_bin('ffprobe')
+        ffprobe_path[:] = [config.bin_paths, path]
+    return ffprobe_path[1]
+
+def decode(value):
+    try:
+        return value.decode('utf-8')
+    except:
+        if sys.platform == 'darwin':
+            return value.decode('macroman')
+        else:
+            return value.decode('iso8859-1')
+
+def from_ffmpeg(output):
+    """Read the stderr of "ffmpeg -i"."""
+    found = {}
+    pending = PATTERNS[:]
+    amap = []
+    rawmeta = {}
+    flag = False
+
+    for line in output.split('\n'):
+        if pending:
+            for item in pending[:]:
+                key, keyword, pattern = item
+                if keyword in line:
+                    x = pattern(line)
+                    if x:
+                        found[key] = x
+                        pending.remove(item)
+
+        if ': Audio:' in line:
+            x = AUDIO_MAP(line)
+            if x:
+                amap.append((x.group(1), x.group(2) + x.group(3)))
+
+        # Metadata dump (newer ffmpeg)
+        if line.startswith('  Metadata:'):
+            flag = True
+        elif flag:
+            if line.startswith('  Duration:'):
+                flag = False
+            else:
+                try:
+                    key, value = [x.strip() for x in line.split(':', 1)]
+                    rawmeta[key] = [decode(value)]
+                except:
+                    pass
+
+    vInfo = {'Supported': True}
+    for key in ('container', 'vCodec', 'aKbps', 'aCodec', 'aFreq',
+                'mapVideo'):
+        if key in found:
+            vInfo[key] = found[key].group(1)
+        else:
+            if key in ['container', 'vCodec']:
+                vInfo[key] = ''
+                vInfo['Supported'] = False
+            else:
+                vInfo[key] = None
+            logger.debug('failed at ' + key)
+
+    vInfo['aCh'] = None
+    if 'aCh' in found:
+        x = found['aCh']
+        if x.group(3):
+            if x.group(3) == 'stereo':
+                vInfo['aCh'] = 2
+            elif x.group(3) == 'mono':
+                vInfo['aCh'] = 1
+        elif x.group(2):
+            vInfo['aCh'] = int(x.group(1)) + int(x.group(2))
+        elif x.group(1):
+            vInfo['aCh'] = int(x.group(1))
+    if vInfo['aCh'] is None:
+        logger.debug('failed at aCh')
+
+    if 'size' in found:
+        x = found['size']
+        vInfo['vWidth'] = int(x.group(1))
+        vInfo['vHeight'] = int(x.group(2))
+    else:
+        vInfo['vWidth'] = ''
+        vInfo['vHeight'] = ''
+        vInfo['Supported'] = False
+        logger.debug('failed at vWidth/vHeight')
+
+    if 'vFps' in found:
+        vInfo['vFps'] = found['vFps'].group(1)
+        if '.' not in vInfo['vFps']:
+            vInfo['vFps'] += '.00'
+
+        # Allow override only if it is mpeg2 and frame rate was doubled
+        # to 59.94
+
+        if vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] != '29.97':
+            # First look for the build 7215 version
+            lower = output.lower()
+            if FILM_SOURCE(lower):
+                logger.debug('film source: 29.97 setting vFps to 29.97')
+                vInfo['vFps'] = '29.97'
+            else:
+                # for build 8047:
+                logger.debug('Bug in VideoReDo')
+                if FRAME_RATE_DIFFERS(lower):
+                    vInfo['vFps'] = '29.97'
+    else:
+        vInfo['vFps'] = ''
+        vInfo['Supported'] = False
+        logger.debug('failed at vFps')
+
+    if 'duration' in found:
+        d = found['duration']
+        vInfo['millisecs'] = ((int(d.group(1)) * 3600 +
+                               int(d.group(2)) * 60 +
+                               int(d.group(3))) * 1000 +
+                              int(d.group(4)) * (10 ** (3 - len(d.group(4)))))
+    else:
+        vInfo['millisecs'] = 0
+
+    # Bitrate of the source, for the TiVo compatibility test, with the
+    # video stream's bitrate as a fallback
+    if 'kbps' in found:
+        vInfo['kbps'] = found['kbps'].group(1)
+    elif 'vKbps' in found:
+        vInfo['kbps'] = found['vKbps'].group(1)
+    else:
+        vInfo['kbps'] = None
+        logger.debug('failed at kbps')
+
+    x = found.get('par')
+    if x and x.group(1) != "0" and x.group(2) != "0":
+        vInfo['par1'] = x.group(1) + ':' + x.group(2)
+        vInfo['par2'] = float(x.group(1)) / float(x.group(2))
+    else:
+        vInfo['par1'], vInfo['par2'] = None, None
+
+    x = found.get('dar')
+    if x and x.group(1) != "0" and x.group(2) != "0":
+        vInfo['dar1'] = x.group(1) + ':' + x.group(2)
+    else:
+        vInfo['dar1'] = None
+
+    if not amap:
+        amap.append(('', ''))
+        logger.debug('failed at mapAudio')
+    vInfo['mapAudio'] = amap
+
+    vInfo['par'] = None
+    vInfo['rawmeta'] = rawmeta
+    return vInfo
+
+def fps_string(rate):
+    # As FFmpeg prints it, plus the '.00' video_info() has always added
+    try:
+        num, den = [float(x) for x in rate.split('/')]
+        fps = num / den
+    except (ValueError, ZeroDivisionError):
+        return ''
+    if int(fps * 100 + 0.5) % 100:
+        return '%3.2f' % fps
+    return '%1.0f.00' % fps
+
+def ratio(value):
+    # '32:27' -> ('32', '27'), or None for nothing, or '0:1'
+    try:
+        num, den = str(value).split(':')
+        if int(num) and int(den):
+            return num, den
+    except (AttributeError, ValueError):
+        pass
+    return None
+
+def from_ffprobe(output):
+    """Read the JSON from ffprobe (run with FFPROBE_ARGS)."""
+    try:
+        data = json.loads(output)
+    except ValueError:
+        data = {}
+    format = data.get('format', {})
+    streams = data.get('streams', [])
+    video = [s for s in streams if s.get('codec_type') == 'video']
+    audio = [s for s in streams if s.get('codec_type') == 'audio']
+
+    vInfo = {'Supported': True, 'par': None}
+    vInfo['container'] = str(format.get('format_name', '').split(',')[0])
+
+    if video:
+        v = video[0]
+        vInfo['vCodec'] = str(v.get('codec_name', ''))
+        vInfo['vWidth'] = v.get('width', '')
+        vInfo['vHeight'] = v.get('height', '')
+        vInfo['vFps'] = fps_string(v.get('r_frame_rate', ''))
+        # As in from_ffmpeg(): film source with pulldown shows up as
+        # 59.94 fields; the average rate gives the real 29.97
+        if (vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] != '29.97'
+            and fps_string(v.get('avg_frame_rate', '')) == '29.97'):
+            logger.debug('film source: 29.97 setting vFps to 29.97')
+            vInfo['vFps'] = '29.97'
+        vInfo['mapVideo'] = '0:%d' % v['index']
+        par = ratio(v.get('sample_aspect_ratio'))
+        dar = ratio(v.get('display_aspect_ratio'))
+    else:
+        vInfo.update({'vCodec': '', 'vWidth': '', 'vHeight': '',
+                      'vFps': '', 'mapVideo': None})
+        par = dar = None
+
+    for key in ('container', 'vCodec', 'vWidth', 'vFps'):
+        if not vInfo[key]:
+            vInfo['Supported'] = False
+            logger.debug('failed at ' + key)
+
+    if par:
+        vInfo['par1'] = ':'.join(par)
+        vInfo['par2'] = float(par[0]) / float(par[1])
+    else:
+        vInfo['par1'], vInfo['par2'] = None, None
+    vInfo['dar1'] = dar and ':'.join(dar) or None
+
+    if audio:
+        a = audio[0]
+        vInfo['aCodec'] = str(a.get('codec_name', '')) or None
+        vInfo['aFreq'] = str(a.get('sample_rate', '')) or None
+        vInfo['aCh'] = a.get('channels')
+        vInfo['aKbps'] = None
+        if a.get('bit_rate'):
+            vInfo['aKbps'] = str(int(a['bit_rate']) / 1000)
+    else:
+        vInfo.update({'aCodec': None, 'aFreq': None, 'aCh': None,
+                      'aKbps': None})
+
+    # Stream id and a description like FFmpeg's, which is where
+    # select_audiolang() looks for the language
+    amap = []
+    for a in audio:
+        desc = ' ' + ', '.join([str(x) for x in
+                                (a.get('codec_name'), a.get('sample_rate'),
+                                 a.get('channel_layout')) if x])
+        lang = a.get('tags', {}).get('language')
+        if lang:
+            desc = '(%s)' % str(lang) + desc
+        amap.append(('0:%d' % a['index'], desc))
+    if not amap:
+        amap.append(('', ''))
+    vInfo['mapAudio'] = amap
+
+    try:
+        vInfo['millisecs'] = int(float(format['duration']) * 1000)
+    except (KeyError, ValueError):
+        vInfo['millisecs'] = 0
+
+    vInfo['kbps'] = None
+    if format.get('bit_rate'):
+        vInfo['kbps'] = str(int(format['bit_rate']) / 1000)
+
+    vInfo['rawmeta'] = dict((str(key), [value]) for key, value in
+                            format.get('tags', {}).items())
+    return vInfo
@@ -0,0 +1,182 @@
+"""Queue of recordings to push to TiVos.
+
+Each push goes through two stages. First, one of a pool of worker
+threads ("push_threads" of them) prepares the file -- checking it,
+remuxing it if that helps, and reading its metadata -- so several files
+are prepared at once. Then a single thread hands them to the Mind
+server, one at a time, in the order they become ready.
+
+If cache_dir is set, the queue is also kept in a journal there, so any
+pushes still pending when pyTivo stops are picked up again the next
+time the video plugin starts.
+"""
+
+import Queue
+import logging
+import threading
+import time
+
+import config
+import journal
+import scheduler
+
+logger = logging.getLogger('pyTivo.video.pushqueue')
+
+JOURNAL = 'push_queue'
+
+class PushQueue(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.jobs = []      # In the order they were added
+        self.prep = Queue.Queue()
+        self.ready = Queue.Queue()
+        self.plugin = None
+        self.workers = 0
+        self.submitting = False
+        self.next_id = 1
+
+    def threads(self):
+        try:
+            return max(int(config.get_server('push_threads', 2)), 1)
+        except ValueError:
+            return 1
+
+    def start(self, plugin):
+        """Set the plugin whose prep_push() and submit_push() methods do
+           the work, and reload anything left in the journal. Only the
+           first call has any effect."""
+        self.lock.acquire()
+        try:
+            if self.plugin:
+                return
+            self.plugin = plugin
+            jobs = self.load()
+            for job in jobs:
+                self._add(job)
+            if jobs:
+                logger.info('Resuming %d queued pushes' % len(jobs))
+                self._start_threads()
+        finally:
+            self.lock.release()
+
+    def add(self, job):
+        """Queue a push. job is a dict with at least 'path', 'name',
+           'tsn' and 'url'."""
+        self.lock.acquire()
+        try:
+            job = dict(job)
+            job.pop('push', None)
+            self._add(job)
+            self.save()
+            self._start_threads()
+        finally:
+            self.lock.release()
+
+    def _add(self, job):
+        # Called with the lock held. Jobs that were already prepared
+        # before a restart go straight to the Mind stage.
+        job['id'] = self.next_id
+        self.next_id += 1
+        job['added'] = job.get('added', time.time())
+        self.jobs.append(job)
+        if job.get('push'):
+            job['state'] = 'ready'
+            self.ready.put(job)
+        else:
+            job['state'] = 'queued'
+            self.prep.put(job)
+
+    def _start_threads(self):
+        # Called with the lock held
+        while self.workers < self.threads():
+            self.workers += 1
+            t = threading.Thread(target=self.work, name='push prep')
+            t.setDaemon(True)
+            t.start()
+        if not self.submitting:
+            self.submitting = True
+            t = threading.Thread(target=self.submit, name='push submit')
+            t.setDaemon(True)
+            t.start()
+
+    def set_state(self, job, state):
+        self.lock.acquire()
+        try:
+            job['state'] = state
+            self.save()
+        finally:
+            self.lock.release()
+
+    def finish(self, job):
+        self.lock.acquire()
+        try:
+            if job in self.jobs:
+                self.jobs.remove(job)
+            self.save()
+        finally:
+            self.lock.release()
+
+    def work(self):
+        # Prep runs FFmpeg, but nobody is waiting on the result right now
+        scheduler.set_background()
+        while True:
+            self.lock.acquire()
+            try:
+                if self.workers > self.threads():
+                    self.workers -= 1
+                    return
+            finally:
+                self.lock.release()
+
+            job = self.prep.get()
+            self.set_state(job, 'preparing')
+            try:
+                push = self.plugin.prep_push(job)
+            except Exception:
+                logger.exception('Unable to prepare %s for Push' %
+                                 unicode(job['path'], 'utf-8', 'replace'))
+                self.finish(job)
+                continue
+
+            self.lock.acquire()
+            try:
+                job['push'] = push
+                job['state'] = 'ready'
+                self.save()
+            finally:
+                self.lock.release()
+            self.ready.put(job)
+
+    def submit(self):
+        while True:
+            job = self.ready.get()
+            self.set_state(job, 'submitting')
+            try:
+                self.plugin.submit_push(job)
+            except Exception, msg:
+                logger.error('Push of %s failed -- %s' %
+                             (unicode(job['path'], 'utf-8', 'replace'), msg))
+            self.finish(job)
+
+    def status(self):
+        self.lock.acquire()
+        try:
+            return [dict(job) for job in self.jobs]
+        finally:
+            self.lock.release()
+
+    def load(self):
+        # Called with the lock held
+        return journal.load(JOURNAL, [])
+
+    def save(self):
+        # Called with the lock held
+        jobs = []
+        for job in self.jobs:
+            job = dict(job)
+            del job['id']
+            jobs.append(job)
+        journal.save(JOURNAL, jobs)
+
+push_queue = PushQueue()
@@ -68,12 +68,17 @@ import struct
 
 from StringIO import StringIO
 
-VERSION = "1.7wjm3"
-CHUNK_SIZE = 8192
+import config
+import zerocopy
+from lrucache import LRUCache, CacheKeyError
+
+VERSION = "1.7wjm4"
+DEFAULT_CACHE = '64Mi'
 
 log = logging.getLogger('pyTivo.video.qt-faststart')
 
-count = 0
+# Rewritten layouts, by file, bounded by "faststart_cache_size"
+layout_cache = LRUCache(1000, maxbytes=0, sizeof=lambda x: x.nbytes)
 
 class FastStartException(Exception):
     pass
@@ -169,23 +174,60 @@ def find_atoms(size, datastream):
             # Ignore this atom, seek to the end of it.
             datastream.seek(atom_size - 8, os.SEEK_CUR)
 
-def output(outfile, skip, data):
-    global count
-    length = len(data)
-    if count + length > skip:
-        if skip > count:
-            data = data[skip - count:]
-        outfile.write(data)
-    count += length
-
-def process(datastream, outfile, skip=0):
+class Layout(object):
     """
-        Convert a Quicktime/MP4 file for streaming by moving the metadata to
-        the front of the file. This method writes a new file.
+        The faststart version of a file, as a list of segments: either
+        bytes to send as they are (the ftyp and patched moov atoms), or
+        a (position, size) range to copy from the original file, in
+        which size may be None, for "to the end". The segments are in
+        output order, so any offset in the output maps directly to a
+        place in one of them.
     """
 
-    global count
-    count = 0
+    def __init__(self, segments):
+        self.segments = segments
+        # Memory used, for the cache's budget
+        self.nbytes = 64 * len(segments)
+        for segment in segments:
+            if isinstance(segment, str):
+                self.nbytes += len(segment)
+
+    def send(self, datastream, outfile, skip=0):
+        """
+            Write the output, from skip bytes in, to outfile. Returns the
+            number of bytes written.
+        """
+        sent = 0
+        for segment in self.segments:
+            if isinstance(segment, str):
+                if skip < len(segment):
+                    outfile.write(segment[skip:])
+                    sent += len(segment) - skip
+                    skip = 0
+                else:
+                    skip -= len(segment)
+                continue
+
+            pos, size = segment
+            if size is None:
+                size = os.fstat(datastream.fileno()).st_size - pos
+            if skip < size:
+                count = zerocopy.sendfile(outfile, datastream, pos + skip,
+                                          size - skip)
+                sent += count
+                if count < size - skip:
+                    break   # The file got shorter
+                skip = 0
+            else:
+                skip -= size
+        return sent
+
+def get_layout(datastream):
+    """
+        Work out the faststart version of an open file -- moving the
+        moov atom ahead of mdat and patching its chunk offsets to match
+        -- and return it as a Layout.
+    """
 
     # Get the top level atom index
     index = get_index(datastream)
@@ -219,13 +261,7 @@ def process(datastream, outfile, skip=0):
         if not free_size:
             # No free atoms and moov is correct, we are done!
             log.debug('mp4 already streamable -- copying')
-            datastream.seek(skip)
-            while True:
-                block = datastream.read(CHUNK_SIZE)
-                if not block:
-                    break
-                output(outfile, 0, block)
-            return count
+            return Layout([(0, None)])
 
     # Read and fix moov
     datastream.seek(moov_pos)
@@ -252,28 +288,52 @@ def process(datastream, outfile, skip=0):
         moov.write(struct.pack(">" + ctype * entry_count,
                                *[entry + offset for entry in entries]))
 
-    log.info("Writing output...")
-
-    # Write ftype
+    # ftyp, then moov, then the rest
+    segments = []
     for atom, pos, size in index:
         if atom == "ftyp":
             datastream.seek(pos)
-            output(outfile, skip, datastream.read(size))
+            segments.append(datastream.read(size))
 
-    # Write moov
-    moov.seek(0)
-    output(outfile, skip, moov.read())
+    segments.append(moov.getvalue())
 
-    # Write the rest
-    atoms = [item for item in index if item[0] not in ["ftyp", "moov", "free"]]
-    for atom, pos, size in atoms:
-        datastream.seek(pos)
+    for atom, pos, size in index:
+        if atom in ["ftyp", "moov", "free"]:
+            continue
+        if not size and atom == "mdat":
+            segments.append((pos, None))
+        elif size:
+            segments.append((pos, size))
 
-        # Write in chunks to not use too much memory
-        for x in range(size / CHUNK_SIZE):
-            output(outfile, skip, datastream.read(CHUNK_SIZE))
+    return Layout(segments)
 
-        if size % CHUNK_SIZE:
-            output(outfile, skip, datastream.read(size % CHUNK_SIZE))
+def cached_layout(datastream, key):
+    """
+        get_layout(), through a cache. key should change whenever the
+        file does -- e.g. (path, size, mtime).
+    """
+    try:
+        return layout_cache[key]
+    except CacheKeyError:
+        pass
+    layout = get_layout(datastream)
+    # The setting can change on a soft reset
+    limit = config.get_server_size('faststart_cache_size', DEFAULT_CACHE)
+    if limit != layout_cache.maxbytes:
+        layout_cache.maxbytes = limit
+    layout_cache[key] = layout
+    return layout
+
+def process(datastream, outfile, skip=0, key=None):
+    """
+        Convert a Quicktime/MP4 file for streaming by moving the metadata to
+        the front of the file, writing the result to outfile, starting skip
+        bytes in. If a key is given, the layout is cached under it.
+    """
+    if key is None:
+        layout = get_layout(datastream)
+    else:
+        layout = cached_layout(datastream, key)
 
-    return count - skip
+    log.info("Writing output...")
+    return layout.send(datastream, outfile, skip)
@@ -1,7 +1,6 @@
 import logging
 import math
 import os
-import re
 import shlex
 import shutil
 import subprocess
@@ -13,19 +12,30 @@ import time
 import lrucache
 
 import config
+import mediaindex
 import metadata
+import procrun
+import scheduler
+from procrun import kill
+from plugins.video import probe
 
 logger = logging.getLogger('pyTivo.video.transcode')
 
 info_cache = lrucache.LRUCache(1000)
-ffmpeg_procs = {}
-reapers = {}
+probe_index = mediaindex.MediaIndex('video_info')
+ffmpeg_procs = {}       # (file, mime, command, header) -> [Session, ...]
+procs_lock = threading.Lock()
+spool_bytes = 0         # Disk used by all sessions' spools
+spool_lock = threading.Lock()
 
 GOOD_MPEG_FPS = ['23.98', '24.00', '25.00', '29.97',
                  '30.00', '50.00', '59.94', '60.00']
 
 BLOCKSIZE = 512 * 1024
-MAXBLOCKS = 2
+MAXBLOCKS = 2       # Blocks kept behind the slowest client, for resuming
+RINGBLOCKS = 16     # Most blocks held per session
+STALL = 30          # Seconds a full ring waits on a slow client
+GRACE = 30          # Seconds an abandoned run keeps its live job slot
 TIMEOUT = 600
 
 UNSET = 0
@@ -59,7 +69,7 @@ def debug(msg):
                 msg = msg.decode('iso8859-1')
     logger.debug(msg)
 
-def transcode(isQuery, inFile, outFile, tsn='', mime='', thead=''):
+def transcode(isQuery, inFile, outFile, tsn='', mime='', thead='', offset=0):
     settings = {'video_codec': select_videocodec(inFile, tsn, mime),
                 'video_br': select_videobr(inFile, tsn),
                 'video_fps': select_videofps(inFile, tsn),
@@ -79,6 +89,46 @@ def transcode(isQuery, inFile, outFile, tsn='', mime='', thead=''):
 
     ffmpeg_path = config.get_bin('ffmpeg')
     cmd_string = config.getFFmpegTemplate(tsn) % settings
+
+    # Clients asking for exactly the same output share one process
+    key = (inFile, mime, cmd_string, thead)
+    idle = []
+    job = None
+    while True:
+        procs_lock.acquire()
+        try:
+            session, reader = find_session(key, offset)
+            if session and not offset:
+                debug('sharing transcode of %s' % inFile)
+            if session or offset:
+                break
+            if job:
+                # Starting over, so any abandoned runs can go
+                idle = [x for x in ffmpeg_procs.get(key, []) if not x.cursors]
+                session = Session(key, start_process(inFile, tsn, ffmpeg_path,
+                                                     cmd_string), thead, job)
+                ffmpeg_procs.setdefault(key, []).append(session)
+                reader = session.attach(0)
+                job = None
+                break
+        finally:
+            procs_lock.release()
+        # Wait for a slot outside the lock, then look again, in case
+        # someone else started the same transcode meanwhile
+        job = scheduler.acquire('live', os.path.basename(inFile))
+        if not job:
+            break       # Too busy; the client gets an empty stream
+
+    scheduler.release(job)
+    if not session:
+        return 0
+
+    for x in idle:
+        x.close()
+
+    return session.send(outFile, reader)
+
+def start_process(inFile, tsn, ffmpeg_path, cmd_string):
     fname = unicode(inFile, 'utf-8')
     if mswindows:
         fname = fname.encode('iso8859-1')
@@ -106,106 +156,364 @@ def transcode(isQuery, inFile, outFile, tsn='', mime='', thead=''):
         debug('transcoding to tivo model ' + tsn[:3] + ' using ffmpeg command:')
         debug(' '.join(cmd))
 
-    ffmpeg_procs[inFile] = {'process': ffmpeg, 'start': 0, 'end': 0,
-                            'last_read': time.time(), 'blocks': []}
-    if thead:
-        ffmpeg_procs[inFile]['blocks'].append(thead)
-    reap_process(inFile)
-    return resume_transfer(inFile, outFile, 0)
-
-def is_resumable(inFile, offset):
-    if inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['start'] <= offset < proc['end']:
-            return True
-        else:
-            cleanup(inFile)
-            kill(proc['process'])
+    return ffmpeg
+
+def find_session(key, offset):
+    # Called with procs_lock held
+    for session in ffmpeg_procs.get(key, []):
+        reader = session.attach(offset)
+        if reader:
+            return session, reader
+    return None, None
+
+def is_resumable(inFile, offset, tsn='', mime='', thead=''):
+    # Matched without the command, which can't be worked out here
+    # without the audio check that the transcode itself runs
+    idle = []
+    procs_lock.acquire()
+    try:
+        for key, sessions in ffmpeg_procs.items():
+            if (key[0], key[1], key[3]) != (inFile, mime, thead):
+                continue
+            for session in sessions:
+                if session.covers(offset):
+                    return True
+                if not session.cursors:
+                    idle.append(session)
+    finally:
+        procs_lock.release()
+
+    # The client has moved on, so nobody will want these
+    for session in idle:
+        session.close()
     return False
 
-def resume_transfer(inFile, outFile, offset):
-    proc = ffmpeg_procs[inFile]
-    offset -= proc['start']
-    count = 0
+def resume_transfer(inFile, outFile, offset, tsn='', mime='', thead=''):
+    return transcode(False, inFile, outFile, tsn, mime, thead, offset)
+
+class Session(object):
+    """One ffmpeg (or tivodecode) run, shared by every client that asks
+       for the same output. A pump thread reads the output into a ring
+       of recent blocks, and each client follows along with its own
+       cursor. The ring only advances once every client has moved at
+       least MAXBLOCKS blocks past its oldest block, so a slow client
+       holds back the encode rather than losing data -- up to STALL
+       seconds, after which it's cut loose. With no clients attached,
+       the ring is kept as it is, so that a client can resume, until
+       TIMEOUT seconds go by -- though after GRACE seconds its live job
+       slot is given up, so it doesn't hold up other streams.
+
+       If "transcode_spool" is set, the output is also written to a
+       temporary file, within that overall disk budget. Any offset
+       already spooled can then be sent (or resumed from) regardless of
+       the ring, and the ring no longer waits for slow clients.
+    """
+
+    def __init__(self, key, process, thead='', job=None):
+        self.key = key
+        self.process = process
+        self.job = job
+        self.cond = threading.Condition()
+        self.blocks = []
+        self.start = 0
+        self.end = 0
+        self.cursors = {}
+        self.next_reader = 1
+        self.done = False
+        self.eof = False
+        self.closed = False
+        self.last_used = time.time()
+        self.spool = None
+        self.spool_end = 0
+        self.spooled = 0
+        self.spool_full = False
+        self.spool_lock = threading.Lock()
+        if config.get_server_size('transcode_spool', '0'):
+            try:
+                self.spool = tempfile.TemporaryFile(
+                    dir=config.get_cache_dir('spool'))
+            except (IOError, OSError), msg:
+                logger.error('Unable to create transcode spool -- %s' % msg)
+        if thead:
+            self.blocks.append(thead)
+            self.end = len(thead)
+            if self.write_spool(thead):
+                self.spool_end = self.end
+
+        t = threading.Thread(target=self.pump, name='transcode pump')
+        t.setDaemon(True)
+        t.start()
+        self.reaper = threading.Timer(TIMEOUT, self.reap)
+        self.reaper.start()
+
+    def covers(self, offset):
+        # Called with the condition held, or for a rough answer
+        return (not self.closed and
+                (self.start <= offset or offset < self.spool_end) and
+                offset <= self.end and not (self.done and offset == self.end))
+
+    def finished(self):
+        # Called with the condition held. A fully spooled run is kept
+        # for resuming, until the reaper gets it.
+        return (self.done and not self.cursors and
+                not (self.eof and self.spool and self.spool_end == self.end))
+
+    def attach(self, offset):
+        """Add a client starting at offset. Returns its reader id, or None
+           if offset is no longer (or not yet) available."""
+        self.cond.acquire()
+        try:
+            if not self.covers(offset):
+                return None
+            reader = self.next_reader
+            self.next_reader += 1
+            self.cursors[reader] = offset
+            return reader
+        finally:
+            self.cond.release()
+
+    def detach(self, reader):
+        self.cond.acquire()
+        try:
+            del self.cursors[reader]
+            self.last_used = time.time()
+            finished = self.finished()
+            idle = not self.cursors and not self.done
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+        if finished:
+            self.close()
+        elif idle:
+            t = threading.Timer(GRACE, self.release_idle)
+            t.setDaemon(True)
+            t.start()
+
+    def release_idle(self):
+        # Nobody has come back, so give up the live job slot; the run is
+        # still kept for resuming, until the reaper gets it
+        self.cond.acquire()
+        try:
+            idle = (not self.cursors and
+                    self.last_used + GRACE <= time.time() + 1)
+        finally:
+            self.cond.release()
+        if idle:
+            scheduler.release(self.job)
+
+    def send(self, outFile, reader):
+        """Send the output from the reader's cursor, as HTTP chunks, until
+           it ends or the client goes away. Returns the bytes sent."""
+        count = 0
+        try:
+            while True:
+                self.cond.acquire()
+                try:
+                    offset = self.cursors[reader]
+                    while offset >= self.end and not self.done:
+                        self.cond.wait()
+                    spooled = offset < self.start
+                    if spooled and offset >= self.spool_end:
+                        logger.info('Client fell too far behind')
+                        break
+                    if offset >= self.end:
+                        break
+                    if not spooled:
+                        pos = self.start
+                        for block in self.blocks:
+                            if offset < pos + len(block):
+                                break
+                            pos += len(block)
+                        block = block[offset - pos:]
+                finally:
+                    self.cond.release()
+
+                if spooled:
+                    block = self.read_spool(offset)
+                    if not block:
+                        break
 
-    try:
-        for block in proc['blocks']:
-            length = len(block)
-            if offset < length:
-                if offset > 0:
-                    block = block[offset:]
                 outFile.write('%x\r\n' % len(block))
                 outFile.write(block)
                 outFile.write('\r\n')
                 count += len(block)
-            offset -= length
-        outFile.flush()
-    except Exception, msg:
-        logger.info(msg)
-        return count
 
-    proc['start'] = proc['end']
-    proc['blocks'] = []
-
-    return count + transfer_blocks(inFile, outFile)
-
-def transfer_blocks(inFile, outFile):
-    proc = ffmpeg_procs[inFile]
-    blocks = proc['blocks']
-    count = 0
-
-    while True:
-        try:
-            block = proc['process'].stdout.read(BLOCKSIZE)
-            proc['last_read'] = time.time()
+                self.cond.acquire()
+                try:
+                    self.cursors[reader] = offset + len(block)
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
+            outFile.flush()
         except Exception, msg:
             logger.info(msg)
-            cleanup(inFile)
-            kill(proc['process'])
-            break
-
-        if not block:
-            try:
-                outFile.flush()
-            except Exception, msg:
-                logger.info(msg)
-            else:
-                cleanup(inFile)
-            break
+        self.detach(reader)
+        return count
 
-        blocks.append(block)
-        proc['end'] += len(block)
-        if len(blocks) > MAXBLOCKS:
-            proc['start'] += len(blocks[0])
-            blocks.pop(0)
+    def trim(self, force):
+        # Called with the condition held. Drops the oldest block, if
+        # every client is far enough past it.
+        if not self.cursors:
+            return False
+        if self.start + len(self.blocks[0]) <= self.spool_end:
+            self.start += len(self.blocks.pop(0))
+            return True
+        slowest = min(self.cursors.values())
+        needed = self.start
+        for block in self.blocks[:MAXBLOCKS]:
+            needed += len(block)
+        if slowest >= needed or force:
+            self.start += len(self.blocks.pop(0))
+            self.cond.notifyAll()
+            return True
+        return False
 
+    def pump(self):
         try:
-            outFile.write('%x\r\n' % len(block))
-            outFile.write(block)
-            outFile.write('\r\n')
-            count += len(block)
+            while True:
+                self.cond.acquire()
+                try:
+                    waiting = time.time()
+                    while (len(self.blocks) >= RINGBLOCKS and
+                           not self.closed and
+                           not self.trim(time.time() - waiting > STALL)):
+                        self.cond.wait(5)
+                    if self.closed:
+                        return
+                finally:
+                    self.cond.release()
+
+                block = self.process.stdout.read(BLOCKSIZE)
+                spooled = self.write_spool(block)
+
+                self.cond.acquire()
+                try:
+                    if not block:
+                        self.eof = True
+                        return
+                    self.blocks.append(block)
+                    self.end += len(block)
+                    if spooled:
+                        self.spool_end = self.end
+                    self.cond.notifyAll()
+                finally:
+                    self.cond.release()
         except Exception, msg:
             logger.info(msg)
-            break
-
-    return count
+            self.close()
+        finally:
+            self.cond.acquire()
+            try:
+                self.done = True
+                finished = self.finished()
+                if self.spool and self.spool_end == self.end:
+                    self.blocks = []
+                    self.start = self.end
+                self.cond.notifyAll()
+            finally:
+                self.cond.release()
+            scheduler.release(self.job)
+            if finished:
+                self.close()
+
+    def reap(self):
+        if not self.cursors and self.last_used + TIMEOUT < time.time():
+            self.close()
+        elif not self.closed:
+            self.reaper = threading.Timer(TIMEOUT, self.reap)
+            self.reaper.start()
+
+    def close(self):
+        self.cond.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            self.done = True
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+        procs_lock.acquire()
+        try:
+            sessions = ffmpeg_procs.get(self.key, [])
+            if self in sessions:
+                sessions.remove(self)
+            if not sessions:
+                ffmpeg_procs.pop(self.key, None)
+        finally:
+            procs_lock.release()
+
+        self.reaper.cancel()
+        if not self.eof and self.process.poll() is None:
+            kill(self.process)
+        scheduler.release(self.job)
+
+        self.spool_lock.acquire()
+        try:
+            if self.spool:
+                self.spool.close()
+                self.spool = None
+                release_spool(self.spooled)
+        finally:
+            self.spool_lock.release()
+
+    def write_spool(self, block):
+        # Called from the pump thread only. Returns True if the block was
+        # added; once one isn't, the spool stops growing.
+        if not block or not self.spool or self.spool_full:
+            return False
+        if not reserve_spool(len(block)):
+            logger.debug('Transcode spool budget reached')
+            self.spool_full = True
+            return False
+        self.spool_lock.acquire()
+        try:
+            if not self.spool:
+                release_spool(len(block))
+                return False
+            try:
+                self.spool.seek(0, 2)
+                self.spool.write(block)
+            except (IOError, OSError), msg:
+                logger.error('Transcode spool write failed -- %s' % msg)
+                release_spool(len(block))
+                self.spool_full = True
+                return False
+            self.spooled += len(block)
+        finally:
+            self.spool_lock.release()
+        return True
 
-def reap_process(inFile):
-    if ffmpeg_procs and inFile in ffmpeg_procs:
-        proc = ffmpeg_procs[inFile]
-        if proc['last_read'] + TIMEOUT < time.time():
-            del ffmpeg_procs[inFile]
-            del reapers[inFile]
-            kill(proc['process'])
-        else:
-            reaper = threading.Timer(TIMEOUT, reap_process, (inFile,))
-            reapers[inFile] = reaper
-            reaper.start()
+    def read_spool(self, offset):
+        self.spool_lock.acquire()
+        try:
+            if not self.spool:
+                return ''
+            self.spool.seek(offset)
+            return self.spool.read(BLOCKSIZE)
+        finally:
+            self.spool_lock.release()
+
+def reserve_spool(size):
+    global spool_bytes
+    limit = config.get_server_size('transcode_spool', '0')
+    spool_lock.acquire()
+    try:
+        if spool_bytes + size > limit:
+            return False
+        spool_bytes += size
+        return True
+    finally:
+        spool_lock.release()
 
-def cleanup(inFile):
-    del ffmpeg_procs[inFile]
-    reapers[inFile].cancel()
-    del reapers[inFile]
+def release_spool(size):
+    global spool_bytes
+    spool_lock.acquire()
+    try:
+        spool_bytes -= size
+    finally:
+        spool_lock.release()
 
 def select_audiocodec(isQuery, inFile, tsn='', mime=''):
     if inFile[-5:].lower() == '.tivo':
@@ -377,16 +685,16 @@ def pad_check():
     global pad_style
     if pad_style == UNSET:
         pad_style = OLD_PAD
-        filters = tempfile.TemporaryFile()
         cmd = [config.get_bin('ffmpeg'), '-filters']
-        ffmpeg = subprocess.Popen(cmd, stdout=filters, stderr=subprocess.PIPE)
-        ffmpeg.wait()
-        filters.seek(0)
-        for line in filters:
+        job = scheduler.acquire('probe', 'ffmpeg -filters', None)
+        try:
+            result = procrun.run(cmd)
+        finally:
+            scheduler.release(job)
+        for line in result.stdout.splitlines():
             if line.startswith('pad'):
                 pad_style = NEW_PAD
                 break
-        filters.close()
     return pad_style == NEW_PAD
 
 def pad_TB(TIVO_WIDTH, TIVO_HEIGHT, multiplier, vInfo):
@@ -738,9 +1046,14 @@ def mp4_remux(inFile, basename, tsn=''):
     debug('transcoding to tivo model ' + tsn[:3] + ' using ffmpeg command:')
     debug(' '.join(cmd))
 
-    ffmpeg = subprocess.Popen(cmd)
-    debug('remuxing ' + inFile + ' to ' + outFile)
-    if ffmpeg.wait():
+    job = scheduler.acquire('batch', os.path.basename(inFile))
+    try:
+        ffmpeg = subprocess.Popen(cmd, preexec_fn=scheduler.preexec('batch'))
+        debug('remuxing ' + inFile + ' to ' + outFile)
+        status = ffmpeg.wait()
+    finally:
+        scheduler.release(job)
+    if status:
         debug('error during remuxing')
         os.remove(outFile)
         return None
@@ -777,14 +1090,45 @@ def tivo_compatible(inFile, tsn='', mime=''):
                                            message[1], inFile))
     return message
 
+def cached_video_info(inFile, st):
+    if inFile in info_cache and info_cache[inFile][0] == st.st_mtime:
+        debug('CACHE HIT! %s' % inFile)
+        return info_cache[inFile][1]
+
+    # The persistent index holds the raw probe, without overrides, and
+    # which of FFmpeg or ffprobe it came from, since they don't read
+    # every file quite the same way
+    vInfo = None
+    entry = probe_index.get(inFile, st.st_size, st.st_mtime)
+    if isinstance(entry, tuple) and entry[0] == probe_backend():
+        vInfo = entry[1]
+    if vInfo:
+        debug('INDEX HIT! %s' % inFile)
+        override_info(inFile, vInfo)
+        info_cache[inFile] = (st.st_mtime, vInfo)
+    return vInfo
+
+def probe_backend():
+    return probe.ffprobe() and 'ffprobe' or 'ffmpeg'
+
+def is_cached(inFile):
+    """True if video_info() can answer without running ffmpeg."""
+    try:
+        st = os.stat(unicode(inFile, 'utf-8'))
+    except OSError:
+        return False
+    return bool(cached_video_info(inFile, st))
+
 def video_info(inFile, cache=True):
     vInfo = dict()
     fname = unicode(inFile, 'utf-8')
-    mtime = os.stat(fname).st_mtime
+    st = os.stat(fname)
+    mtime = st.st_mtime
     if cache:
-        if inFile in info_cache and info_cache[inFile][0] == mtime:
-            debug('CACHE HIT! %s' % inFile)
-            return info_cache[inFile][1]
+        vInfo = cached_video_info(inFile, st)
+        if vInfo:
+            return vInfo
+        vInfo = dict()
 
     vInfo['Supported'] = True
 
@@ -801,202 +1145,54 @@ def video_info(inFile, cache=True):
 
     if mswindows:
         fname = fname.encode('iso8859-1')
-    cmd = [ffmpeg_path, '-i', fname]
-    # Windows and other OS buffer 4096 and ffmpeg can output more than that.
-    err_tmp = tempfile.TemporaryFile()
-    ffmpeg = subprocess.Popen(cmd, stderr=err_tmp, stdout=subprocess.PIPE,
-                              stdin=subprocess.PIPE)
-
-    # wait configured # of seconds: if ffmpeg is not back give up
-    limit = config.getFFmpegWait()
-    if limit:
-        for i in xrange(limit * 20):
-            time.sleep(.05)
-            if not ffmpeg.poll() == None:
-                break
+    ffprobe_path = probe.ffprobe()
+    if ffprobe_path:
+        cmd = [ffprobe_path] + probe.FFPROBE_ARGS + [fname]
+    else:
+        cmd = [ffmpeg_path, '-i', fname]
+    job = scheduler.acquire('probe', os.path.basename(inFile))
+    if not job:
+        # Too busy -- this comes out as unsupported, but isn't cached,
+        # so it's tried again next time
+        cache = False
+        output = ''
+    else:
+        try:
+            # wait configured # of seconds: if ffmpeg is not back give up
+            result = procrun.run(cmd, config.getFFmpegWait(),
+                                 scheduler.preexec('probe'))
+        finally:
+            scheduler.release(job)
 
-        if ffmpeg.poll() == None:
-            kill(ffmpeg)
+        if result.timed_out:
             vInfo['Supported'] = False
             if cache:
                 info_cache[inFile] = (mtime, vInfo)
             return vInfo
-    else:
-        ffmpeg.wait()
 
-    err_tmp.seek(0)
-    output = err_tmp.read()
-    err_tmp.close()
-    debug('ffmpeg output=%s' % output)
-
-    attrs = {'container': r'Input #0, ([^,]+),',
-             'vCodec': r'Video: ([^, ]+)',             # video codec
-             'aKbps': r'.*Audio: .+, (.+) (?:kb/s).*',     # audio bitrate
-             'aCodec': r'.*Audio: ([^, ]+)',             # audio codec
-             'aFreq': r'.*Audio: .+, (.+) (?:Hz).*',       # audio frequency
-             'mapVideo': r'([0-9]+[.:]+[0-9]+).*: Video:.*'}  # video mapping
-
-    for attr in attrs:
-        rezre = re.compile(attrs[attr])
-        x = rezre.search(output)
-        if x:
-            vInfo[attr] = x.group(1)
-        else:
-            if attr in ['container', 'vCodec']:
-                vInfo[attr] = ''
-                vInfo['Supported'] = False
-            else:
-                vInfo[attr] = None
-            debug('failed at ' + attr)
-
-    rezre = re.compile(r'.*Audio: .+, (?:(\d+)(?:(?:\.(\d).*)?(?: channels.*)?)|(stereo|mono)),.*')
-    x = rezre.search(output)
-    if x:
-        if x.group(3):
-            if x.group(3) == 'stereo':
-                vInfo['aCh'] = 2
-            elif x.group(3) == 'mono':
-                vInfo['aCh'] = 1
-        elif x.group(2):
-            vInfo['aCh'] = int(x.group(1)) + int(x.group(2))
-        elif x.group(1):
-            vInfo['aCh'] = int(x.group(1))
-        else:
-            vInfo['aCh'] = None
-            debug('failed at aCh')
-    else:
-        vInfo['aCh'] = None
-        debug('failed at aCh')
-
-    rezre = re.compile(r'.*Video: .+, (\d+)x(\d+)[, ].*')
-    x = rezre.search(output)
-    if x:
-        vInfo['vWidth'] = int(x.group(1))
-        vInfo['vHeight'] = int(x.group(2))
-    else:
-        vInfo['vWidth'] = ''
-        vInfo['vHeight'] = ''
-        vInfo['Supported'] = False
-        debug('failed at vWidth/vHeight')
-
-    rezre = re.compile(r'.*Video: .+, (.+) (?:fps|tb\(r\)|tbr).*')
-    x = rezre.search(output)
-    if x:
-        vInfo['vFps'] = x.group(1)
-        if '.' not in vInfo['vFps']:
-            vInfo['vFps'] += '.00'
-
-        # Allow override only if it is mpeg2 and frame rate was doubled
-        # to 59.94
-
-        if vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] != '29.97':
-            # First look for the build 7215 version
-            rezre = re.compile(r'.*film source: 29.97.*')
-            x = rezre.search(output.lower())
-            if x:
-                debug('film source: 29.97 setting vFps to 29.97')
-                vInfo['vFps'] = '29.97'
-            else:
-                # for build 8047:
-                rezre = re.compile(r'.*frame rate differs from container ' +
-                                   r'frame rate: 29.97.*')
-                debug('Bug in VideoReDo')
-                x = rezre.search(output.lower())
-                if x:
-                    vInfo['vFps'] = '29.97'
-    else:
-        vInfo['vFps'] = ''
-        vInfo['Supported'] = False
-        debug('failed at vFps')
-
-    durre = re.compile(r'.*Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+),')
-    d = durre.search(output)
-
-    if d:
-        vInfo['millisecs'] = ((int(d.group(1)) * 3600 +
-                               int(d.group(2)) * 60 +
-                               int(d.group(3))) * 1000 +
-                              int(d.group(4)) * (10 ** (3 - len(d.group(4)))))
-    else:
-        vInfo['millisecs'] = 0
-
-    # get bitrate of source for tivo compatibility test.
-    rezre = re.compile(r'.*bitrate: (.+) (?:kb/s).*')
-    x = rezre.search(output)
-    if x:
-        vInfo['kbps'] = x.group(1)
-    else:
-        # Fallback method of getting video bitrate
-        # Sample line:  Stream #0.0[0x1e0]: Video: mpeg2video, yuv420p,
-        #               720x480 [PAR 32:27 DAR 16:9], 9800 kb/s, 59.94 tb(r)
-        rezre = re.compile(r'.*Stream #0\.0\[.*\]: Video: mpeg2video, ' +
-                           r'\S+, \S+ \[.*\], (\d+) (?:kb/s).*')
-        x = rezre.search(output)
-        if x:
-            vInfo['kbps'] = x.group(1)
+        if ffprobe_path:
+            output = result.stdout
         else:
-            vInfo['kbps'] = None
-            debug('failed at kbps')
-
-    # get par.
-    rezre = re.compile(r'.*Video: .+PAR ([0-9]+):([0-9]+) DAR [0-9:]+.*')
-    x = rezre.search(output)
-    if x and x.group(1) != "0" and x.group(2) != "0":
-        vInfo['par1'] = x.group(1) + ':' + x.group(2)
-        vInfo['par2'] = float(x.group(1)) / float(x.group(2))
-    else:
-        vInfo['par1'], vInfo['par2'] = None, None
+            output = result.stderr
+    debug('ffmpeg output=%s' % output)
 
-    # get dar.
-    rezre = re.compile(r'.*Video: .+DAR ([0-9]+):([0-9]+).*')
-    x = rezre.search(output)
-    if x and x.group(1) != "0" and x.group(2) != "0":
-        vInfo['dar1'] = x.group(1) + ':' + x.group(2)
-    else:
-        vInfo['dar1'] = None
-
-    # get Audio Stream mapping.
-    rezre = re.compile(r'([0-9]+[.:]+[0-9]+)(.*): Audio:(.*)')
-    x = rezre.search(output)
-    amap = []
-    if x:
-        for x in rezre.finditer(output):
-            amap.append((x.group(1), x.group(2) + x.group(3)))
+    if ffprobe_path:
+        vInfo.update(probe.from_ffprobe(output))
     else:
-        amap.append(('', ''))
-        debug('failed at mapAudio')
-    vInfo['mapAudio'] = amap
+        vInfo.update(probe.from_ffmpeg(output))
 
-    vInfo['par'] = None
+    if cache:
+        probe_index.put(inFile, st.st_size, mtime,
+                        (ffprobe_path and 'ffprobe' or 'ffmpeg', vInfo))
 
-    # get Metadata dump (newer ffmpeg).
-    lines = output.split('\n')
-    rawmeta = {}
-    flag = False
+    override_info(inFile, vInfo)
 
-    for line in lines:
-        if line.startswith('  Metadata:'):
-            flag = True
-        else:
-            if flag:
-                if line.startswith('  Duration:'):
-                    flag = False
-                else:
-                    try:
-                        key, value = [x.strip() for x in line.split(':', 1)]
-                        try:
-                            value = value.decode('utf-8')
-                        except:
-                            if sys.platform == 'darwin':
-                                value = value.decode('macroman')
-                            else:
-                                value = value.decode('iso8859-1')
-                        rawmeta[key] = [value]
-                    except:
-                        pass
-
-    vInfo['rawmeta'] = rawmeta
+    if cache:
+        info_cache[inFile] = (mtime, vInfo)
+    debug("; ".join(["%s=%s" % (k, v) for k, v in vInfo.items()]))
+    return vInfo
 
+def override_info(inFile, vInfo):
     data = metadata.from_text(inFile)
     for key in data:
         if key.startswith('Override_'):
@@ -1012,11 +1208,6 @@ def video_info(inFile, cache=True):
             else:
                 vInfo[key.replace('Override_', '')] = data[key]
 
-    if cache:
-        info_cache[inFile] = (mtime, vInfo)
-    debug("; ".join(["%s=%s" % (k, v) for k, v in vInfo.items()]))
-    return vInfo
-
 def audio_check(inFile, tsn):
     cmd_string = ('-y -vcodec mpeg2video -r 29.97 -b 1000k -acodec copy ' +
                   select_audiolang(inFile, tsn) + ' -t 00:00:01 -f vob -')
@@ -1024,17 +1215,28 @@ def audio_check(inFile, tsn):
     if mswindows:
         fname = fname.encode('iso8859-1')
     cmd = [config.get_bin('ffmpeg'), '-i', fname] + cmd_string.split()
-    ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+    job = scheduler.acquire('probe', os.path.basename(inFile))
+    if not job:
+        return None
     fd, testname = tempfile.mkstemp()
     testfile = os.fdopen(fd, 'wb')
     try:
-        shutil.copyfileobj(ffmpeg.stdout, testfile)
-    except:
-        kill(ffmpeg)
-        testfile.close()
-        vInfo = None
-    else:
-        testfile.close()
+        ffmpeg = subprocess.Popen(cmd, stdout=subprocess.PIPE,
+                                  preexec_fn=scheduler.preexec('probe'))
+        try:
+            shutil.copyfileobj(ffmpeg.stdout, testfile)
+        except:
+            kill(ffmpeg)
+            testfile.close()
+            vInfo = None
+        else:
+            testfile.close()
+            ffmpeg.wait()
+            vInfo = {}
+    finally:
+        scheduler.release(job)
+    # The probe needs a slot of its own
+    if vInfo is not None:
         vInfo = video_info(testname, False)
     os.remove(testname)
     return vInfo
@@ -1046,31 +1248,6 @@ def supported_format(inFile):
         debug('FALSE, file not supported %s' % inFile)
         return False
 
-def kill(popen):
-    debug('killing pid=%s' % str(popen.pid))
-    if mswindows:
-        win32kill(popen.pid)
-    else:
-        import os, signal
-        for i in xrange(3):
-            debug('sending SIGTERM to pid: %s' % popen.pid)
-            os.kill(popen.pid, signal.SIGTERM)
-            time.sleep(.5)
-            if popen.poll() is not None:
-                debug('process %s has exited' % popen.pid)
-                break
-        else:
-            while popen.poll() is None:
-                debug('sending SIGKILL to pid: %s' % popen.pid)
-                os.kill(popen.pid, signal.SIGKILL)
-                time.sleep(.5)
-
-def win32kill(pid):
-    import ctypes
-    handle = ctypes.windll.kernel32.OpenProcess(1, False, pid)
-    ctypes.windll.kernel32.TerminateProcess(handle, -1)
-    ctypes.windll.kernel32.CloseHandle(handle)
-
 def gcd(a, b):
     while b:
         a, b = b, a % b
@@ -4,7 +4,6 @@ import logging
 import os
 import re
 import struct
-import thread
 import time
 import traceback
 import urllib
@@ -13,15 +12,18 @@ from UserDict import DictMixin
 from datetime import datetime, timedelta
 from xml.sax.saxutils import escape
 
-from Cheetah.Template import Template
 from lrucache import LRUCache
 
 import config
 import metadata
 import mind
 import qtfaststart
+import scanner
+import tmplcache
 import transcode
+import zerocopy
 from plugin import EncodeUnicode, Plugin, quote
+from pushqueue import push_queue
 
 logger = logging.getLogger('pyTivo.video.video')
 
@@ -31,9 +33,9 @@ CLASS_NAME = 'Video'
 
 PUSHED = '<h3>Queued for Push to %s</h3> <p>%s</p>'
 
-# Preload the templates
+# The templates, compiled on first use
 def tmpl(name):
-    return file(os.path.join(SCRIPTDIR, 'templates', name), 'rb').read()
+    return os.path.join(SCRIPTDIR, 'templates', name)
 
 HTML_CONTAINER_TEMPLATE_MOBILE = tmpl('container_mob.tmpl')
 HTML_CONTAINER_TEMPLATE = tmpl('container_html.tmpl')
@@ -54,8 +56,6 @@ try:
 except:
     use_extensions = False
 
-queue = []  # Recordings to push
-
 def uniso(iso):
     return time.strptime(iso[:19], '%Y-%m-%dT%H:%M:%S')
 
@@ -67,7 +67,13 @@ def isogm(iso):
 
 class Pushable(object):
 
-    def push_one_file(self, f):
+    def init(self):
+        push_queue.start(self)
+
+    def prep_push(self, f):
+        """Check, and if need be remux, a file queued for Push, and
+           return the details to send to the Mind server. Runs in the
+           push queue's worker pool."""
         file_info = VideoDetails()
         file_info['valid'] = transcode.supported_format(f['path'])
 
@@ -98,28 +104,22 @@ class Pushable(object):
         if not source:
             source = title
 
-        subtitle = file_info['episodeTitle']
-        try:
-            m = mind.getMind(f['tsn'])
-            m.pushVideo(
-                tsn = f['tsn'],
-                url = url,
-                description = file_info['description'],
-                duration = file_info['duration'] / 1000,
-                size = file_info['size'],
-                title = title,
-                subtitle = subtitle,
-                source = source,
-                mime = mime,
-                tvrating = file_info['tvRating'])
-        except Exception, msg:
-            logger.error(msg)
-
-    def process_queue(self):
-        while queue:
-            time.sleep(5)
-            item = queue.pop(0)
-            self.push_one_file(item)
+        return {'tsn': f['tsn'],
+                'url': url,
+                'description': file_info['description'],
+                'duration': file_info['duration'] / 1000,
+                'size': file_info['size'],
+                'title': title,
+                'subtitle': file_info['episodeTitle'],
+                'source': source,
+                'mime': mime,
+                'tvrating': file_info['tvRating']}
+
+    def submit_push(self, f):
+        """Hand a prepared push to the Mind server. The push queue makes
+           these calls one at a time."""
+        m = mind.getMind(f['tsn'])
+        m.pushVideo(**f['push'])
 
     def readip(self):
         """ returns your external IP address by querying dyndns.org """
@@ -156,10 +156,8 @@ class Pushable(object):
         files = query.get('File', [])
         for f in files:
             file_path = path + os.path.normpath(f)
-            queue.append({'path': file_path, 'name': f, 'tsn': tsn,
-                          'url': baseurl})
-            if len(queue) == 1:
-                thread.start_new_thread(Video.process_queue, (self,))
+            push_queue.add({'path': file_path, 'name': f, 'tsn': tsn,
+                            'url': baseurl})
 
             logger.info('[%s] Queued "%s" for Push to %s' %
                         (time.strftime('%d/%b/%Y %H:%M:%S'),
@@ -207,10 +205,6 @@ class BaseVideo(Plugin):
         else:
             valid = True
 
-        if valid and offset:
-            valid = ((compatible and offset < os.stat(path).st_size) or
-                     (not compatible and transcode.is_resumable(path, offset)))
-
         #faking = (mime in ['video/x-tivo-mpeg-ts', 'video/x-tivo-mpeg'] and
         faking = (mime == 'video/x-tivo-mpeg' and
                   not (is_tivo_file and compatible))
@@ -218,6 +212,12 @@ class BaseVideo(Plugin):
         thead = ''
         if faking:
             thead = self.tivo_header(tsn, path, mime)
+
+        if valid and offset:
+            valid = ((compatible and offset < os.stat(path).st_size) or
+                     (not compatible and
+                      transcode.is_resumable(path, offset, tsn, mime, thead)))
+
         if compatible:
             size = os.stat(fname).st_size + len(thead)
             handler.send_response(200)
@@ -243,25 +243,25 @@ class BaseVideo(Plugin):
                 f = open(fname, 'rb')
                 try:
                     if mime == 'video/mp4':
-                        count = qtfaststart.process(f, handler.wfile, offset)
+                        st = os.fstat(f.fileno())
+                        count = qtfaststart.process(f, handler.wfile, offset,
+                                    (fname, st.st_size, st.st_mtime))
                     else:
                         if offset:
                             offset -= len(thead)
-                            f.seek(offset)
-                        while True:
-                            block = f.read(512 * 1024)
-                            if not block:
-                                break
-                            handler.wfile.write(block)
-                            count += len(block)
+                            if offset < 0:
+                                # Resuming within the header
+                                handler.wfile.write(thead[offset:])
+                                offset = 0
+                        count = zerocopy.sendfile(handler.wfile, f, offset)
                 except Exception, msg:
                     logger.info(msg)
                 f.close()
             else:
                 logger.debug('"%s" is not tivo compatible' % fname)
                 if offset:
-                    count = transcode.resume_transfer(path, handler.wfile, 
-                                                      offset)
+                    count = transcode.resume_transfer(path, handler.wfile,
+                                                      offset, tsn, mime, thead)
                 else:
                     count = transcode.transcode(False, path, handler.wfile,
                                                 tsn, mime, thead)
@@ -283,6 +283,13 @@ class BaseVideo(Plugin):
         if fname.endswith('.pyTivo-temp'):
             os.remove(fname)
 
+    def prewarm(self, full_path):
+        """Probe a file and parse its metadata ahead of time, so that
+           listings can show full details. Called by the scanner."""
+        if self.video_file_filter(full_path):
+            if transcode.supported_format(full_path):
+                metadata.basic(full_path)
+
     def __duration(self, full_path):
         return transcode.video_info(full_path)['millisecs']
 
@@ -300,7 +307,7 @@ class BaseVideo(Plugin):
                 elif use_extensions:
                     if os.path.splitext(f2)[1].lower() in EXTENSIONS:
                         count += 1
-                elif f2 in transcode.info_cache:
+                elif transcode.is_cached(f2):
                     if transcode.supported_format(f2):
                         count += 1
         except:
@@ -415,6 +422,7 @@ class BaseVideo(Plugin):
                                              force_alpha)
 
         videos = []
+        unscanned = []
         local_base_path = self.get_local_base_path(handler, query)
         for f in files:
             video = VideoDetails()
@@ -438,7 +446,7 @@ class BaseVideo(Plugin):
                 video['small_path'] = subcname + '/' + video['name']
                 video['total_items'] = self.__total_items(f.name)
             else:
-                if len(files) == 1 or f.name in transcode.info_cache:
+                if len(files) == 1 or transcode.is_cached(f.name):
                     video['valid'] = transcode.supported_format(f.name)
                     if video['valid']:
                         video.update(self.metadata_full(f.name, tsn))
@@ -447,6 +455,7 @@ class BaseVideo(Plugin):
                 else:
                     video['valid'] = True
                     video.update(metadata.basic(f.name))
+                    unscanned.append(f.name)
 
                 if self.use_ts(tsn, f.name):
                     video['mime'] = 'video/x-tivo-mpeg-ts'
@@ -457,15 +466,20 @@ class BaseVideo(Plugin):
 
             videos.append(video)
 
+        if unscanned:
+            scanner.queue_files(handler.cname, unscanned)
+
         logger.debug('mobileagent: %d useragent: %s' % (useragent.lower().find('mobile'), useragent.lower()))
         use_mobile = useragent.lower().find('mobile') > 0
         if use_html:
             if use_mobile:
-                t = Template(HTML_CONTAINER_TEMPLATE_MOBILE, filter=EncodeUnicode)
+                t = tmplcache.get(HTML_CONTAINER_TEMPLATE_MOBILE)(
+                    filter=EncodeUnicode)
             else:
-                t = Template(HTML_CONTAINER_TEMPLATE, filter=EncodeUnicode)
+                t = tmplcache.get(HTML_CONTAINER_TEMPLATE)(
+                    filter=EncodeUnicode)
         else:
-            t = Template(XML_CONTAINER_TEMPLATE, filter=EncodeUnicode)
+            t = tmplcache.get(XML_CONTAINER_TEMPLATE)(filter=EncodeUnicode)
         t.container = handler.cname
         t.name = subcname
         t.total = total
@@ -505,7 +519,7 @@ class BaseVideo(Plugin):
             if file_info['valid']:
                 file_info.update(self.metadata_full(file_path, tsn))
 
-            t = Template(TVBUS_TEMPLATE, filter=EncodeUnicode)
+            t = tmplcache.get(TVBUS_TEMPLATE)(filter=EncodeUnicode)
             t.video = file_info
             t.escape = escape
             t.get_tv = metadata.get_tv
@@ -543,7 +557,10 @@ class BaseVideo(Plugin):
         handler.send_xml(details)
 
 class Video(BaseVideo, Pushable):
-        pass
+
+    def init(self):
+        BaseVideo.init(self)
+        Pushable.init(self)
 
 class VideoDetails(DictMixin):
 
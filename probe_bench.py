@@ -0,0 +1,295 @@
+#!/usr/bin/env python
+
+"""Compare plugins.video.probe.from_ffmpeg() with the regex code it
+replaced in transcode.video_info().
+
+    usage: probe_bench.py [saved ffmpeg output ...]
+
+Each sample -- the stderr of "ffmpeg -i somefile", from the built-in
+corpus below, plus any files named on the command line -- is parsed
+both ways. The results must be identical; then both are timed. Times
+are per sample, in microseconds.
+"""
+
+import re
+import sys
+import time
+
+from plugins.video import probe
+
+CORPUS = {
+'mpeg2-ota': """FFmpeg version SVN-r20463, Copyright (c) 2000-2009 Fabrice Bellard, et al.
+  configuration: --enable-gpl --enable-postproc --enable-pthreads
+  libavutil     50. 3. 0 / 50. 3. 0
+  libavcodec    52.37. 1 / 52.37. 1
+  libavformat   52.39. 2 / 52.39. 2
+  built on Nov  9 2009 12:00:00, gcc: 4.4.1
+[mpeg @ 0x9b8f4e0]MAX_READ_SIZE:5000000 reached
+Input #0, mpeg, from 'Show - 12345.mpg':
+  Duration: 00:29:59.97, start: 0.287267, bitrate: 6519 kb/s
+    Stream #0.0[0x1e0]: Video: mpeg2video, yuv420p, 720x480 [PAR 32:27 DAR 16:9], 9800 kb/s, 59.94 tb(r)
+    Stream #0.1[0x80]: Audio: ac3, 48000 Hz, 5.1, s16, 384 kb/s
+    Stream #0.2[0x81]: Audio: ac3, 48000 Hz, stereo, s16, 192 kb/s
+At least one output file must be specified
+""",
+'tivo-ts': """ffmpeg version 0.8.4, Copyright (c) 2000-2011 the FFmpeg developers
+  built on Oct 14 2012 10:00:00 with gcc 4.6.3
+[mpegts @ 0x1c0a0a0] max_analyze_duration reached
+Input #0, mpegts, from 'Movie (Recorded Oct 1, 2012, KABC).TiVo':
+  Duration: 01:58:00.08, start: 1.400000, bitrate: 12483 kb/s
+  Program 1
+    Stream #0.0[0x11]: Video: h264 (High), yuv420p, 1920x1080 [PAR 1:1 DAR 16:9], 29.97 fps, 29.97 tbr, 90k tbn, 59.94 tbc
+    Stream #0.1[0x14](eng): Audio: ac3, 48000 Hz, 5.1, s16, 384 kb/s
+    Stream #0.2[0x15](spa): Audio: ac3, 48000 Hz, stereo, s16, 192 kb/s
+At least one output file must be specified
+""",
+'mp4-meta': """ffmpeg version 1.0 Copyright (c) 2000-2012 the FFmpeg developers
+  built on Oct  1 2012 12:00:00 with gcc 4.7 (GCC)
+  configuration: --enable-gpl --enable-libx264
+Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'Episode.m4v':
+  Metadata:
+    major_brand     : M4V
+    minor_version   : 1
+    compatible_brands: M4V M4A mp42isom
+    creation_time   : 2012-06-01 10:00:00
+    title           : The Episode
+    artist          : The Series
+    album           : The Series, Season 2
+    comment         : A description of the episode: with a colon.
+    genre           : Drama
+    date            : 2012
+  Duration: 00:42:31.25, start: 0.000000, bitrate: 2535 kb/s
+    Stream #0:0(und): Video: h264 (Main) (avc1 / 0x31637661), yuv420p, 1280x720 [SAR 1:1 DAR 16:9], 2398 kb/s, 23.98 fps, 23.98 tbr, 2997 tbn, 5994 tbc
+    Metadata:
+      creation_time   : 2012-06-01 10:00:00
+      handler_name    :
+    Stream #0:1(eng): Audio: aac (mp4a / 0x6134706D), 48000 Hz, stereo, s16, 128 kb/s
+    Metadata:
+      creation_time   : 2012-06-01 10:00:00
+      handler_name    :
+At least one output file must be specified
+""",
+'mkv-langs': """ffmpeg version 0.10.4 Copyright (c) 2000-2012 the FFmpeg developers
+Input #0, matroska,webm, from 'Film.mkv':
+  Metadata:
+    title           : Film
+  Duration: 02:01:12.34, start: 0.000000, bitrate: N/A
+    Stream #0:0(eng): Video: h264 (High), yuv420p, 1280x536, SAR 1:1 DAR 160:67, 23.98 fps, 23.98 tbr, 1k tbn, 47.95 tbc (default)
+    Stream #0:1(fre): Audio: dts (DTS), 48000 Hz, 5.1(side), s16, 1536 kb/s
+    Stream #0:2(eng): Audio: ac3, 48000 Hz, 6 channels, s16, 448 kb/s (default)
+    Stream #0:3(eng): Subtitle: ssa (default)
+At least one output file must be specified
+""",
+'avi-mono': """FFmpeg version 0.5, Copyright (c) 2000-2009 Fabrice Bellard, et al.
+Input #0, avi, from 'home.avi':
+  Duration: 00:03:12.5, start: 0.000000, bitrate: 1051 kb/s
+    Stream #0.0: Video: mpeg4, yuv420p, 640x480 [PAR 1:1 DAR 4:3], 25 tbr, 25 tbn, 25 tbc
+    Stream #0.1: Audio: mp3, 22050 Hz, mono, s16, 64 kb/s
+At least one output file must be specified
+""",
+'vob-film': """FFmpeg version SVN-r15261, Copyright (c) 2000-2008 Fabrice Bellard, et al.
+Input #0, mpeg, from 'VTS_01_1.VOB':
+  Duration: 00:24:10.45, start: 0.280633, bitrate: 7894 kb/s
+    Stream #0.0[0x1e0]: Video: mpeg2video, yuv420p, 720x480 [PAR 8:9 DAR 4:3], 9800 kb/s, 59.94 tb(r)
+    Stream #0.1[0x80]: Audio: ac3, 48000 Hz, 2 channels, s16, 192 kb/s
+[mpeg2video @ 0x8f4a440]Film source: 29.97 fps detected
+At least one output file must be specified
+""",
+'audio-only': """ffmpeg version 0.8.4, Copyright (c) 2000-2011 the FFmpeg developers
+Input #0, mp3, from 'song.mp3':
+  Metadata:
+    title           : Caf\xc3\xa9 Song
+    artist          : Somebody
+  Duration: 00:04:01.02, start: 0.000000, bitrate: 320 kb/s
+    Stream #0.0: Audio: mp3, 44100 Hz, stereo, s16, 320 kb/s
+At least one output file must be specified
+""",
+'broken': """ffmpeg version 0.8.4, Copyright (c) 2000-2011 the FFmpeg developers
+broken.avi: Invalid data found when processing input
+""",
+}
+
+def old_parse(output):
+    """The parsing from transcode.video_info() before probe.py, for
+       comparison."""
+    vInfo = {'Supported': True}
+
+    attrs = {'container': r'Input #0, ([^,]+),',
+             'vCodec': r'Video: ([^, ]+)',             # video codec
+             'aKbps': r'.*Audio: .+, (.+) (?:kb/s).*',     # audio bitrate
+             'aCodec': r'.*Audio: ([^, ]+)',             # audio codec
+             'aFreq': r'.*Audio: .+, (.+) (?:Hz).*',       # audio frequency
+             'mapVideo': r'([0-9]+[.:]+[0-9]+).*: Video:.*'}  # video mapping
+
+    for attr in attrs:
+        rezre = re.compile(attrs[attr])
+        x = rezre.search(output)
+        if x:
+            vInfo[attr] = x.group(1)
+        else:
+            if attr in ['container', 'vCodec']:
+                vInfo[attr] = ''
+                vInfo['Supported'] = False
+            else:
+                vInfo[attr] = None
+
+    rezre = re.compile(r'.*Audio: .+, (?:(\d+)(?:(?:\.(\d).*)?(?: channels.*)?)|(stereo|mono)),.*')
+    x = rezre.search(output)
+    if x:
+        if x.group(3):
+            if x.group(3) == 'stereo':
+                vInfo['aCh'] = 2
+            elif x.group(3) == 'mono':
+                vInfo['aCh'] = 1
+        elif x.group(2):
+            vInfo['aCh'] = int(x.group(1)) + int(x.group(2))
+        elif x.group(1):
+            vInfo['aCh'] = int(x.group(1))
+        else:
+            vInfo['aCh'] = None
+    else:
+        vInfo['aCh'] = None
+
+    rezre = re.compile(r'.*Video: .+, (\d+)x(\d+)[, ].*')
+    x = rezre.search(output)
+    if x:
+        vInfo['vWidth'] = int(x.group(1))
+        vInfo['vHeight'] = int(x.group(2))
+    else:
+        vInfo['vWidth'] = ''
+        vInfo['vHeight'] = ''
+        vInfo['Supported'] = False
+
+    rezre = re.compile(r'.*Video: .+, (.+) (?:fps|tb\(r\)|tbr).*')
+    x = rezre.search(output)
+    if x:
+        vInfo['vFps'] = x.group(1)
+        if '.' not in vInfo['vFps']:
+            vInfo['vFps'] += '.00'
+
+        if vInfo['vCodec'] == 'mpeg2video' and vInfo['vFps'] != '29.97':
+            rezre = re.compile(r'.*film source: 29.97.*')
+            x = rezre.search(output.lower())
+            if x:
+                vInfo['vFps'] = '29.97'
+            else:
+                rezre = re.compile(r'.*frame rate differs from container ' +
+                                   r'frame rate: 29.97.*')
+                x = rezre.search(output.lower())
+                if x:
+                    vInfo['vFps'] = '29.97'
+    else:
+        vInfo['vFps'] = ''
+        vInfo['Supported'] = False
+
+    durre = re.compile(r'.*Duration: ([0-9]+):([0-9]+):([0-9]+)\.([0-9]+),')
+    d = durre.search(output)
+
+    if d:
+        vInfo['millisecs'] = ((int(d.group(1)) * 3600 +
+                               int(d.group(2)) * 60 +
+                               int(d.group(3))) * 1000 +
+                              int(d.group(4)) * (10 ** (3 - len(d.group(4)))))
+    else:
+        vInfo['millisecs'] = 0
+
+    rezre = re.compile(r'.*bitrate: (.+) (?:kb/s).*')
+    x = rezre.search(output)
+    if x:
+        vInfo['kbps'] = x.group(1)
+    else:
+        rezre = re.compile(r'.*Stream #0\.0\[.*\]: Video: mpeg2video, ' +
+                           r'\S+, \S+ \[.*\], (\d+) (?:kb/s).*')
+        x = rezre.search(output)
+        if x:
+            vInfo['kbps'] = x.group(1)
+        else:
+            vInfo['kbps'] = None
+
+    rezre = re.compile(r'.*Video: .+PAR ([0-9]+):([0-9]+) DAR [0-9:]+.*')
+    x = rezre.search(output)
+    if x and x.group(1) != "0" and x.group(2) != "0":
+        vInfo['par1'] = x.group(1) + ':' + x.group(2)
+        vInfo['par2'] = float(x.group(1)) / float(x.group(2))
+    else:
+        vInfo['par1'], vInfo['par2'] = None, None
+
+    rezre = re.compile(r'.*Video: .+DAR ([0-9]+):([0-9]+).*')
+    x = rezre.search(output)
+    if x and x.group(1) != "0" and x.group(2) != "0":
+        vInfo['dar1'] = x.group(1) + ':' + x.group(2)
+    else:
+        vInfo['dar1'] = None
+
+    rezre = re.compile(r'([0-9]+[.:]+[0-9]+)(.*): Audio:(.*)')
+    x = rezre.search(output)
+    amap = []
+    if x:
+        for x in rezre.finditer(output):
+            amap.append((x.group(1), x.group(2) + x.group(3)))
+    else:
+        amap.append(('', ''))
+    vInfo['mapAudio'] = amap
+
+    vInfo['par'] = None
+
+    lines = output.split('\n')
+    rawmeta = {}
+    flag = False
+
+    for line in lines:
+        if line.startswith('  Metadata:'):
+            flag = True
+        else:
+            if flag:
+                if line.startswith('  Duration:'):
+                    flag = False
+                else:
+                    try:
+                        key, value = [x.strip() for x in line.split(':', 1)]
+                        try:
+                            value = value.decode('utf-8')
+                        except:
+                            if sys.platform == 'darwin':
+                                value = value.decode('macroman')
+                            else:
+                                value = value.decode('iso8859-1')
+                        rawmeta[key] = [value]
+                    except:
+                        pass
+
+    vInfo['rawmeta'] = rawmeta
+    return vInfo
+
+def timed(func, arg, reps):
+    start = time.time()
+    for i in xrange(reps):
+        result = func(arg)
+    return result, (time.time() - start) * 1e6 / reps
+
+def main(argv):
+    samples = sorted(CORPUS.items())
+    for name in argv:
+        samples.append((name, open(name, 'rb').read()))
+
+    reps = 2000
+    print '%-12s %10s %10s %8s' % ('sample', 'regex us', 'probe us',
+                                  'speedup')
+    total_old = total_new = 0
+    for name, output in samples:
+        old, old_time = timed(old_parse, output, reps)
+        new, new_time = timed(probe.from_ffmpeg, output, reps)
+        if old != new:
+            for key in sorted(set(old) | set(new)):
+                if old.get(key) != new.get(key):
+                    print '  %s: %r != %r' % (key, old.get(key), new.get(key))
+            raise AssertionError('Results differ for %s' % name)
+        total_old += old_time
+        total_new += new_time
+        print '%-12s %10.1f %10.1f %7.1fx' % (name[-12:], old_time, new_time,
+                                              old_time / new_time)
+    print '%-12s %10.1f %10.1f %7.1fx' % ('all', total_old, total_new,
+                                          total_old / total_new)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
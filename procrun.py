@@ -0,0 +1,182 @@
+"""Run short-lived helpers -- mostly FFmpeg and ffprobe probes -- to
+completion, collecting what they write in memory.
+
+The pipes are read with select() as output arrives, so nothing is
+spooled to disk and a chatty process can't fill a pipe and stall; the
+caller wakes as soon as the process finishes, or at the deadline, when
+the process is killed. run_all() starts several commands at once and
+waits on them together, in the same loop.
+
+    result = procrun.run([ffmpeg_path, '-i', fname], timeout=10)
+    if not result.timed_out:
+        parse(result.stderr)
+
+On Windows, where select() only works on sockets, each process is
+read by a thread instead.
+"""
+
+import errno
+import logging
+import os
+import select
+import subprocess
+import sys
+import threading
+import time
+
+logger = logging.getLogger('pyTivo.procrun')
+
+mswindows = (sys.platform == 'win32')
+
+BLOCKSIZE = 64 * 1024
+REAP_WAIT = 0.01    # Seconds between checks on a process that closed
+                    # its pipes but hasn't exited yet
+
+class Result(object):
+    """The outcome of one command: returncode, stdout and stderr (as
+       strings), and timed_out, set if it had to be killed."""
+
+    def __init__(self):
+        self.returncode = None
+        self.stdout = ''
+        self.stderr = ''
+        self.timed_out = False
+
+def kill(popen):
+    logger.debug('killing pid=%s' % str(popen.pid))
+    if mswindows:
+        win32kill(popen.pid)
+    else:
+        import signal
+        for i in xrange(3):
+            logger.debug('sending SIGTERM to pid: %s' % popen.pid)
+            os.kill(popen.pid, signal.SIGTERM)
+            time.sleep(.5)
+            if popen.poll() is not None:
+                logger.debug('process %s has exited' % popen.pid)
+                break
+        else:
+            while popen.poll() is None:
+                logger.debug('sending SIGKILL to pid: %s' % popen.pid)
+                os.kill(popen.pid, signal.SIGKILL)
+                time.sleep(.5)
+
+def win32kill(pid):
+    import ctypes
+    handle = ctypes.windll.kernel32.OpenProcess(1, False, pid)
+    ctypes.windll.kernel32.TerminateProcess(handle, -1)
+    ctypes.windll.kernel32.CloseHandle(handle)
+
+def run(cmd, timeout=None, preexec_fn=None):
+    """Run cmd, giving it up to timeout seconds (no limit if None or 0),
+       and return a Result. Raises OSError if it can't be started."""
+    return run_all([cmd], timeout, preexec_fn)[0]
+
+def run_all(cmds, timeout=None, preexec_fn=None):
+    """Run all of cmds at once, and return their Results, in order.
+       The timeout applies to the whole batch."""
+    procs = []
+    try:
+        for cmd in cmds:
+            procs.append(subprocess.Popen(cmd, stdin=subprocess.PIPE,
+                                          stdout=subprocess.PIPE,
+                                          stderr=subprocess.PIPE,
+                                          preexec_fn=preexec_fn,
+                                          close_fds=not mswindows))
+            # Nothing is sent; end-of-file keeps FFmpeg from waiting on
+            # keyboard input.
+            procs[-1].stdin.close()
+    except OSError:
+        for popen in procs:
+            kill(popen)
+        raise
+
+    deadline = None
+    if timeout:
+        deadline = time.time() + timeout
+    if mswindows:
+        return _wait_threads(procs, deadline)
+    return _wait_select(procs, deadline)
+
+def _wait_select(procs, deadline):
+    results = [Result() for popen in procs]
+    chunks = {}     # fd -> blocks read
+    owners = {}     # fd -> index of its process, for open pipes
+    for i, popen in enumerate(procs):
+        for pipe in (popen.stdout, popen.stderr):
+            chunks[pipe.fileno()] = []
+            owners[pipe.fileno()] = i
+
+    while owners:
+        wait = None
+        if deadline:
+            wait = deadline - time.time()
+            if wait <= 0:
+                break
+        try:
+            ready = select.select(owners.keys(), [], [], wait)[0]
+        except select.error, (err, msg):
+            if err == errno.EINTR:
+                continue
+            raise
+        for fd in ready:
+            block = os.read(fd, BLOCKSIZE)
+            if block:
+                chunks[fd].append(block)
+            else:
+                del owners[fd]
+
+    late = set(owners.values())
+    for i, popen in enumerate(procs):
+        result = results[i]
+        if i not in late:
+            # Its pipes are closed, so it's finished or nearly so
+            while popen.poll() is None:
+                if deadline and time.time() >= deadline:
+                    late.add(i)
+                    break
+                time.sleep(REAP_WAIT)
+        if i in late:
+            kill(popen)
+            result.timed_out = True
+        result.returncode = popen.returncode
+        result.stdout = ''.join(chunks[popen.stdout.fileno()])
+        result.stderr = ''.join(chunks[popen.stderr.fileno()])
+        popen.stdout.close()
+        popen.stderr.close()
+    return results
+
+def _wait_threads(procs, deadline):
+    results = [Result() for popen in procs]
+
+    def reader(pipe, out):
+        out.append(pipe.read())
+
+    threads = []
+    for popen, result in zip(procs, results):
+        out, err = [], []
+        for pipe, store in ((popen.stdout, out), (popen.stderr, err)):
+            t = threading.Thread(target=reader, args=(pipe, store),
+                                 name='procrun reader')
+            t.setDaemon(True)
+            t.start()
+            threads.append((popen, result, t, store))
+
+    for popen, result, t, store in threads:
+        if deadline:
+            t.join(max(deadline - time.time(), 0))
+        else:
+            t.join()
+        if t.isAlive() and not result.timed_out:
+            kill(popen)
+            result.timed_out = True
+        t.join()
+
+    for i, popen in enumerate(procs):
+        result = results[i]
+        result.returncode = popen.wait()
+        result.stdout = ''.join(threads[2 * i][3])
+        result.stderr = ''.join(threads[2 * i + 1][3])
+        popen.stdout.close()
+        popen.stderr.close()
+    return results
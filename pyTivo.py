@@ -13,6 +13,7 @@ if sys.version_info[0] != 2 or sys.version_info[1] < 5:
 import beacon
 import config
 import httpserver
+import scanner
 
 def exceptionLogger(*args):
     sys.excepthook = sys.__excepthook__
@@ -59,6 +60,8 @@ def setup(in_service=False):
     httpd.set_beacon(b)
     httpd.set_service_status(in_service)
 
+    scanner.rescan()
+
     logger.info('pyTivo is ready.')
     return httpd
 
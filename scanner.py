@@ -0,0 +1,280 @@
+import Queue
+import logging
+import os
+import sys
+import threading
+import time
+import unicodedata
+
+import config
+import fswatch
+import scheduler
+from plugin import GetPlugin, SETTLE
+
+logger = logging.getLogger('pyTivo.scanner')
+
+class Scanner(object):
+    """Walk the shares in the background, handing every file to its
+       plugin's prewarm() method from a bounded pool of worker threads,
+       so that the expensive probes are done before anyone asks. Where
+       there's a watcher, files added or changed later are queued too,
+       once they've settled.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.queue = Queue.Queue()
+        self.pending = set()
+        self.shares = {}
+        self.workers = 0
+        self.generation = 0
+        self.changed = {}       # path -> share name, for watched changes
+        self.settling = False
+
+    def threads(self):
+        try:
+            return max(int(config.get_server('scan_threads', 0)), 0)
+        except ValueError:
+            return 0
+
+    def rescan(self):
+        """Start over with the current shares. Anything still queued
+           from an earlier scan is dropped."""
+        roots = []
+        self.lock.acquire()
+        try:
+            self.generation += 1
+            self.pending.clear()
+            self.changed.clear()
+            self.shares = {}
+            if self.threads():
+                for name, settings in config.getShares():
+                    plugin = GetPlugin(settings.get('type'))
+                    if hasattr(plugin, 'prewarm') and 'path' in settings:
+                        self._start_walk(name, plugin, settings['path'])
+                        roots.append((name, settings['path']))
+                self._start_workers()
+        finally:
+            self.lock.release()
+
+        watcher = fswatch.get_watcher()
+        if watcher:
+            for key in watcher.keys():
+                if key[0] is self:
+                    watcher.unwatch(key)
+            for name, path in roots:
+                watcher.watch((self, name), path,
+                    lambda action, path, name=name:
+                        self.watch_event(name, action, path))
+
+    def _start_walk(self, name, plugin, path):
+        # Called with the lock held
+        self.shares[name] = {'name': name, 'found': 0, 'done': 0,
+                             'errors': 0, 'walking': True,
+                             'started': time.time(), 'finished': None}
+        t = threading.Thread(target=self.walk, name='scanner walker',
+                             args=(self.generation, name, plugin, path))
+        t.setDaemon(True)
+        t.start()
+
+    def watch_event(self, name, action, path):
+        # From the watcher's thread. New and rewritten files are noted,
+        # and queued by settle() once they've stopped changing, so that
+        # nothing is probed half-written.
+        if action == 'reset':
+            # Events were lost; walk the whole share again
+            for name2, settings in config.getShares():
+                if name2 == name:
+                    break
+            else:
+                return
+            self.lock.acquire()
+            try:
+                if name in self.shares:
+                    self._start_walk(name, GetPlugin(settings.get('type')),
+                                     settings['path'])
+            finally:
+                self.lock.release()
+            return
+        if action not in ('create', 'change'):
+            return
+
+        if fswatch.isdir(path):
+            paths = []
+            for root, dirs, files in os.walk(unicode(path, 'utf-8')):
+                dirs[:] = [d for d in dirs if not d.startswith('.')]
+                for f in files:
+                    if not f.startswith('.'):
+                        f = os.path.join(root, f)
+                        if sys.platform == 'darwin':
+                            f = unicodedata.normalize('NFC', f)
+                        paths.append(f.encode('utf-8'))
+        else:
+            paths = [path]
+
+        self.lock.acquire()
+        try:
+            for f in paths:
+                self.changed[f] = name
+            if paths and not self.settling:
+                self.settling = True
+                t = threading.Thread(target=self.settle,
+                                     name='scanner settle')
+                t.setDaemon(True)
+                t.start()
+        finally:
+            self.lock.release()
+
+    def settle(self):
+        # Queue the noted files once they've gone SETTLE seconds without
+        # changing. Runs until there are none left.
+        while True:
+            time.sleep(SETTLE)
+            now = time.time()
+            ready = {}
+            self.lock.acquire()
+            try:
+                for path, name in self.changed.items():
+                    try:
+                        mtime = os.stat(unicode(path, 'utf-8')).st_mtime
+                    except OSError:
+                        del self.changed[path]
+                        continue
+                    if mtime + SETTLE <= now:
+                        del self.changed[path]
+                        ready.setdefault(name, []).append(path)
+                if not ready and not self.changed:
+                    self.settling = False
+                    return
+            finally:
+                self.lock.release()
+            for name, paths in ready.items():
+                paths.sort()
+                self.queue_files(name, paths)
+
+    def queue_files(self, name, paths):
+        """Ask for specific files in a share to be scanned, e.g. when a
+           listing turns up files that haven't been seen yet."""
+        if not self.threads():
+            return
+        self.lock.acquire()
+        try:
+            for name2, settings in config.getShares():
+                if name2 == name:
+                    break
+            else:
+                return
+            plugin = GetPlugin(settings.get('type'))
+            if not hasattr(plugin, 'prewarm'):
+                return
+            status = self.shares.setdefault(name,
+                {'name': name, 'found': 0, 'done': 0, 'errors': 0,
+                 'walking': False, 'started': time.time(), 'finished': None})
+            for path in paths:
+                if path not in self.pending:
+                    self.pending.add(path)
+                    status['found'] += 1
+                    status['finished'] = None
+                    self.queue.put((self.generation, name, plugin, path))
+            self._start_workers()
+        finally:
+            self.lock.release()
+
+    def status(self):
+        self.lock.acquire()
+        try:
+            shares = [dict(s) for s in self.shares.values()]
+        finally:
+            self.lock.release()
+        shares.sort(key=lambda x: x['name'])
+        return {'threads': self.threads(), 'queued': self.queue.qsize(),
+                'shares': shares}
+
+    def _start_workers(self):
+        # Called with the lock held
+        while self.workers < self.threads():
+            self.workers += 1
+            t = threading.Thread(target=self.work, name='scanner worker')
+            t.setDaemon(True)
+            t.start()
+
+    def walk(self, generation, name, plugin, path):
+        logger.info('Scanning share %s' % name)
+        for root, dirs, files in os.walk(unicode(path, 'utf-8')):
+            if generation != self.generation:
+                return
+            dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+            files.sort()
+            self.lock.acquire()
+            try:
+                status = self.shares[name]
+                for f in files:
+                    if f.startswith('.'):
+                        continue
+                    f = os.path.join(root, f)
+                    if sys.platform == 'darwin':
+                        f = unicodedata.normalize('NFC', f)
+                    f = f.encode('utf-8')
+                    if f not in self.pending:
+                        self.pending.add(f)
+                        status['found'] += 1
+                        self.queue.put((generation, name, plugin, f))
+            finally:
+                self.lock.release()
+
+        self.lock.acquire()
+        try:
+            if generation == self.generation:
+                self.shares[name]['walking'] = False
+                self._check_finished(name)
+        finally:
+            self.lock.release()
+
+    def work(self):
+        scheduler.set_background()
+        while True:
+            self.lock.acquire()
+            try:
+                if self.workers > self.threads():
+                    self.workers -= 1
+                    return
+            finally:
+                self.lock.release()
+
+            generation, name, plugin, path = self.queue.get()
+            if generation != self.generation:
+                continue
+
+            error = False
+            try:
+                plugin.prewarm(path)
+            except Exception, msg:
+                logger.warning('Unable to scan %s -- %s' %
+                               (unicode(path, 'utf-8', 'replace'), msg))
+                error = True
+
+            self.lock.acquire()
+            try:
+                if generation == self.generation:
+                    self.pending.discard(path)
+                    status = self.shares[name]
+                    status['done'] += 1
+                    if error:
+                        status['errors'] += 1
+                    self._check_finished(name)
+            finally:
+                self.lock.release()
+
+    def _check_finished(self, name):
+        # Called with the lock held
+        status = self.shares[name]
+        if not status['walking'] and status['done'] >= status['found']:
+            status['finished'] = time.time()
+            logger.debug('Finished scanning share %s, %d files' %
+                         (name, status['found']))
+
+scanner = Scanner()
+rescan = scanner.rescan
+queue_files = scanner.queue_files
+threads = scanner.threads
+status = scanner.status
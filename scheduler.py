@@ -0,0 +1,213 @@
+"""Admission control for the external processes pyTivo starts (FFmpeg,
+tivodecode), so a burst of requests or a library scan can't swamp the
+machine.
+
+Every job belongs to a class:
+
+    live   - streams being sent to a client right now
+    probe  - file info, thumbnails and photo renders
+    batch  - remuxing and other prep work nobody is watching
+
+Each class has its own limit on how many jobs run at once. Jobs that
+can't start yet wait in one queue, ordered by class (live first), then
+by deadline, then by arrival; nothing from a lower class is let in
+while a live job is waiting. A job that's still queued when its
+deadline passes is dropped, and acquire() returns None. Live jobs wait
+up to LIVE_DEADLINE seconds, so a client isn't left hanging.
+
+Probes started from background threads (see set_background()) get no
+deadline, so anything a client is waiting on goes ahead of them; and
+while a live job is running, only one of them runs at a time. On POSIX
+systems, probe and batch processes also run at a lower CPU priority.
+
+    job = scheduler.acquire('probe', path)
+    if job:
+        try:
+            ...
+        finally:
+            scheduler.release(job)
+"""
+
+import logging
+import os
+import threading
+import time
+
+import config
+
+logger = logging.getLogger('pyTivo.scheduler')
+
+CLASSES = ('live', 'probe', 'batch')
+DEFAULT_LIMITS = {'live': 0, 'probe': 2, 'batch': 1}   # 0 = no limit
+PROBE_DEADLINE = 60     # Seconds a foreground probe may wait, by default
+LIVE_DEADLINE = 30      # Seconds a stream may wait, by default
+NICE = 10               # Added to the niceness of probe and batch jobs
+
+class Job(object):
+
+    def __init__(self, cls, desc, deadline, background, seq):
+        self.cls = cls
+        self.desc = desc
+        self.deadline = deadline
+        self.background = background
+        self.seq = seq
+        self.queued = time.time()
+        self.started = None
+        self.finished = False
+
+    def order(self):
+        deadline = self.deadline
+        if deadline is None:
+            deadline = float('inf')
+        return (CLASSES.index(self.cls), deadline, self.seq)
+
+class Scheduler(object):
+
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.local = threading.local()
+        self.queue = []
+        self.running = []
+        self.seq = 0
+        self.expired = 0
+
+    def limit(self, cls):
+        try:
+            return max(int(config.get_server('ffmpeg_%s_jobs' % cls,
+                                             DEFAULT_LIMITS[cls])), 0)
+        except ValueError:
+            return DEFAULT_LIMITS[cls]
+
+    def set_background(self, background=True):
+        """Mark the calling thread's jobs as background work."""
+        self.local.background = background
+
+    def default_deadline(self, cls, background):
+        if cls == 'live':
+            return LIVE_DEADLINE
+        if cls != 'probe' or background:
+            return None
+        return config.getFFmpegWait() or PROBE_DEADLINE
+
+    def acquire(self, cls, desc='', timeout=-1):
+        """Wait for a slot in class cls. desc is shown on the Status
+           page. timeout is how long to wait (None for no limit; the
+           default depends on the class). Returns the job, to be handed
+           to release() when the process is done, or None if the
+           deadline passed first."""
+        background = getattr(self.local, 'background', False)
+        if timeout == -1:
+            timeout = self.default_deadline(cls, background)
+        if timeout is None:
+            deadline = None
+        else:
+            deadline = time.time() + timeout
+
+        self.cond.acquire()
+        try:
+            self.seq += 1
+            job = Job(cls, desc, deadline, background, self.seq)
+            self.queue.append(job)
+            self.queue.sort(key=Job.order)
+            while True:
+                self._admit()
+                if job.started:
+                    return job
+                if deadline is None:
+                    self.cond.wait(5)
+                else:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        self.queue.remove(job)
+                        self.expired += 1
+                        self.cond.notifyAll()
+                        logger.info('Gave up waiting to %s %s' % (cls, desc))
+                        return None
+                    self.cond.wait(min(remaining, 5))
+        finally:
+            self.cond.release()
+
+    def release(self, job):
+        """Free the job's slot. Safe to call more than once."""
+        if not job:
+            return
+        self.cond.acquire()
+        try:
+            if not job.finished:
+                job.finished = True
+                self.running.remove(job)
+                self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def _admit(self):
+        # Called with the condition held. Starts whatever can start,
+        # in queue order.
+        counts = dict((cls, 0) for cls in CLASSES)
+        background = 0
+        for job in self.running:
+            counts[job.cls] += 1
+            if job.background:
+                background += 1
+        limits = dict((cls, self.limit(cls)) for cls in CLASSES)
+
+        started = False
+        live_waiting = False
+        for job in self.queue[:]:
+            if job.cls != 'live' and live_waiting:
+                break
+            limit = limits[job.cls]
+            if limit and counts[job.cls] >= limit:
+                if job.cls == 'live':
+                    live_waiting = True
+                continue
+            if job.background and counts['live'] and background:
+                continue
+            self.queue.remove(job)
+            self.running.append(job)
+            job.started = time.time()
+            counts[job.cls] += 1
+            if job.background:
+                background += 1
+            started = True
+        if started:
+            self.cond.notifyAll()
+
+    def preexec(self, cls):
+        """A preexec_fn for subprocess.Popen, lowering the priority of
+           anything that isn't live (None where that's not possible)."""
+        if cls == 'live' or not hasattr(os, 'nice'):
+            return None
+        return lambda: os.nice(NICE)
+
+    def status(self):
+        now = time.time()
+        self.cond.acquire()
+        try:
+            running = [{'cls': job.cls, 'desc': job.desc,
+                        'background': job.background,
+                        'time': now - job.started} for job in self.running]
+            queued = [{'cls': job.cls, 'desc': job.desc,
+                       'background': job.background,
+                       'time': now - job.queued,
+                       'deadline': job.deadline and job.deadline - now}
+                      for job in self.queue]
+            expired = self.expired
+        finally:
+            self.cond.release()
+        classes = []
+        for cls in CLASSES:
+            classes.append({'cls': cls, 'limit': self.limit(cls),
+                            'running': len([x for x in running
+                                            if x['cls'] == cls]),
+                            'queued': len([x for x in queued
+                                           if x['cls'] == cls])})
+        return {'classes': classes, 'running': running, 'queued': queued,
+                'expired': expired}
+
+scheduler = Scheduler()
+acquire = scheduler.acquire
+release = scheduler.release
+set_background = scheduler.set_background
+preexec = scheduler.preexec
+status = scheduler.status
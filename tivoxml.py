@@ -0,0 +1,158 @@
+"""Single-pass readers for the XML TiVos send: container listings (the
+Now Playing List) and TvBus program details (from TiVoVideoDetails, or
+tdcat).
+
+These take their data from expat events as the document is read, and
+keep only the text and attribute values they return -- no DOM tree is
+built, and nothing is searched afterwards. Paths in the results are
+the element names below the point of reference, joined by "/", as used
+by metadata.tag_data(); as with tag_data(), the first match wins.
+"""
+
+from xml.parsers import expat
+
+def _parse(source, start, end, data):
+    parser = expat.ParserCreate()
+    parser.buffer_text = True
+    parser.StartElementHandler = start
+    parser.EndElementHandler = end
+    parser.CharacterDataHandler = data
+    if isinstance(source, basestring):
+        parser.Parse(source, True)
+    else:
+        parser.ParseFile(source)
+
+class _Element(object):
+    __slots__ = ('name', 'path', 'text', 'children', 'elements')
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path        # Below the reference point
+        self.text = []          # Text before the first child element
+        self.children = False
+        self.elements = None    # Text of "element" children, if any
+
+class _Reader(object):
+
+    def __init__(self):
+        self.stack = []
+
+    def start(self, name, attrs):
+        if self.stack:
+            parent = self.stack[-1]
+            parent.children = True
+            path = self.subpath(parent, name)
+        else:
+            path = None
+        self.stack.append(_Element(name, path))
+        self.opened(name, attrs)
+
+    def subpath(self, parent, name):
+        if parent.path is None:
+            return None
+        if parent.path:
+            return parent.path + '/' + name
+        return name
+
+    def data(self, text):
+        element = self.stack[-1]
+        if not element.children:
+            element.text.append(text)
+
+    def end(self, name):
+        element = self.stack.pop()
+        text = ''
+        if not element.children:
+            text = u''.join(element.text)
+        self.closed(element, text)
+
+    def opened(self, name, attrs):
+        pass
+
+    def closed(self, element, text):
+        pass
+
+class _ContainerReader(_Reader):
+
+    def __init__(self):
+        _Reader.__init__(self)
+        self.details = {}
+        self.items = []
+        self.item = None
+
+    def start(self, name, attrs):
+        depth = len(self.stack)
+        _Reader.start(self, name, attrs)
+        if depth == 0:
+            self.stack[-1].path = ''
+            self.fields = self.details
+        elif depth == 1 and name == 'Item':
+            self.stack[-1].path = ''
+            self.item = self.fields = {}
+
+    def closed(self, element, text):
+        if not element.path:
+            if self.item is not None and element.name == 'Item':
+                self.items.append(self.item)
+                self.item = None
+                self.fields = self.details
+        elif text and element.path not in self.fields:
+            self.fields[element.path] = text
+
+def parse_container(source):
+    """Read a TiVoContainer document from a string or file object.
+       Returns (details, items): details maps the paths below the root
+       (like "Details/TotalItems" or "ItemStart") to their text, outside
+       of the Items; items is a list of one such dict for each Item,
+       with paths below it (like "Details/Title" or
+       "Links/Content/Url")."""
+    reader = _ContainerReader()
+    _parse(source, reader.start, reader.end, reader.data)
+    return reader.details, reader.items
+
+class _DetailsReader(_Reader):
+
+    def __init__(self):
+        _Reader.__init__(self)
+        self.fields = {}
+        self.vitems = {}
+        self.values = {}
+        self.showing = None     # The first <showing> element, while open
+        self.done = False
+
+    def opened(self, name, attrs):
+        if self.showing:
+            if name not in self.values and 'value' in attrs:
+                self.values[name] = attrs['value']
+        elif name == 'showing' and not self.done:
+            self.showing = self.stack[-1]
+            self.showing.path = ''
+
+    def closed(self, element, text):
+        if not self.showing:
+            return
+        if element is self.showing:
+            self.showing = None
+            self.done = True
+            return
+        if element.elements is not None and element.name not in self.vitems:
+            self.vitems[element.name] = element.elements
+        if element.name == 'element' and text:
+            parent = self.stack[-1]
+            if parent.elements is None:
+                parent.elements = []
+            parent.elements.append(text)
+        if text and element.path not in self.fields:
+            self.fields[element.path] = text
+
+def parse_details(source):
+    """Read a TvBus document (the details of one showing) from a string
+       or file object. Returns (fields, vitems, values), all from within
+       the first <showing>: fields maps paths below it (like
+       "program/title") to their text; vitems maps the names of list
+       elements (like "vActor") to the text of their <element>s; and
+       values maps element names (like "starRating") to their "value"
+       attribute."""
+    reader = _DetailsReader()
+    _parse(source, reader.start, reader.end, reader.data)
+    return reader.fields, reader.vitems, reader.values
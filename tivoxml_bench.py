@@ -0,0 +1,257 @@
+#!/usr/bin/env python
+
+"""Compare the tivoxml readers with the minidom code they replaced.
+
+    usage: tivoxml_bench.py [items ...]
+
+For each NPL size (by default 50, 500 and 5000 items), this builds a
+container document like a TiVo's and times reading every Item's fields
+and metadata both ways; then it does the same for a TvBus details
+document, as from_details() gets from a TiVo or from tdcat. The results
+of the two are checked against each other; times are per document.
+"""
+
+import sys
+import time
+from xml.dom import minidom
+
+import metadata
+import tivoxml
+from metadata import tag_data, TRIBUNE_CR
+
+ITEM = """<Item><Details><Title>Show %(n)d</Title>
+<ContentType>video/x-tivo-raw-tts</ContentType>
+<SourceFormat>video/x-tivo-raw-tts</SourceFormat>
+<SourceSize>%(size)d</SourceSize><Duration>1799000</Duration>
+<CaptureDate>0x4C3E2A10</CaptureDate>
+<EpisodeTitle>Episode &amp; Title %(n)d</EpisodeTitle>
+<Description>What happens in episode %(n)d.%(cr)s</Description>
+<SourceChannel>%(n)d-1</SourceChannel><SourceStation>KABC</SourceStation>
+<HighDefinition>Yes</HighDefinition><ProgramId>EP%(n)08d0001</ProgramId>
+<SeriesId>SH%(n)08d</SeriesId><EpisodeNumber>%(n)d</EpisodeNumber>
+<TvRating>4</TvRating><ByteOffset>0</ByteOffset>
+<UniqueId>%(n)d</UniqueId><ShowingBits>4099</ShowingBits>
+</Details><Links><Content>
+<Url>http://10.0.0.2:80/download/Show%%20%(n)d.TiVo?Container=%%2FNowPlaying&amp;id=%(n)d</Url>
+<ContentType>video/x-tivo-raw-tts</ContentType></Content>
+<CustomIcon><ContentType>image/*</ContentType>
+<AcceptsParams>No</AcceptsParams>
+<Url>urn:tivo:image:save-until-i-delete-recording</Url></CustomIcon>
+<TiVoVideoDetails><ContentType>text/xml</ContentType>
+<AcceptsParams>No</AcceptsParams>
+<Url>https://10.0.0.2:443/TiVoVideoDetails?id=%(n)d</Url>
+</TiVoVideoDetails></Links></Item>
+"""
+
+CONTAINER = """<?xml version="1.0" encoding="utf-8"?>
+<TiVoContainer xmlns="http://www.tivo.com/developer/calypso-protocol-1.6/">
+<Details><ContentType>x-tivo-container/tivo-videos</ContentType>
+<SourceFormat>x-tivo-container/tivo-dvr</SourceFormat>
+<Title>Now Playing</Title><LastChangeDate>0x4C3E2A10</LastChangeDate>
+<TotalItems>%d</TotalItems><UniqueId>/NowPlaying</UniqueId></Details>
+<SortOrder>Type,CaptureDate</SortOrder><GlobalSort>Yes</GlobalSort>
+<ItemStart>0</ItemStart><ItemCount>%d</ItemCount>
+%s</TiVoContainer>
+"""
+
+ELEMENTS = ''.join(['<element>Person %d</element>' % i for i in xrange(8)])
+
+DETAILS = """<?xml version="1.0" encoding="utf-8"?>
+<TvBusMarshalledStruct:TvBusEnvelope
+ xmlns:xs="http://www.w3.org/2001/XMLSchema-instance"
+ xmlns:TvBusMarshalledStruct="http://tivo.com/developer/xml/idl/TvBusMarshalledStruct"
+ xs:schemaLocation="http://tivo.com/developer/xml/idl/TvBusMarshalledStruct TvBusMarshalledStruct.xsd"
+ xs:type="TvPgdRecording:TvPgdRecording">
+<recordedDuration>PT29M59S</recordedDuration>
+<vActualShowing><element><showingBits value="4099"/>
+<time>2010-07-14T21:00:00Z</time><duration>PT30M</duration>
+<program><vActor>%(e)s</vActor><vAdvisory/>
+<vChoreographer/><colorCode value="4">COLOR</colorCode>
+<description>A long description of the program.%(cr)s</description>
+<vDirector>%(e)s</vDirector><episodeNumber>12</episodeNumber>
+<episodeTitle>The Episode</episodeTitle><vExecProducer>%(e)s</vExecProducer>
+<vProgramGenre><element>Comedy</element><element>Drama</element></vProgramGenre>
+<vGuestStar>%(e)s</vGuestStar><vHost/><isEpisode>true</isEpisode>
+<originalAirDate>2010-07-14T00:00:00Z</originalAirDate>
+<vProducer>%(e)s</vProducer><series><isEpisodic>true</isEpisodic>
+<vSeriesGenre><element>Comedy</element></vSeriesGenre>
+<seriesTitle>The Series</seriesTitle><uniqueId>SH0000001</uniqueId></series>
+<starRating value="5">THREE</starRating><title>The Series</title>
+<uniqueId>EP0000010012</uniqueId><vWriter>%(e)s</vWriter></program>
+<channel><displayMajorNumber>7</displayMajorNumber>
+<displayMinorNumber>1</displayMinorNumber><callsign>KABC</callsign></channel>
+<tvRating value="4">PG</tvRating></element></vActualShowing>
+<vBookmark/><showing><showingBits value="4099"/>
+<time>2010-07-14T21:00:00Z</time><duration>PT30M</duration>
+<partCount>1</partCount><partIndex>1</partIndex>
+<program><vActor>%(e)s</vActor><vAdvisory/>
+<vChoreographer/><colorCode value="4">COLOR</colorCode>
+<description>A long description of the program.%(cr)s</description>
+<vDirector>%(e)s</vDirector><episodeNumber>12</episodeNumber>
+<episodeTitle>The Episode</episodeTitle><vExecProducer>%(e)s</vExecProducer>
+<vProgramGenre><element>Comedy</element><element>Drama</element></vProgramGenre>
+<vGuestStar>%(e)s</vGuestStar><vHost/><isEpisode>true</isEpisode>
+<originalAirDate>2010-07-14T00:00:00Z</originalAirDate>
+<vProducer>%(e)s</vProducer><series><isEpisodic>true</isEpisodic>
+<vSeriesGenre><element>Comedy</element></vSeriesGenre>
+<seriesTitle>The Series</seriesTitle><uniqueId>SH0000001</uniqueId></series>
+<starRating value="5">THREE</starRating><title>The Series</title>
+<uniqueId>EP0000010012</uniqueId><vWriter>%(e)s</vWriter></program>
+<channel><displayMajorNumber>7</displayMajorNumber>
+<displayMinorNumber>1</displayMinorNumber><callsign>KABC</callsign></channel>
+<tvRating value="4">PG</tvRating></showing>
+<startTime>2010-07-14T21:00:00Z</startTime>
+</TvBusMarshalledStruct:TvBusEnvelope>
+""" % {'e': ELEMENTS, 'cr': TRIBUNE_CR}
+
+# The fields ToGo reads from each Item
+ITEM_FIELDS = ('Details/ContentType', 'Details/CopyProtected',
+               'Details/UniqueId', 'Details/Title', 'Details/TotalItems',
+               'Details/LastCaptureDate', 'Details/LastChangeDate',
+               'Links/CustomIcon/Url', 'Links/Content/Url',
+               'Details/SourceSize', 'Details/Duration',
+               'Details/CaptureDate')
+
+def dom_from_container(xmldoc):
+    """metadata.from_container() before tivoxml, for comparison."""
+    metadata = {}
+
+    keys = {'title': 'Title', 'episodeTitle': 'EpisodeTitle',
+            'description': 'Description', 'programId': 'ProgramId',
+            'seriesId': 'SeriesId', 'episodeNumber': 'EpisodeNumber',
+            'tvRating': 'TvRating', 'displayMajorNumber': 'SourceChannel',
+            'callsign': 'SourceStation', 'showingBits': 'ShowingBits',
+            'mpaaRating': 'MpaaRating'}
+
+    details = xmldoc.getElementsByTagName('Details')[0]
+
+    for key in keys:
+        data = tag_data(details, keys[key])
+        if data:
+            if key == 'description':
+                data = data.replace(TRIBUNE_CR, '')
+            elif key == 'tvRating':
+                data = int(data)
+            elif key == 'displayMajorNumber':
+                if '-' in data:
+                    data, metadata['displayMinorNumber'] = data.split('-')
+            metadata[key] = data
+
+    return metadata
+
+def _vtag_data(element, tag):
+    for name in tag.split('/'):
+        new_element = element.getElementsByTagName(name)
+        if not new_element:
+            return []
+        element = new_element[0]
+    elements = element.getElementsByTagName('element')
+    return [x.firstChild.data for x in elements if x.firstChild]
+
+def _tag_value(element, tag):
+    item = element.getElementsByTagName(tag)
+    if item:
+        value = item[0].attributes['value'].value
+        return int(value[0])
+
+def dom_from_details(xml):
+    """metadata.from_details() before tivoxml, for comparison."""
+    metadata = {}
+
+    xmldoc = minidom.parseString(xml)
+    showing = xmldoc.getElementsByTagName('showing')[0]
+    program = showing.getElementsByTagName('program')[0]
+
+    items = {'description': 'program/description',
+             'title': 'program/title',
+             'episodeTitle': 'program/episodeTitle',
+             'episodeNumber': 'program/episodeNumber',
+             'programId': 'program/uniqueId',
+             'seriesId': 'program/series/uniqueId',
+             'seriesTitle': 'program/series/seriesTitle',
+             'originalAirDate': 'program/originalAirDate',
+             'isEpisode': 'program/isEpisode',
+             'movieYear': 'program/movieYear',
+             'partCount': 'partCount',
+             'partIndex': 'partIndex',
+             'time': 'time'}
+
+    for item in items:
+        data = tag_data(showing, items[item])
+        if data:
+            if item == 'description':
+                data = data.replace(TRIBUNE_CR, '')
+            metadata[item] = data
+
+    vItems = ['vActor', 'vChoreographer', 'vDirector',
+              'vExecProducer', 'vProgramGenre', 'vGuestStar',
+              'vHost', 'vProducer', 'vWriter']
+
+    for item in vItems:
+        data = _vtag_data(program, item)
+        if data:
+            metadata[item] = data
+
+    sb = showing.getElementsByTagName('showingBits')
+    if sb:
+        metadata['showingBits'] = sb[0].attributes['value'].value
+
+    for tag in ['starRating', 'mpaaRating']:
+        value = _tag_value(program, tag)
+        if value:
+            metadata[tag] = value
+
+    rating = _tag_value(showing, 'tvRating')
+    if rating:
+        metadata['tvRating'] = rating
+
+    return metadata
+
+def dom_container(xml):
+    xmldoc = minidom.parseString(xml)
+    total = tag_data(xmldoc, 'TiVoContainer/Details/TotalItems')
+    result = []
+    for item in xmldoc.getElementsByTagName('Item'):
+        fields = dict((key, tag_data(item, key)) for key in ITEM_FIELDS)
+        result.append((fields, dom_from_container(item)))
+    xmldoc.unlink()
+    return total, result
+
+def sax_container(xml):
+    details, items = tivoxml.parse_container(xml)
+    total = details.get('Details/TotalItems', '')
+    result = []
+    for item in items:
+        fields = dict((key, item.get(key, '')) for key in ITEM_FIELDS)
+        result.append((fields, metadata.from_container(item)))
+    return total, result
+
+def timed(func, arg, reps):
+    start = time.time()
+    for i in xrange(reps):
+        result = func(arg)
+    return result, (time.time() - start) / reps
+
+def main(argv):
+    counts = [int(x) for x in argv] or [50, 500, 5000]
+    print '%-10s %8s %12s %12s %8s' % ('document', 'items', 'minidom ms',
+                                      'tivoxml ms', 'speedup')
+    for count in counts:
+        items = ''.join([ITEM % {'n': n, 'size': n * 1000003,
+                                 'cr': TRIBUNE_CR} for n in xrange(count)])
+        xml = CONTAINER % (count, count, items)
+        reps = max(1, 500 / count)
+        old, old_time = timed(dom_container, xml, reps)
+        new, new_time = timed(sax_container, xml, reps)
+        assert old == new, 'Results differ'
+        print '%-10s %8d %12.2f %12.2f %7.1fx' % ('container', count,
+            old_time * 1000, new_time * 1000, old_time / new_time)
+
+    old, old_time = timed(dom_from_details, DETAILS, 200)
+    new, new_time = timed(metadata.from_details, DETAILS, 200)
+    assert old == new, 'Results differ'
+    print '%-10s %8s %12.2f %12.2f %7.1fx' % ('details', '-',
+        old_time * 1000, new_time * 1000, old_time / new_time)
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
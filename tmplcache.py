@@ -0,0 +1,90 @@
+"""Compiled Cheetah templates, by file name.
+
+Each .tmpl file is compiled once into a template class, which is then
+instantiated per request; a file is recompiled only when its mtime
+changes. If cache_dir is set, the generated Python code is also kept
+under cache_dir/templates, so a restart skips the Cheetah compiler.
+
+    t = tmplcache.get(path)(filter=EncodeUnicode)
+"""
+
+import logging
+import new
+import os
+import re
+import sys
+import tempfile
+import threading
+from hashlib import md5
+
+from Cheetah.Template import Template
+from Cheetah.Version import Version
+
+import config
+
+logger = logging.getLogger('pyTivo.tmplcache')
+
+class TemplateCache(object):
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.classes = {}   # path -> (mtime, class)
+
+    def get(self, path):
+        """Return the template class for path, compiling it if needed."""
+        mtime = os.path.getmtime(path)
+        entry = self.classes.get(path)
+        if entry and entry[0] == mtime:
+            return entry[1]
+
+        self.lock.acquire()
+        try:
+            entry = self.classes.get(path)
+            if not entry or entry[0] != mtime:
+                entry = (mtime, self.compile(path))
+                self.classes[path] = entry
+        finally:
+            self.lock.release()
+        return entry[1]
+
+    def compile(self, path):
+        # Called with the lock held
+        source = file(path, 'rb').read()
+        digest = md5(Version + '\0' + source).hexdigest()
+        name = re.sub(r'\W', '_', os.path.splitext(os.path.basename(path))[0])
+        name = 'tmpl_%s_%s' % (name, digest)
+
+        code = None
+        fname = path
+        cache_dir = config.get_cache_dir('templates')
+        if cache_dir:
+            fname = os.path.join(cache_dir, name + '.py')
+            try:
+                code = file(fname, 'rb').read()
+            except IOError:
+                pass
+
+        if code is None:
+            code = Template.compile(source, returnAClass=False,
+                                    moduleName=name, className=name)
+            logger.debug('Compiled %s' % path)
+            if cache_dir:
+                try:
+                    fd, tmpname = tempfile.mkstemp(dir=cache_dir)
+                    os.write(fd, code)
+                    os.close(fd)
+                    if os.path.exists(fname):
+                        os.remove(fname)
+                    os.rename(tmpname, fname)
+                except (IOError, OSError), msg:
+                    logger.error('Unable to write %s -- %s' % (fname, msg))
+
+        # Cheetah looks up the module to check the compiler version
+        mod = new.module(name)
+        mod.__file__ = fname
+        exec compile(code, fname, 'exec') in mod.__dict__
+        sys.modules[name] = mod
+        return getattr(mod, name)
+
+template_cache = TemplateCache()
+get = template_cache.get
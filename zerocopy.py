@@ -0,0 +1,111 @@
+"""Send a file (or part of one) to an HTTP client.
+
+Where the platform allows, this uses sendfile(2), so the data goes from
+the page cache to the socket without passing through Python -- via
+os.sendfile if it exists, else the "sendfile" module (pysendfile) if
+it's installed, else libc through ctypes on Linux. Otherwise, or if the
+socket won't accept it, it falls back to the usual read/write loop.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import socket
+import sys
+
+logger = logging.getLogger('pyTivo.zerocopy')
+
+BLOCKSIZE = 512 * 1024
+CHUNK = 8 * 1024 * 1024     # Most to hand to sendfile() in one call
+
+# Errors meaning sendfile() can't be used here at all
+UNSUPPORTED = (errno.EINVAL, errno.ENOSYS, errno.EOPNOTSUPP, errno.ENOTSOCK)
+
+def _find_sendfile():
+    if hasattr(os, 'sendfile'):
+        return os.sendfile
+
+    try:
+        import sendfile
+        return sendfile.sendfile
+    except ImportError:
+        pass
+
+    if sys.platform.startswith('linux'):
+        try:
+            libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+            func = libc.sendfile64
+        except (OSError, TypeError, AttributeError):
+            return None
+        func.argtypes = [ctypes.c_int, ctypes.c_int,
+                         ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+        func.restype = getattr(ctypes, 'c_ssize_t', ctypes.c_long)
+
+        def libc_sendfile(out_fd, in_fd, offset, count):
+            off = ctypes.c_int64(offset)
+            sent = func(out_fd, in_fd, ctypes.byref(off), count)
+            if sent < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            return sent
+
+        return libc_sendfile
+
+    return None
+
+_sendfile = _find_sendfile()
+
+def copy(wfile, f, offset=0, count=None):
+    """Send the file with a plain read/write loop."""
+    f.seek(offset)
+    sent = 0
+    while count is None or sent < count:
+        size = BLOCKSIZE
+        if count is not None:
+            size = min(size, count - sent)
+        block = f.read(size)
+        if not block:
+            break
+        wfile.write(block)
+        sent += len(block)
+    return sent
+
+def sendfile(wfile, f, offset=0, count=None):
+    """Send count bytes (default: to the end) of the open file f,
+       starting at offset, to the socket behind wfile. Returns the
+       number of bytes sent; errors writing to the socket are raised,
+       as with wfile.write()."""
+    sock = getattr(wfile, '_sock', None)
+    if not _sendfile or not sock:
+        return copy(wfile, f, offset, count)
+
+    # Anything already buffered has to go out first
+    wfile.flush()
+    out_fd = sock.fileno()
+    in_fd = f.fileno()
+    timeout = sock.gettimeout()
+    if count is None:
+        count = os.fstat(in_fd).st_size - offset
+
+    sent = 0
+    while sent < count:
+        try:
+            n = _sendfile(out_fd, in_fd, offset + sent,
+                          min(count - sent, CHUNK))
+        except OSError, msg:
+            if msg.errno in (errno.EAGAIN, errno.EINTR):
+                # A socket with a timeout is non-blocking underneath
+                if not select.select([], [out_fd], [], timeout)[1]:
+                    raise socket.timeout('timed out')
+                continue
+            if msg.errno in UNSUPPORTED and not sent:
+                logger.debug('sendfile() not usable -- %s' % msg)
+                return copy(wfile, f, offset, count)
+            raise socket.error(msg.errno, msg.strerror)
+        if not n:
+            break   # The file got shorter
+        sent += n
+    return sent